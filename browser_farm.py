@@ -0,0 +1,177 @@
+"""
+浏览器服务 (Browser Farm)
+
+独立进程持有本机所有 Chrome / chromedriver：登录、等待 2FA 的 driver、Token 嗅探都在这里完成。
+API / Celery / 任务引擎设置 BROWSER_FARM=true 后不再自己启动浏览器，而是通过本机 Unix Socket RPC
+调用本进程，浏览器崩溃或内存暴涨不会拖垮 API 进程。
+
+启动: python browser_farm.py （或使用 scut-browser.service）
+"""
+import os
+
+# 必须在导入 core 之前设置：固定节点 ID 以便其他进程找到本服务，并且本进程始终是单进程模式
+os.environ["SCUT_ROLE"] = "browser_farm"
+os.environ["API_WORKERS"] = "1"
+os.environ.setdefault("ENGINE_NODE_ID", "browser-farm")
+
+# ================= 资源上限 =================
+FARM_MAX_CONCURRENT_LOGINS = int(os.environ.get("FARM_MAX_CONCURRENT_LOGINS", 3))  # 同时进行的登录
+FARM_MAX_BROWSERS = int(os.environ.get("FARM_MAX_BROWSERS", 8))                    # 登录中 + 等待 2FA 的浏览器总数
+FARM_MAX_RSS_MB = int(os.environ.get("FARM_MAX_RSS_MB", 3072))                     # 本进程及所有子进程的内存上限
+FARM_SLOT_WAIT = 30                                                                # 排队等待浏览器名额的秒数
+# core 的 BROWSER_SEMAPHORE（BROWSER_LIMIT）同样限制登录中 + 等待 2FA 的浏览器，必须与 FARM_MAX_BROWSERS 一致，
+# 否则默认的 2 个名额会让上面的上限形同虚设
+os.environ["BROWSER_LIMIT"] = str(FARM_MAX_BROWSERS)
+
+import threading
+import time
+
+from core import (
+    add_log, deduplicated_login, complete_2fa, discard_pending_driver,
+    get_login_timing_stats, get_chrome_governor_stats, get_2fa_hold_stats,
+    PENDING_DRIVERS, DRIVER_MAP_LOCK, BROWSER_FARM_NODE, ENGINE_NODE_ID,
+    register_local_rpc, start_local_rpc_server, start_health_check_daemon,
+    start_driver_cleanup_daemon, kill_zombie_processes,
+)
+
+_FARM_COND = threading.Condition()
+_ACTIVE_LOGINS = 0
+
+
+def _descendant_pids(root_pid):
+    """从 /proc 找出 root_pid 的全部子孙进程"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # comm 可能带空格，取最后一个 ')' 之后的字段
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+        except (OSError, ValueError, IndexError):
+            continue
+    result, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        for child in children.get(pid, []):
+            result.append(child)
+            stack.append(child)
+    return result
+
+
+def farm_rss_mb():
+    """本进程 + 所有 Chrome/driver 子进程的 RSS 总和 (MB)，非 Linux 返回 0"""
+    if not os.path.isdir('/proc'):
+        return 0
+    total_kb = 0
+    for pid in [os.getpid()] + _descendant_pids(os.getpid()):
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total_kb += int(line.split()[1])
+                        break
+        except (OSError, ValueError):
+            continue
+    return total_kb // 1024
+
+
+def _browser_count():
+    with DRIVER_MAP_LOCK:
+        pending = len(PENDING_DRIVERS)
+    return _ACTIVE_LOGINS + pending
+
+
+def _acquire_browser_slot():
+    """等待浏览器名额：并发登录数、浏览器总数、内存三个条件都满足才放行"""
+    global _ACTIVE_LOGINS
+    deadline = time.time() + FARM_SLOT_WAIT
+    with _FARM_COND:
+        while True:
+            reason = None
+            if _ACTIVE_LOGINS >= FARM_MAX_CONCURRENT_LOGINS:
+                reason = f"并发登录已达上限 {FARM_MAX_CONCURRENT_LOGINS}"
+            elif _browser_count() >= FARM_MAX_BROWSERS:
+                reason = f"浏览器数量已达上限 {FARM_MAX_BROWSERS}"
+            else:
+                rss = farm_rss_mb()
+                if rss >= FARM_MAX_RSS_MB:
+                    reason = f"内存占用 {rss}MB 超过上限 {FARM_MAX_RSS_MB}MB"
+            if reason is None:
+                _ACTIVE_LOGINS += 1
+                return None
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return reason
+            # 2FA driver 被清理/取走时不会 notify，按 1 秒轮询兜底
+            _FARM_COND.wait(min(remaining, 1))
+
+
+def _release_browser_slot():
+    global _ACTIVE_LOGINS
+    with _FARM_COND:
+        _ACTIVE_LOGINS -= 1
+        _FARM_COND.notify_all()
+
+
+def farm_login(username, password):
+    """RPC：在本进程中完成登录，需要 2FA 时 driver 留在本进程等待验证码"""
+    reason = _acquire_browser_slot()
+    if reason:
+        add_log(f"🧩 [浏览器服务] {username} 登录被拒绝: {reason}")
+        return "error", f"登录繁忙，请稍后重试（{reason}）"
+    try:
+        return deduplicated_login(username, password)
+    finally:
+        _release_browser_slot()
+
+
+def farm_complete_2fa(username, code):
+    """RPC：提交验证码；完成后释放名额"""
+    try:
+        return complete_2fa(username, code)
+    finally:
+        with _FARM_COND:
+            _FARM_COND.notify_all()
+
+
+def farm_stats():
+    """RPC：资源占用快照，附带本进程的登录耗时、浏览器内存和 2FA 等待统计（供 /api/admin/governor 展示）"""
+    with DRIVER_MAP_LOCK:
+        pending = len(PENDING_DRIVERS)
+    return {
+        "node": ENGINE_NODE_ID,
+        "active_logins": _ACTIVE_LOGINS,
+        "pending_2fa": pending,
+        "rss_mb": farm_rss_mb(),
+        "max_concurrent_logins": FARM_MAX_CONCURRENT_LOGINS,
+        "max_browsers": FARM_MAX_BROWSERS,
+        "max_rss_mb": FARM_MAX_RSS_MB,
+        "login": get_login_timing_stats(),
+        "chrome": get_chrome_governor_stats(),
+        "2fa": get_2fa_hold_stats(),
+    }
+
+
+register_local_rpc("login", farm_login)
+register_local_rpc("complete_2fa", farm_complete_2fa)
+register_local_rpc("discard_2fa", discard_pending_driver)
+register_local_rpc("stats", farm_stats)
+
+
+def main():
+    if ENGINE_NODE_ID != BROWSER_FARM_NODE:
+        add_log(f"⚠️ [浏览器服务] 节点 ID {ENGINE_NODE_ID} 与 BROWSER_FARM_NODE={BROWSER_FARM_NODE} 不一致，其他进程将无法调用")
+    # 本机的浏览器都归本服务管理，启动时清理上次遗留的进程
+    kill_zombie_processes()
+    start_health_check_daemon()
+    start_driver_cleanup_daemon()
+    start_local_rpc_server()
+    add_log(f"🧩 浏览器服务已启动 (并发登录 {FARM_MAX_CONCURRENT_LOGINS}, 浏览器上限 {FARM_MAX_BROWSERS}, 内存上限 {FARM_MAX_RSS_MB}MB)")
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == "__main__":
+    main()
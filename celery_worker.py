@@ -1,8 +1,11 @@
 from celery import Celery
-import time, random, os, json
+from celery.signals import worker_process_init
+import time, random, os, json, threading
 from core import (
-    add_log, redis_client, send_booking_request, fetch_venue_data, 
-    get_session_from_redis, extract_user_info
+    add_log, redis_client, send_booking_request, send_batch_booking_request,
+    get_session_from_redis, extract_user_info, next_poll_interval,
+    PRIORITY_RENEW, PRIORITY_SNIPE, UPSTREAM_BREAKERS, rank_snipe_candidates,
+    fetch_venue_snapshot, SNAPSHOT_SHARE_AGE
 )
 
 celery_app = Celery('scut_tasks', broker=os.environ.get("REDIS_URL", "redis://localhost:6379/0"))
@@ -12,96 +15,214 @@ def set_task_status(tid, task_type, status, info):
         "type": task_type, "status": status, "info": info
     }), ex=86400)
 
+# --- 停止信号 (Redis Pub/Sub) ---
+# 每个 worker 进程只维持一条订阅连接，收到的停止信号保存在本地集合中，
+# 任务循环里的 is_stopped() 只查内存，不再逐次 GET task_stop:{id}
+STOP_CHANNEL = "scut_order:task_stop"
+STOP_SIGNAL_TTL = 3600  # 与 task_stop:{id} 的过期时间一致
+STOPPED_TASKS = {}  # task_id -> 本地记录的过期时间，与 Redis 标记同时失效，避免各 worker 内无限增长
+_STOP_LOCK = threading.Lock()
+_STOP_LISTENER_READY = threading.Event()  # 已订阅且完成补扫后置位，断线期间清除
+_stop_listener_thread = None
+
+def _stop_listener():
+    """后台线程：订阅停止频道，断线自动重连"""
+    while True:
+        pubsub = None
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(STOP_CHANNEL)
+            # 订阅建立后补扫一次已有的停止标记，避免断线期间漏掉信号
+            existing = {k.replace("task_stop:", "", 1) for k in redis_client.scan_iter("task_stop:*", count=100)}
+            with _STOP_LOCK:
+                # 以 Redis 中现存的标记为准，顺便丢弃已过期的本地记录
+                STOPPED_TASKS.clear()
+                for tid in existing:
+                    STOPPED_TASKS[tid] = time.time() + STOP_SIGNAL_TTL
+            _STOP_LISTENER_READY.set()
+            for msg in pubsub.listen():
+                if msg.get("type") == "message":
+                    with _STOP_LOCK:
+                        STOPPED_TASKS[msg["data"]] = time.time() + STOP_SIGNAL_TTL
+        except Exception as e:
+            _STOP_LISTENER_READY.clear()
+            add_log(f"⚠️ 停止信号订阅异常: {e}")
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+            time.sleep(1)
+
+def start_stop_listener():
+    """启动停止信号订阅线程（幂等）"""
+    global _stop_listener_thread
+    if _stop_listener_thread is None or not _stop_listener_thread.is_alive():
+        _stop_listener_thread = threading.Thread(target=_stop_listener, daemon=True, name="StopListener")
+        _stop_listener_thread.start()
+
+@worker_process_init.connect
+def _on_worker_process_init(**kwargs):
+    # prefork 子进程不继承父进程的线程，需在每个子进程内启动
+    start_stop_listener()
+
 def is_stopped(task_id):
-    return redis_client.get(f"task_stop:{task_id}") is not None
+    start_stop_listener()
+    if not _STOP_LISTENER_READY.is_set():
+        # 订阅尚未就绪（刚启动或正在重连），本地集合可能漏掉信号，直接查 Redis
+        try:
+            return bool(redis_client.exists(f"task_stop:{task_id}"))
+        except Exception as e:
+            add_log(f"⚠️ 停止标记查询失败: {e}")
+            return False
+    now = time.time()
+    with _STOP_LOCK:
+        for tid in [t for t, exp in STOPPED_TASKS.items() if exp <= now]:
+            del STOPPED_TASKS[tid]
+        return task_id in STOPPED_TASKS
+
+
+# 锁场时间配置（秒）
+LOCK_RENEW_INTERVAL = 9 * 60     # 成功后 9 分钟开始续订
+LOCK_BURST_WINDOW = 70           # 爆发续订窗口
+LOCK_BURST_RETRY_DELAY = 0.5     # 爆发期内的重试间隔
+
+
+def _lock_info(params):
+    venue_name = params.get('venueName') or f"场地{params.get('venueId')}"
+    return f"[{params.get('username')}] {params.get('date')} {params.get('startTime')} {venue_name}"
+
+
+def _schedule_lock_renew(task_id, params, countdown, burst_deadline=None, pending=None):
+    """
+    以 countdown 投递下一次续订，并记录 Celery 任务 ID 以便停止时撤销
+    pending: 批量锁场时本轮尚未续订成功的场次
+    """
+    # revoke 只能撤销排队中的任务；停止时正在执行的续订走到这里，直接查 Redis 标记，不再排期
+    if redis_client.exists(f"task_stop:{task_id}"):
+        _finish_lock_task(task_id)
+        return
+    result = lock_renew_task.apply_async(args=(task_id, params, burst_deadline, pending), countdown=countdown)
+    redis_client.set(f"task_celery_id:{task_id}", result.id, ex=86400)
+
+
+def _finish_lock_task(task_id):
+    # 停止标记保留至 STOP_SIGNAL_TTL 过期：revoke 只存在于 worker 内存中，
+    # worker 重启后残留的 ETA 续订仍会执行，要靠该标记在 _schedule_lock_renew / lock_renew_task 中拦下
+    add_log(f"⏹️ [Task {task_id}] 锁场任务已停止")
+    redis_client.delete(f"task_status:{task_id}")
+    redis_client.delete(f"task_celery_id:{task_id}")
+
+
+def stop_task(task_id):
+    """
+    停止任务：
+    - 锁场任务：撤销已排期的续订任务（不再占用 worker）
+    - 捡漏任务：写入停止标记并广播，由循环在本地集合中感知后退出
+    """
+    redis_client.set(f"task_stop:{task_id}", "1", ex=STOP_SIGNAL_TTL)
+    redis_client.publish(STOP_CHANNEL, task_id)
+    celery_id = redis_client.get(f"task_celery_id:{task_id}")
+    if celery_id:
+        celery_app.control.revoke(celery_id)
+        # 保留停止标记至过期，防止正在执行的续订再次排期
+        add_log(f"⏹️ [Task {task_id}] 锁场任务已停止")
+        redis_client.delete(f"task_status:{task_id}")
+        redis_client.delete(f"task_celery_id:{task_id}")
 
 
 @celery_app.task(bind=True)
 def lock_task(self, task_id, params):
     """
     锁场保活任务（已预定成功后启动）
-    - 只负责每 9 分钟续订一次
-    - 复制自 server.py monitor_worker 的续订逻辑
+    - 不再阻塞 worker 等待 9 分钟，而是按截止时间投递短任务 lock_renew_task
+    - 每次续订成功后由 lock_renew_task 重新排期下一轮
     """
-    token = params.get('token')
-    date = params.get('date')
-    start_time = params.get('startTime')
-    end_time = params.get('endTime')
-    venue_id = params.get('venueId')
-    venue_name = params.get('venueName', f"场地{venue_id}")
-    username = params.get('username')
-    user_id = params.get('userId')
-    price = params.get('price', 40)
-    
-    info = f"[{username}] {date} {start_time} {venue_name}"
+    info = _lock_info(params)
     add_log(f"🔒 [Task {task_id}] 锁场保活已启动")
     set_task_status(task_id, "lock", "已锁场", info)
-    
-    # 当前凭证（从 Redis 同步，与 server.py 一致）
-    current_token = token
-    current_cookies = {}
-    
+
+    add_log(f"⏸️ [Task {task_id}] 等待 9 分钟后续订...")
+    _schedule_lock_renew(task_id, params, LOCK_RENEW_INTERVAL)
+    return "Scheduled"
+
+
+@celery_app.task(bind=True)
+def lock_renew_task(self, task_id, params, burst_deadline=None, pending=None):
+    """
+    单次续订尝试（短任务）
+    - burst_deadline 为空表示新一轮爆发续订的开始
+    - 失败且仍在爆发窗口内：LOCK_BURST_RETRY_DELAY 后重试
+    - 成功或窗口结束：LOCK_RENEW_INTERVAL 后进入下一轮
+    - params.slots 存在时为批量锁场：所有场次合并为一个请求，窗口内只重试失败的场次，
+      窗口结束时放弃仍失败的场次（若有其他场次续订成功）
+    """
+    if is_stopped(task_id):
+        _finish_lock_task(task_id)
+        return "Done"
+
+    info = _lock_info(params)
+    slots = params.get('slots')
+    if burst_deadline is None:
+        add_log(f"⚡ [Task {task_id}] 爆发期开始 ({LOCK_BURST_WINDOW}s)!")
+        set_task_status(task_id, "lock", "续订中", info)
+        burst_deadline = time.time() + LOCK_BURST_WINDOW
+        pending = slots
+
     try:
-        while not is_stopped(task_id):
-            add_log(f"⏸️ [Task {task_id}] 等待 9 分钟后续订...")
-            
-            # 9分钟等待，每10秒检查一次停止信号
-            for _ in range(54):
-                if is_stopped(task_id): break
-                time.sleep(10)
-            
-            if is_stopped(task_id): break
-            
-            # 爆发续订 70 秒（完全复制 server.py 的逻辑）
-            add_log(f"⚡ [Task {task_id}] 爆发期开始 (70s)!")
-            set_task_status(task_id, "lock", "续订中", info)
-            
-            burst_start = time.time()
-            round_success = False
-            
-            while time.time() - burst_start < 70:
-                if is_stopped(task_id): break
-                
-                # Token 同步逻辑（与 server.py 一致）
-                session = get_session_from_redis(username)
-                if session:
-                    if session.get('token') and session.get('token') != current_token:
-                        current_token = session['token']
-                        current_cookies = session.get('cookies', {})
-                
-                # 发送请求（与 server.py 完全一致的调用方式）
-                # DEBUG: 输出调试信息
-                add_log(f"🔍 [DEBUG] Token: {current_token[:50]}..." if current_token else "Token: None")
-                add_log(f"🔍 [DEBUG] user_id={user_id}, venue_id={venue_id}, price={price}")
-                add_log(f"🔍 [DEBUG] cookies keys: {list(current_cookies.keys()) if current_cookies else 'Empty'}")
-                
-                ok_renew, msg_renew = send_booking_request(
-                    current_token, user_id, date, start_time, end_time,
-                    venue_id, price, cookies=current_cookies
-                )
-                
-                # DEBUG: 输出结果
-                add_log(f"🔍 [DEBUG] 续订结果: ok={ok_renew}, msg={msg_renew}")
-                
-                if ok_renew:
-                    add_log(f"✅ [Task {task_id}] 续订成功!")
-                    round_success = True
-                    break
-                
-                time.sleep(0.5)
-            
-            if not round_success and not is_stopped(task_id):
-                add_log(f"⚠️ [Task {task_id}] 本轮续订失败，继续尝试...")
-            
-            set_task_status(task_id, "lock", "已锁场", info)
-    
+        # Token 同步逻辑（与 server.py 一致）
+        current_token = params.get('token')
+        current_cookies = {}
+        session = get_session_from_redis(params.get('username'))
+        if session and session.get('token'):
+            current_token = session['token']
+            current_cookies = session.get('cookies', {})
+
+        if slots:
+            booked, failed = send_batch_booking_request(
+                current_token, params.get('userId'), params.get('date'), pending or slots,
+                cookies=current_cookies, priority=PRIORITY_RENEW,
+                username=params.get('username'), hedge=True
+            )
+            pending = [slot for slot, _ in failed]
+            ok_renew = not pending
+            msg_renew = failed[0][1] if failed else "预定成功"
+        else:
+            ok_renew, msg_renew, _ = send_booking_request(
+                current_token, params.get('userId'), params.get('date'),
+                params.get('startTime'), params.get('endTime'),
+                params.get('venueId'), params.get('price', 40), cookies=current_cookies,
+                priority=PRIORITY_RENEW, username=params.get('username'), hedge=True
+            )
     except Exception as e:
         add_log(f"❌ [Task {task_id}] 异常: {e}")
-    
-    add_log(f"⏹️ [Task {task_id}] 锁场任务已停止")
-    redis_client.delete(f"task_stop:{task_id}")
-    redis_client.delete(f"task_status:{task_id}")
-    return "Done"
+        ok_renew, msg_renew = False, str(e)
+
+    if ok_renew:
+        add_log(f"✅ [Task {task_id}] 续订成功!")
+        set_task_status(task_id, "lock", "已锁场", info)
+        _schedule_lock_renew(task_id, params, LOCK_RENEW_INTERVAL)
+        return "Renewed"
+
+    # 业务拒绝快速重试；上游故障时按熔断器指数退避
+    retry_delay = UPSTREAM_BREAKERS["apply"].retry_delay(LOCK_BURST_RETRY_DELAY, cap=2.0)
+    if time.time() + retry_delay < burst_deadline:
+        _schedule_lock_renew(task_id, params, retry_delay, burst_deadline, pending)
+        return "Retry"
+
+    if slots and pending and len(pending) < len(slots):
+        # 部分场次续订成功：放弃失败的场次，其余继续锁定
+        lost_keys = {(p['startTime'], str(p['venueId'])) for p in pending}
+        params = dict(params, slots=[x for x in slots if (x['startTime'], str(x['venueId'])) not in lost_keys])
+        add_log(f"⚠️ [Task {task_id}] {len(pending)} 个场次续订失败 ({msg_renew})，已放弃，其余场次继续锁定")
+        set_task_status(task_id, "lock", "已锁场", info)
+        _schedule_lock_renew(task_id, params, LOCK_RENEW_INTERVAL)
+        return "Partial"
+
+    add_log(f"⚠️ [Task {task_id}] 本轮续订失败 ({msg_renew})，继续尝试...")
+    set_task_status(task_id, "lock", "已锁场", info)
+    _schedule_lock_renew(task_id, params, LOCK_RENEW_INTERVAL)
+    return "Failed"
 
 
 @celery_app.task(bind=True)
@@ -110,6 +231,7 @@ def monitor_task(self, task_id, params):
     自动捡漏任务（扫描空场 -> 预定）
     - 持续扫描指定日期时间的空场
     - 复制自 server.py monitor_worker 的扫描逻辑
+    - 可选参数 venuePreference（场地偏好顺序）、altStartTimes（备选开始时间）
     """
     token = params.get('token')
     date = params.get('date')
@@ -147,66 +269,66 @@ def monitor_task(self, task_id, params):
                     current_cookies = session.get('cookies', {})
             
             # 扫描场地
-            sessions = fetch_venue_data(current_token, date, cookies=current_cookies, username=username)
+            snapshot = fetch_venue_snapshot(
+                current_token, date, cookies=current_cookies, username=username,
+                priority=PRIORITY_SNIPE, max_age=SNAPSHOT_SHARE_AGE
+            )
             
             if is_stopped(task_id): break
             
-            # 查找空场（与 server.py 一致的匹配逻辑）
-            target = None
-            actual_price = 40
-            target_vid_str = str(vid) if vid else None
+            # 从同一快照中取出所有候选并按偏好排序，失败立即尝试下一个
+            candidates = rank_snipe_candidates(
+                snapshot, [start_time] + list(params.get('altStartTimes') or []),
+                vid, params.get('venuePreference'), end_time=end_time
+            )
+            booked = False
             
-            for s in sessions or []:
-                try:
-                    if s.get('startTime') != start_time:
-                        continue
-                    if end_time and s.get('endTime') and s.get('endTime') != end_time:
-                        continue
-                    if int(s.get('availNum', 0)) != 1:
-                        continue
-                    if target_vid_str and str(s.get('venueId')) != target_vid_str:
-                        continue
-                    
-                    target = s
-                    if 'price' in s:
-                        actual_price = s['price']
-                    break
-                except Exception:
-                    continue
-            
-            if target:
-                add_log(f"🎉 [Task {task_id}] 发现空闲: {target.get('venueName')}")
+            for target in candidates:
+                if is_stopped(task_id): break
+                actual_price = target.get('price', 40)
+                c_start = target.get('startTime')
+                c_end = target.get('endTime') or end_time
+                add_log(f"🎉 [Task {task_id}] 发现空闲: {target.get('venueName')} {c_start}")
                 
-                # 发送请求（与 server.py 完全一致）
-                ok, msg = send_booking_request(
-                    current_token, user_id, date, start_time, end_time,
-                    target['venueId'], actual_price, cookies=current_cookies
+                ok, msg, _ = send_booking_request(
+                    current_token, user_id, date, c_start, c_end,
+                    target['venueId'], actual_price, cookies=current_cookies,
+                    username=username, hedge=True
                 )
                 
-                if ok:
-                    add_log(f"✅ [Task {task_id}] 预定成功!")
-                    
-                    if is_lock_mode:
-                        # 转换为锁场模式
-                        lock_task.delay(task_id + "-L", {
-                            **params,
-                            'venueId': target['venueId'],
-                            'venueName': target.get('venueName'),
-                            'price': actual_price,
-                            'userId': user_id
-                        })
-                        add_log(f"🔒 [Task {task_id}] 已启动锁场保活")
-                    
-                    set_task_status(task_id, task_type, "已完成", info)
-                    break
+                if not ok:
+                    add_log(f"❌ [Task {task_id}] 预定失败: {msg}，尝试下一个候选")
+                    continue
+                
+                add_log(f"✅ [Task {task_id}] 预定成功!")
+                
+                if is_lock_mode:
+                    # 转换为锁场模式
+                    lock_task.delay(task_id + "-L", {
+                        **params,
+                        'startTime': c_start,
+                        'endTime': c_end,
+                        'venueId': target['venueId'],
+                        'venueName': target.get('venueName'),
+                        'price': actual_price,
+                        'userId': user_id
+                    })
+                    add_log(f"🔒 [Task {task_id}] 已启动锁场保活")
+                
+                set_task_status(task_id, task_type, "已完成", info)
+                booked = True
+                break
+            
+            if booked:
+                break
             
-            # 随机休眠（与 server.py 一致）
-            time.sleep(random.uniform(1.0, 3.0))
+            # 按预计释放时间自适应休眠，保留少量随机抖动
+            interval = UPSTREAM_BREAKERS["booking"].retry_delay(next_poll_interval(date, start_time, vid))
+            time.sleep(interval * random.uniform(0.8, 1.2))
 
     except Exception as e:
         add_log(f"❌ [Task {task_id}] 异常: {e}")
     
     add_log(f"⏹️ [Task {task_id}] 监控任务已停止")
-    redis_client.delete(f"task_stop:{task_id}")
     redis_client.delete(f"task_status:{task_id}")
     return "Done"
@@ -1,4 +1,6 @@
 import os, time, datetime, random, re, subprocess, threading, requests, json, base64, smtplib, sys, shutil, atexit
+import collections, http.cookiejar, socket, hashlib, tempfile, heapq, itertools, stat
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 try:
     from config import SMTP_SERVER, SMTP_PORT, SMTP_SENDER, SMTP_PASSWORD
 except ImportError:
@@ -9,38 +11,106 @@ except ImportError:
     SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "")
 from email.mime.text import MIMEText
 from email.header import Header
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
 import redis
 
+# Selenium 在首次启动浏览器时才导入（见 _load_selenium）：Celery / 月场等从不开浏览器的进程不承担导入开销
+webdriver = Service = Options = By = None
+
 # --- 配置 ---
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+# 学校接口地址；离线压测/回归时指向 mock_upstream.py 启动的本地模拟服务
+UPSTREAM_BASE = os.environ.get("SCUT_UPSTREAM_BASE", "https://venue.spe.scut.edu.cn").rstrip("/")
 redis_client = redis.from_url(REDIS_URL, decode_responses=True)
 MEMORY_LOGS = []  # 内存日志备用
 MEMORY_LOG_LOCK = threading.Lock()
 
+# 多 worker 模式（uvicorn --workers N）：共享状态全部放在 Redis，
+# 等待 2FA 的浏览器通过本机 RPC 访问，清理浏览器进程时不误杀其他 worker 的进程
+API_WORKERS = int(os.environ.get("API_WORKERS", 1))
+MULTI_WORKER = API_WORKERS > 1
+
+def ensure_private_dir(path):
+    """
+    创建/检查只有本用户可访问的目录（0700，属主为当前有效用户，不能是符号链接）
+    服务以 root 运行，放在共享目录下的 Socket、Profile、缓存必须先确认没有被其他用户预先创建或替换；
+    检查不通过时抛出 RuntimeError
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise RuntimeError(f"{path} 不是目录")
+    if st.st_uid != os.geteuid():
+        raise RuntimeError(f"{path} 属主不是当前用户 (uid={st.st_uid})")
+    if st.st_mode & 0o077:
+        raise RuntimeError(f"{path} 权限过宽 ({oct(st.st_mode & 0o777)})，应为 0700")
+    return path
+
 
 # 自动检测 chromedriver 路径
-def get_chromedriver_path():
+# 探测需要逐个执行 --version，结果连同二进制文件指纹（路径/大小/修改时间）缓存到本机文件，
+# 指纹不变时后续进程直接复用，升级 chromedriver 后自动重新探测；首次启动浏览器时才探测
+DRIVER_CANDIDATES = [
     # 优先使用重命名后的 chromedriver-new，防止被旧系统误杀
-    for p in ["/usr/bin/chromedriver-new", "/usr/local/bin/chromedriver-new", "chromedriver-new"]:
-        try:
-            if subprocess.run([p, "--version"], capture_output=True).returncode == 0:
-                return p
-        except: pass
-    
+    "/usr/bin/chromedriver-new", "/usr/local/bin/chromedriver-new", "chromedriver-new",
     # 备选回退
-    for p in ["/usr/bin/chromedriver", "/usr/local/bin/chromedriver", "chromedriver"]:
+    "/usr/bin/chromedriver", "/usr/local/bin/chromedriver", "chromedriver",
+    "/usr/lib/chromium-browser/chromedriver", "/snap/bin/chromium.chromedriver",
+]
+# 缓存里的路径会被以 root 身份执行：放在私有目录中，读取时只接受 DRIVER_CANDIDATES 里的路径
+DRIVER_CACHE_DIR = os.environ.get("SCUT_CACHE_DIR", "/var/cache/scut_order")
+DRIVER_CACHE_FILE = os.path.join(DRIVER_CACHE_DIR, "chromedriver.json")
+
+def _driver_fingerprint(path):
+    resolved = shutil.which(path)
+    if not resolved:
+        return None
+    st = os.stat(resolved)
+    return f"{os.path.realpath(resolved)}:{st.st_size}:{int(st.st_mtime)}"
+
+def get_chromedriver_path():
+    try:
+        cache_ok = bool(ensure_private_dir(DRIVER_CACHE_DIR))
+    except (RuntimeError, OSError) as e:
+        print(f"Chromedriver cache disabled: {e}")
+        cache_ok = False
+
+    if cache_ok:
+        try:
+            with open(DRIVER_CACHE_FILE) as f:
+                cached = json.load(f)
+            if (cached["path"] in DRIVER_CANDIDATES and cached.get("fingerprint")
+                    and _driver_fingerprint(cached["path"]) == cached["fingerprint"]):
+                return cached["path"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    for p in DRIVER_CANDIDATES:
         try:
-            if subprocess.run([p, "--version"], capture_output=True).returncode == 0:
+            r = subprocess.run([p, "--version"], capture_output=True, text=True, timeout=10)
+            if r.returncode == 0:
+                if cache_ok:
+                    try:
+                        with open(DRIVER_CACHE_FILE, "w") as f:
+                            json.dump({"path": p, "fingerprint": _driver_fingerprint(p), "version": r.stdout.strip()}, f)
+                    except OSError:
+                        pass
                 return p
-        except: pass
-    return "chromedriver"
+        except Exception: pass
+    return None
 
-DRIVER_PATH = get_chromedriver_path()
+def _load_selenium():
+    global webdriver, Service, Options, By
+    if webdriver is None:
+        from selenium import webdriver as _webdriver
+        from selenium.webdriver.chrome.service import Service as _Service
+        from selenium.webdriver.chrome.options import Options as _Options
+        from selenium.webdriver.common.by import By as _By
+        Service, Options, By = _Service, _Options, _By
+        webdriver = _webdriver
+
+DRIVER_PATH = None
 BROWSER_SEMAPHORE = threading.Semaphore(int(os.environ.get("BROWSER_LIMIT", 2)))
+BROWSER_ADMISSION_WAIT = 3  # 排队超过该秒数仍无名额时，尝试淘汰等待 2FA 的浏览器（见 evict_oldest_2fa_hold）
 ACTIVE_DRIVER_PIDS = set()
 PID_LOCK = threading.Lock()
 # 存储等待 2FA 的 driver: {username: {"driver": driver, "timestamp": time, "last_attempt": time}}
@@ -116,37 +186,121 @@ def get_all_sessions():
         add_log(f"⚠️ 批量读取 Session 失败: {e}")
     return sessions
 
-# === 订单缓存操作 (Redis Only) ===
+# === 订单索引 (Redis Sorted Set + Hash) ===
+# 结构：
+# - scut_order:orders:{username}:all          ZSET  rid -> createdAtMs（全部订单）
+# - scut_order:orders:{username}:status:{st}  ZSET  rid -> createdAtMs（按状态 1/2/3/4）
+# - scut_order:orders:{username}:rec:{orderNo} HASH  序号 -> 记录 JSON（一个订单可能包含多个时段）
+# - scut_order:orders:{username}:meta         HASH  updated_at
+# rid = "{orderNo}#{序号}"，分页直接 ZREVRANGE，无需解码整份缓存
+
+ORDER_STATUS_NAMES = {1: 'unpaid', 2: 'paid', 3: 'refund', 4: 'closed'}
+
+def _order_key(username, suffix):
+    return f"scut_order:orders:{username}:{suffix}"
+
+def _split_rid(rid):
+    order_no, _, idx = rid.rpartition("#")
+    return order_no, idx
 
-def save_order_cache(username, cache_data):
-    """保存订单缓存到 Redis"""
+def save_order_index(username, by_status):
+    """
+    用最新抓取的订单重建索引
+    by_status: {status_code: [record, ...]}
+    """
     try:
-        key = f"scut_order:cache:orders:{username}"
-        redis_client.set(key, json.dumps(cache_data, ensure_ascii=False), ex=CACHE_TTL)
+        old_rids = redis_client.zrange(_order_key(username, "all"), 0, -1)
+        old_orders = {_split_rid(rid)[0] for rid in old_rids}
+
+        pipe = redis_client.pipeline(transaction=True)
+        for order_no in old_orders:
+            pipe.delete(_order_key(username, f"rec:{order_no}"))
+        pipe.delete(_order_key(username, "all"))
+        for st in ORDER_STATUS_NAMES:
+            pipe.delete(_order_key(username, f"status:{st}"))
+
+        new_keys = [_order_key(username, "all"), _order_key(username, "meta")]
+        for st, records in by_status.items():
+            st = int(st)
+            status_key = _order_key(username, f"status:{st}")
+            new_keys.append(status_key)
+            for i, r in enumerate(records):
+                order_no = r.get("orderNo") or f"anon{st}-{i}"
+                rec_key = _order_key(username, f"rec:{order_no}")
+                # 同一订单的多个时段用序号区分
+                idx = f"{st}-{i}"
+                rid = f"{order_no}#{idx}"
+                score = int(r.get("createdAtMs") or 0)
+                pipe.hset(rec_key, idx, json.dumps({**r, "statusType": ORDER_STATUS_NAMES.get(st, 'unknown')}, ensure_ascii=False))
+                pipe.zadd(_order_key(username, "all"), {rid: score})
+                pipe.zadd(status_key, {rid: score})
+                new_keys.append(rec_key)
+
+        pipe.hset(_order_key(username, "meta"), "updated_at", time.time())
+        for key in set(new_keys):
+            pipe.expire(key, CACHE_TTL)
+        pipe.execute()
         return True
     except Exception as e:
-        add_log(f"⚠️ 订单缓存保存失败: {e}")
+        add_log(f"⚠️ 订单索引保存失败: {e}")
         return False
 
-def get_order_cache(username):
-    """从 Redis 获取订单缓存"""
+def get_order_index_updated_at(username):
+    """返回订单索引的更新时间，不存在时返回 None"""
     try:
-        key = f"scut_order:cache:orders:{username}"
-        data = redis_client.get(key)
-        if data:
-            return json.loads(data) if isinstance(data, str) else json.loads(data.decode('utf-8'))
-        return None
+        ts = redis_client.hget(_order_key(username, "meta"), "updated_at")
+        return float(ts) if ts else None
     except Exception as e:
-        add_log(f"⚠️ 订单缓存读取失败: {e}")
+        add_log(f"⚠️ 订单索引读取失败: {e}")
         return None
 
+def get_order_page(username, status=None, start=0, stop=-1):
+    """
+    按 createdAt 倒序读取订单索引的一段
+    status: 1/2/3/4，None 表示全部状态
+    返回: (records, total)
+    """
+    try:
+        zkey = _order_key(username, "all") if status is None else _order_key(username, f"status:{int(status)}")
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zcard(zkey)
+        pipe.zrevrange(zkey, start, stop)
+        total, rids = pipe.execute()
+        if not rids:
+            return [], total
+
+        pipe = redis_client.pipeline(transaction=False)
+        for rid in rids:
+            order_no, idx = _split_rid(rid)
+            pipe.hget(_order_key(username, f"rec:{order_no}"), idx)
+        records = [json.loads(raw) for raw in pipe.execute() if raw]
+        return records, total
+    except Exception as e:
+        add_log(f"⚠️ 订单索引读取失败: {e}")
+        return [], 0
+
+def clear_order_index(username):
+    """清除订单索引"""
+    try:
+        rids = redis_client.zrange(_order_key(username, "all"), 0, -1)
+        keys = {_order_key(username, f"rec:{_split_rid(rid)[0]}") for rid in rids}
+        keys.add(_order_key(username, "all"))
+        keys.add(_order_key(username, "meta"))
+        keys.update(_order_key(username, f"status:{st}") for st in ORDER_STATUS_NAMES)
+        redis_client.delete(*keys)
+    except:
+        pass
+
+# === 订单缓存操作 (旧版缓存已废弃，仅保留清理；请使用上面的订单索引) ===
+
 def clear_order_cache(username):
-    """清除订单缓存"""
+    """清除订单缓存（同时清除订单索引）"""
     try:
         key = f"scut_order:cache:orders:{username}"
         redis_client.delete(key)
     except:
         pass
+    clear_order_index(username)
 
 # === 场地缓存操作 (Redis Only) ===
 
@@ -172,28 +326,352 @@ def get_venue_cache(cache_key):
         add_log(f"⚠️ 场地缓存读取失败: {e}")
         return None
 
+# === 场地快照 (预建索引，供所有消费者共享) ===
+# 一次查询的结果只解析一次：状态、venueId 字符串化、各类索引都在构建时完成，
+# 捡漏/监控清单/场地页面等消费者直接查字典，不再逐条 str()/int() 线性扫描。
+# 场地空闲情况与用户无关，同一进程内的消费者可在 max_age 内复用最近一次快照。
+
+SNAPSHOT_SHARE_AGE = float(os.environ.get("SNAPSHOT_SHARE_AGE", 0.5))  # 捡漏复用快照的最长时间（秒）
+
+def natural_key(name):
+    return [int(t) if t.isdigit() else t for t in re.split('([0-9]+)', str(name or ''))]
+
+def session_status(s):
+    """场次状态：free / reserved（固定用途）/ sold"""
+    if s.get('fixedPurpose'):
+        return 'reserved'
+    try:
+        return 'free' if int(s.get('availNum', 0)) == 1 else 'sold'
+    except (TypeError, ValueError):
+        return 'sold'
+
+
+class VenueSnapshot:
+    """
+    某日场地数据的解析结果
+    - sessions:      原始场次的副本（附加 _vid / _status 字段；raw 中的上游字典保持不变，可能与其他快照共享）
+    - by_slot:       (startTime, endTime) -> [场次]
+    - by_start:      startTime -> [场次]
+    - by_venue:      venueId(str) -> [场次]
+    - by_status:     status -> [场次]
+    - free_by_start: startTime -> [空闲场次]
+    """
+    def __init__(self, date_str, raw_list, fetched_at=None):
+        self.date = date_str
+        self.fetched_at = fetched_at or time.time()
+        self.raw = raw_list
+        self.sessions = []
+        self.by_slot = {}
+        self.by_start = {}
+        self.by_venue = {}
+        self.by_status = {}
+        self.free_by_start = {}
+        for raw in raw_list or []:
+            s = dict(raw, _vid=str(raw.get('venueId')), _status=session_status(raw))
+            self.sessions.append(s)
+            self.by_slot.setdefault((s.get('startTime'), s.get('endTime')), []).append(s)
+            self.by_start.setdefault(s.get('startTime'), []).append(s)
+            self.by_venue.setdefault(s['_vid'], []).append(s)
+            self.by_status.setdefault(s['_status'], []).append(s)
+            if s['_status'] == 'free':
+                self.free_by_start.setdefault(s.get('startTime'), []).append(s)
+
+    @property
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def free(self, start_time, end_time=None, venue_id=None):
+        """某时段的空闲场次（字典查找）"""
+        if end_time:
+            found = [s for s in self.by_slot.get((start_time, end_time), []) if s['_status'] == 'free']
+        else:
+            found = self.free_by_start.get(start_time, [])
+        if venue_id:
+            vid = str(venue_id)
+            found = [s for s in found if s['_vid'] == vid]
+        return found
+
+    def free_start_times(self, start_from, start_to):
+        """时间段 [start_from, start_to] 内有空闲场次的开始时间"""
+        return sorted(t for t in self.free_by_start if t and start_from <= t <= start_to)
+
+
+_SNAPSHOT_CACHE = {}  # {date: VenueSnapshot}
+_SNAPSHOT_LOCK = threading.Lock()
+
+def publish_venue_snapshot(date_str, raw_list):
+    """由 fetch_venue_data 在每次成功查询后调用：建立索引、共享给其他消费者、记录状态变化"""
+    snapshot = VenueSnapshot(date_str, raw_list)
+    with _SNAPSHOT_LOCK:
+        _SNAPSHOT_CACHE[date_str] = snapshot
+    observe_venue_snapshot(snapshot)
+    return snapshot
+
+def get_cached_venue_snapshot(date_str, max_age):
+    with _SNAPSHOT_LOCK:
+        snapshot = _SNAPSHOT_CACHE.get(date_str)
+    if snapshot and snapshot.age <= max_age:
+        return snapshot
+    return None
+
+def fetch_venue_snapshot(token, date_str, cookies=None, username=None, user_agent=None, priority=None, max_age=0):
+    """
+    获取某日的场地快照：max_age 内已有其他消费者查询过则直接复用
+    返回 VenueSnapshot；失败返回 None；需要 2FA 救援时返回 fetch_venue_data 的特殊标记 dict
+    """
+    if max_age > 0:
+        snapshot = get_cached_venue_snapshot(date_str, max_age)
+        if snapshot:
+            return snapshot
+    kwargs = {"priority": priority} if priority else {}
+    started = time.time()
+    raw = fetch_venue_data(token, date_str, cookies, username=username, user_agent=user_agent, **kwargs)
+    if not isinstance(raw, list):
+        return raw
+    with _SNAPSHOT_LOCK:
+        snapshot = _SNAPSHOT_CACHE.get(date_str)
+    # 正常情况下 fetch_venue_data 已发布快照（并发时可能是另一个更新的快照，同样可用）
+    if snapshot is None or snapshot.fetched_at < started:
+        snapshot = VenueSnapshot(date_str, raw)
+    return snapshot
+
+# === 自适应轮询 (基于场地释放规律) ===
+# 未支付订单在下单 10 分钟后自动取消，场地会重新变为空闲。
+# 每次查询到场地数据时记录状态变化：
+# - scut_order:slot_state:{date}    HASH  "{startTime}|{venueId}" -> free/sold
+# - scut_order:slot_sold:{date}     HASH  "{startTime}|{venueId}" -> 变为已订的时间戳
+# - scut_order:slot_release_hours   HASH  小时 -> 观察到的释放次数（用于学习高峰时段）
+# 捡漏任务据此在预计释放时间附近密集轮询，其余时间退避。
+
+SLOT_RELEASE_DELAY = 600   # 下单后 10 分钟未支付自动取消
+RELEASE_LEAD = 15          # 预计释放前 15 秒开始密集轮询
+RELEASE_TAIL = 45          # 预计释放后继续密集轮询 45 秒
+POLL_FAST = 0.5            # 释放窗口内的轮询间隔
+POLL_NORMAL = 1.5          # 高峰时段的轮询间隔（与原固定间隔一致）
+POLL_IDLE = 6.0            # 非高峰时段的轮询间隔
+SLOT_STATE_TTL = 2 * 86400
+
+_HOT_HOURS_CACHE = {"hours": None, "expire": 0}
+_HOT_HOURS_LOCK = threading.Lock()
+
+def _slot_field(start_time, venue_id):
+    return f"{start_time}|{venue_id}"
+
+def observe_venue_snapshot(snapshot):
+    """记录一次场地快照中的状态变化（free→sold 记录时间，sold→free 计入释放统计）"""
+    if not snapshot.sessions:
+        return
+    try:
+        state_key = f"scut_order:slot_state:{snapshot.date}"
+        prev = redis_client.hgetall(state_key)
+        now = time.time()
+        changed, sold_at, released = {}, {}, 0
+        for s in snapshot.sessions:
+            field = _slot_field(s.get('startTime'), s['_vid'])
+            status = 'free' if s['_status'] == 'free' else 'sold'
+            old = prev.get(field)
+            if old == status:
+                continue
+            changed[field] = status
+            if old == 'free' and status == 'sold':
+                sold_at[field] = now
+            elif old == 'sold' and status == 'free':
+                released += 1
+        if not changed:
+            return
+
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(state_key, mapping=changed)
+        pipe.expire(state_key, SLOT_STATE_TTL)
+        if sold_at:
+            sold_key = f"scut_order:slot_sold:{snapshot.date}"
+            pipe.hset(sold_key, mapping=sold_at)
+            pipe.expire(sold_key, SLOT_STATE_TTL)
+        if released:
+            pipe.hincrby("scut_order:slot_release_hours", datetime.datetime.now().hour, released)
+        pipe.execute()
+    except Exception:
+        pass  # 统计失败不影响查询
+
+def _is_hot_hour():
+    """当前小时是否为释放高峰（释放次数不低于平均值）；无历史数据时视为高峰"""
+    now = time.time()
+    with _HOT_HOURS_LOCK:
+        if _HOT_HOURS_CACHE["expire"] < now:
+            hours = None
+            try:
+                raw = redis_client.hgetall("scut_order:slot_release_hours")
+                if raw:
+                    counts = {int(h): int(c) for h, c in raw.items()}
+                    mean = sum(counts.values()) / 24
+                    hours = {h for h, c in counts.items() if c >= mean}
+            except Exception:
+                pass
+            _HOT_HOURS_CACHE["hours"] = hours
+            _HOT_HOURS_CACHE["expire"] = now + 600
+        hours = _HOT_HOURS_CACHE["hours"]
+    return hours is None or datetime.datetime.now().hour in hours
+
+def next_poll_interval(date_str, start_time, venue_id=None):
+    """
+    根据预计释放时间计算下一次轮询的间隔（秒）
+    - 处于某个场地的预计释放窗口内：POLL_FAST
+    - 下一个释放窗口快到了：等到窗口开始
+    - 否则按是否高峰时段取 POLL_NORMAL / POLL_IDLE
+    start_time / venue_id 均可传入单个值或集合（监控清单一次关注多个场次）
+    """
+    start_times = {start_time} if isinstance(start_time, str) else set(start_time)
+    if not venue_id:
+        venue_ids = None
+    elif isinstance(venue_id, (list, tuple, set)):
+        venue_ids = {str(v) for v in venue_id}
+    else:
+        venue_ids = {str(venue_id)}
+    base = POLL_NORMAL if _is_hot_hour() else POLL_IDLE
+    try:
+        sold = redis_client.hgetall(f"scut_order:slot_sold:{date_str}")
+    except Exception:
+        return POLL_NORMAL
+
+    now = time.time()
+    nearest = None
+    for field, ts in sold.items():
+        st, _, vid = field.partition("|")
+        if st not in start_times:
+            continue
+        if venue_ids and vid not in venue_ids:
+            continue
+        eta = float(ts) + SLOT_RELEASE_DELAY - now
+        if -RELEASE_TAIL <= eta <= RELEASE_LEAD:
+            return POLL_FAST
+        if eta > RELEASE_LEAD and (nearest is None or eta < nearest):
+            nearest = eta
+
+    if nearest is not None:
+        return max(POLL_FAST, min(base, nearest - RELEASE_LEAD))
+    return base
+
+# === 捡漏候选排序 ===
+
+def rank_snipe_candidates(snapshot, start_times, target_venue_id=None, venue_preference=None, end_time=None):
+    """
+    从同一次场地快照中挑出所有可预定的场次，按用户偏好排序
+    - snapshot: VenueSnapshot（传入原始列表时会先构建快照）
+    - start_times: 按偏好排列的开始时间（第一个为首选）
+    - target_venue_id: 只要指定场地
+    - venue_preference: 按偏好排列的场地 ID，未列出的按场地名排在后面
+    - end_time: 首选时间的结束时间（与原逻辑一致，仅约束首选时间）
+    预定失败时调用方直接尝试下一个候选，不必等待下一轮查询
+    """
+    if not isinstance(snapshot, VenueSnapshot):
+        snapshot = VenueSnapshot(None, snapshot if isinstance(snapshot, list) else [])
+    venue_rank = {str(v): i for i, v in enumerate(venue_preference or [])}
+
+    candidates = []
+    for i, st in enumerate(start_times):
+        found = snapshot.free(st, end_time if i == 0 else None, target_venue_id)
+        candidates.extend(sorted(found, key=lambda s: (
+            venue_rank.get(s['_vid'], len(venue_rank)),
+            natural_key(s.get('venueName'))
+        )))
+    return candidates
+
 # === 2FA Driver 管理 ===
+# 每个等待验证码的用户占用一个完整的 Chrome：数量有上限，按到期时间放入最小堆，
+# 清理线程睡到最早的到期时间再精确关闭；满额时按 TWO_FA_EVICTION 策略淘汰最早的或拒绝新的
+# 等待中的 driver 一直占用 BROWSER_SEMAPHORE 名额：新浏览器拿不到名额时也会按同一策略淘汰最早的空闲 hold
+# 注意：上限按进程计算。多 worker 且未启用浏览器服务时，全机最多 API_WORKERS × TWO_FA_MAX_HOLDS 个
+TWO_FA_HOLD_TTL = int(os.environ.get("TWO_FA_HOLD_TTL", 600))          # 10 分钟未输入验证码即关闭
+TWO_FA_MAX_HOLDS = int(os.environ.get("TWO_FA_MAX_HOLDS", 4))          # 同时等待验证码的浏览器上限
+TWO_FA_HOLD_MAX_MB = int(os.environ.get("TWO_FA_HOLD_MAX_MB", 1200))   # 等待中的浏览器内存合计上限
+TWO_FA_EVICTION = os.environ.get("TWO_FA_EVICTION", "oldest")          # oldest: 淘汰最早的; reject: 拒绝新的
+TWO_FA_IN_USE_GRACE = 30  # 到期时正在提交验证码的 driver 顺延的秒数
+_HOLD_DEADLINES = []  # 最小堆 (到期时间, 序号, username)，被替换/移除的条目在弹出时跳过
+_HOLD_SEQ = itertools.count()
+_HOLD_COND = threading.Condition(DRIVER_MAP_LOCK)
+_HOLD_STATS = {"expired": 0, "evicted": 0, "rejected": 0}
+
+def _hold_rss_mb(data):
+    """该等待浏览器最近一次治理巡检统计的内存"""
+    pid = getattr(data.get("driver"), "_pid", None) if isinstance(data, dict) else None
+    return _GOVERNOR_STATS["drivers"].get(pid, 0)
 
 def save_pending_driver(username, driver):
-    """保存等待 2FA 的 driver，并关闭旧的"""
-    with DRIVER_MAP_LOCK:
+    """保存等待 2FA 的 driver，并关闭旧的；名额已满且策略为 reject 时关闭新 driver 并返回 False"""
+    to_close = []
+    with _HOLD_COND:
         # 关闭旧的 driver（如果存在）
         if username in PENDING_DRIVERS:
-            old_data = PENDING_DRIVERS[username]
             add_log(f"⚠️ [{username}] 检测到旧的 2FA driver，先关闭")
-            try:
-                old_driver = old_data.get('driver') if isinstance(old_data, dict) else old_data
-                close_driver(old_driver)
-            except Exception as e:
-                add_log(f"⚠️ 关闭旧 driver 失败: {e}")
+            to_close.append(PENDING_DRIVERS.pop(username))
         
-        # 保存新的 driver
-        PENDING_DRIVERS[username] = {
-            "driver": driver,
-            "timestamp": time.time(),
-            "last_attempt": time.time()
-        }
-        add_log(f"🔐 [{username}] 2FA driver 已保存，将在 10 分钟后自动清理")
+        # 名额/内存检查；正在提交验证码的 driver 不能淘汰
+        while PENDING_DRIVERS and (len(PENDING_DRIVERS) >= TWO_FA_MAX_HOLDS or
+                                   sum(_hold_rss_mb(d) for d in PENDING_DRIVERS.values()) >= TWO_FA_HOLD_MAX_MB):
+            idle = [u for u, d in PENDING_DRIVERS.items() if not d.get("in_use")]
+            if TWO_FA_EVICTION == "reject" or not idle:
+                _HOLD_STATS["rejected"] += 1
+                add_log(f"🚫 [{username}] 等待验证码的浏览器已满 ({len(PENDING_DRIVERS)}/{TWO_FA_MAX_HOLDS})，拒绝新的 2FA 会话")
+                to_close.append({"driver": driver})
+                driver = None
+                break
+            oldest = min(idle, key=lambda u: PENDING_DRIVERS[u].get("deadline", 0))
+            _HOLD_STATS["evicted"] += 1
+            add_log(f"♻️ [{oldest}] 等待验证码的浏览器已满，释放最早的 2FA 会话给 [{username}]")
+            to_close.append(PENDING_DRIVERS.pop(oldest))
+            _clear_2fa_owner(oldest)
+        
+        if driver is not None:
+            # 保存新的 driver
+            now = time.time()
+            deadline = now + TWO_FA_HOLD_TTL
+            PENDING_DRIVERS[username] = {
+                "driver": driver,
+                "timestamp": now,
+                "last_attempt": now,
+                "deadline": deadline
+            }
+            heapq.heappush(_HOLD_DEADLINES, (deadline, next(_HOLD_SEQ), username))
+            _HOLD_COND.notify()
+            _set_2fa_owner(username)
+            add_log(f"🔐 [{username}] 2FA driver 已保存，将在 {TWO_FA_HOLD_TTL // 60} 分钟后自动清理")
+    
+    # 关闭浏览器较慢，放在锁外
+    for data in to_close:
+        try:
+            close_driver(data.get('driver') if isinstance(data, dict) else data)
+        except Exception as e:
+            add_log(f"⚠️ 关闭旧 driver 失败: {e}")
+    return driver is not None
+
+def evict_oldest_2fa_hold(reason):
+    """释放最早到期的空闲 hold（正在提交验证码的不动）；TWO_FA_EVICTION=reject 时不淘汰。返回是否释放"""
+    if TWO_FA_EVICTION == "reject":
+        return False
+    with _HOLD_COND:
+        idle = [u for u, d in PENDING_DRIVERS.items() if isinstance(d, dict) and not d.get("in_use")]
+        if not idle:
+            return False
+        oldest = min(idle, key=lambda u: PENDING_DRIVERS[u].get("deadline", 0))
+        data = PENDING_DRIVERS.pop(oldest)
+        _HOLD_STATS["evicted"] += 1
+    add_log(f"♻️ [{oldest}] {reason}，释放最早的 2FA 会话")
+    _clear_2fa_owner(oldest)
+    try:
+        close_driver(data.get("driver"))
+    except Exception as e:
+        add_log(f"⚠️ 关闭旧 driver 失败: {e}")
+    return True
+
+def get_2fa_hold_stats():
+    """等待验证码的浏览器：数量、剩余时间、内存及淘汰计数"""
+    now = time.time()
+    with DRIVER_MAP_LOCK:
+        holds = [{"username": u, "remaining": round(d.get("deadline", now) - now), "rss_mb": _hold_rss_mb(d)}
+                 for u, d in PENDING_DRIVERS.items()]
+    return {"holds": holds, "count": len(holds), "max_holds": TWO_FA_MAX_HOLDS,
+            "rss_mb": round(sum(h["rss_mb"] for h in holds), 1), "max_rss_mb": TWO_FA_HOLD_MAX_MB,
+            **_HOLD_STATS}
 
 def get_pending_driver(username):
     """获取等待 2FA 的 driver"""
@@ -203,46 +681,114 @@ def get_pending_driver(username):
             return data.get('driver') if isinstance(data, dict) else data
         return None
 
+def checkout_pending_driver(username):
+    """取出 driver 供 complete_2fa 使用并标记为占用；不存在或已被占用时返回 None"""
+    with DRIVER_MAP_LOCK:
+        data = PENDING_DRIVERS.get(username)
+        if not isinstance(data, dict) or data.get("in_use"):
+            return None
+        data["in_use"] = True
+        return data.get("driver")
+
+def checkin_pending_driver(username, driver):
+    """complete_2fa 结束：driver 仍在等待列表中（验证失败可重试）时解除占用"""
+    with DRIVER_MAP_LOCK:
+        data = PENDING_DRIVERS.get(username)
+        if isinstance(data, dict) and data.get("driver") is driver:
+            data["in_use"] = False
+
 def remove_pending_driver(username):
     """移除等待 2FA 的 driver"""
     with DRIVER_MAP_LOCK:
-        return PENDING_DRIVERS.pop(username, None)
+        data = PENDING_DRIVERS.pop(username, None)
+    if data:
+        _clear_2fa_owner(username)
+    return data
+
+def discard_pending_driver(username):
+    """关闭并移除本进程中该用户等待 2FA 的 driver（本机 RPC 也会调用）"""
+    driver = get_pending_driver(username)
+    if driver:
+        close_driver(driver)
+        remove_pending_driver(username)
+    return bool(driver)
+
+# 等待 2FA 的 driver 只存在于创建它的进程中，Redis 里记录其所在节点，
+# 其他 worker 收到验证码时通过本机 RPC 转交（见 call_local_rpc）
+_2FA_OWNER_TTL = TWO_FA_HOLD_TTL + 300  # 记录必须比 driver 晚过期，否则其他 worker 找不到仍在等待的 driver
+
+def _set_2fa_owner(username):
+    try:
+        redis_client.set(f"scut_order:2fa_owner:{username}", json.dumps({
+            "node": ENGINE_NODE_ID,
+            "host": socket.gethostname(),
+            "last_attempt": time.time()
+        }), ex=_2FA_OWNER_TTL)
+    except Exception as e:
+        print(f"2FA owner save error: {e}")
+
+def _clear_2fa_owner(username):
+    """只删除本节点登记的记录（其他节点可能已为该用户创建了新的 driver）"""
+    try:
+        owner = get_2fa_owner(username)
+        if owner and owner.get("node") == ENGINE_NODE_ID:
+            redis_client.delete(f"scut_order:2fa_owner:{username}")
+    except Exception:
+        pass
+
+def get_2fa_owner(username):
+    """等待 2FA 的 driver 所在节点 {node, host, last_attempt}"""
+    try:
+        raw = redis_client.get(f"scut_order:2fa_owner:{username}")
+        return json.loads(raw) if raw else None
+    except Exception:
+        return None
 
 def should_retry_2fa(username):
     """检查是否应该重试 2FA（每小时一次）"""
     with DRIVER_MAP_LOCK:
-        if username not in PENDING_DRIVERS:
-            return True  # 没有记录，可以尝试
-        
-        data = PENDING_DRIVERS[username]
+        data = PENDING_DRIVERS.get(username)
+    if data is not None:
         last_attempt = data.get('last_attempt', 0)
-        # 距离上次尝试超过 1 小时
-        return (time.time() - last_attempt) > 3600
+    else:
+        # 可能在其他 worker 中等待验证码
+        owner = get_2fa_owner(username)
+        if not owner:
+            return True  # 没有记录，可以尝试
+        last_attempt = owner.get('last_attempt', 0)
+    # 距离上次尝试超过 1 小时
+    return (time.time() - last_attempt) > 3600
 
 def _cleanup_expired_drivers():
-    """后台线程：定期清理超时的 2FA driver"""
+    """后台线程：睡到最早的到期时间，精确关闭超时的 2FA driver"""
     while True:
-        time.sleep(300)  # 每 5 分钟检查一次
-        now = time.time()
         expired = []
+        with _HOLD_COND:
+            now = time.time()
+            while _HOLD_DEADLINES and _HOLD_DEADLINES[0][0] <= now:
+                deadline, _, username = heapq.heappop(_HOLD_DEADLINES)
+                data = PENDING_DRIVERS.get(username)
+                # 已被取走或替换的条目直接丢弃
+                if not (isinstance(data, dict) and data.get("deadline") == deadline):
+                    continue
+                if data.get("in_use"):
+                    # 正在提交验证码：推迟到提交结束后再检查
+                    data["deadline"] = now + TWO_FA_IN_USE_GRACE
+                    heapq.heappush(_HOLD_DEADLINES, (data["deadline"], next(_HOLD_SEQ), username))
+                    continue
+                expired.append((username, PENDING_DRIVERS.pop(username)))
+            if not expired:
+                _HOLD_COND.wait(_HOLD_DEADLINES[0][0] - now if _HOLD_DEADLINES else None)
+                continue
         
-        with DRIVER_MAP_LOCK:
-            for username, data in list(PENDING_DRIVERS.items()):
-                timestamp = data.get('timestamp', 0) if isinstance(data, dict) else 0
-                # 超过 10 分钟未处理
-                if now - timestamp > 600:
-                    expired.append(username)
-        
-        for username in expired:
-            add_log(f"⏱️ [Cleanup] {username} 的 2FA driver 已超时 (10分钟)，强制关闭")
-            with DRIVER_MAP_LOCK:
-                data = PENDING_DRIVERS.pop(username, None)
-                if data:
-                    try:
-                        driver = data.get('driver') if isinstance(data, dict) else data
-                        close_driver(driver)
-                    except Exception as e:
-                        add_log(f"⚠️ 清理 driver 失败: {e}")
+        for username, data in expired:
+            _HOLD_STATS["expired"] += 1
+            add_log(f"⏱️ [Cleanup] {username} 的 2FA driver 已超时 ({TWO_FA_HOLD_TTL // 60}分钟)，强制关闭")
+            _clear_2fa_owner(username)
+            try:
+                close_driver(data.get('driver'))
+            except Exception as e:
+                add_log(f"⚠️ 清理 driver 失败: {e}")
 
 
 # === 兼容性保留 (已废弃，仅供过渡) ===
@@ -286,6 +832,7 @@ def save_task_to_redis(task_id, task_data):
             "status": task_data.get("status"),
             "info": task_data.get("info"),
             "username": task_data.get("username"),
+            "node": task_data.get("node"),
             # 保存创建参数以便可能的恢复
             "params": task_data.get("params", {}) 
         }
@@ -297,8 +844,285 @@ def remove_task_from_redis(task_id):
     """从 Redis 移除任务"""
     try:
         redis_client.hdel("scut_order:tasks", task_id)
+        redis_client.hdel(TASK_STATE_KEY, task_id)
+    except: pass
+
+# --- 任务检查点 (重启恢复) ---
+# 锁场/捡漏任务在每次状态变化时把运行状态写入 scut_order:task_state，
+# 服务重启后按检查点在原定的下一个时间点继续（而不是全部标记为已停止）
+TASK_STATE_KEY = "scut_order:task_state"
+
+def save_task_checkpoint(task_id, state):
+    """保存任务运行状态（phase、last_success_time、renew_count、凭证时间戳、目标场次等）"""
+    try:
+        state = dict(state, checkpoint_at=time.time())
+        redis_client.hset(TASK_STATE_KEY, task_id, json.dumps(state))
+    except Exception as e:
+        print(f"Redis Task Checkpoint Error: {e}")
+
+def load_task_checkpoints():
+    """加载所有任务检查点 {task_id: state}"""
+    try:
+        return {k: json.loads(v) for k, v in redis_client.hgetall(TASK_STATE_KEY).items()}
+    except: return {}
+
+def get_task_checkpoint(task_id):
+    try:
+        raw = redis_client.hget(TASK_STATE_KEY, task_id)
+        return json.loads(raw) if raw else None
+    except: return None
+
+def sync_task_status(task_id, task_data):
+    """任务仍存在时更新其状态（已被其他节点停止删除的任务不会被写回）"""
+    try:
+        serializable = {
+            "type": task_data.get("type"),
+            "status": task_data.get("status"),
+            "info": task_data.get("info"),
+            "username": task_data.get("username"),
+            "node": task_data.get("node"),
+            "params": task_data.get("params", {})
+        }
+        _hset_if_exists_script(keys=["scut_order:tasks"], args=[task_id, json.dumps(serializable)])
+    except Exception as e:
+        print(f"Redis Task Sync Error: {e}")
+
+# --- 任务租约 (多节点分片) ---
+# 每个运行中的任务由一个引擎节点持有租约 scut_order:lease:{task_id}（值为节点 ID，带 TTL）。
+# 节点每 LEASE_HEARTBEAT 秒续约并在 scut_order:nodes 中登记心跳；
+# 节点宕机后租约过期，存活节点按一致性哈希（HRW）认领孤儿任务，未认领的下一轮由任意节点接管。
+# ENGINE_NODE_ID 固定时，节点重启后可立即收回自己的租约。
+# 多 worker 模式下同一台机器上的每个 worker 进程都是一个独立节点（追加进程号）。
+ENGINE_NODE_ID = os.environ.get("ENGINE_NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+if MULTI_WORKER and os.environ.get("ENGINE_NODE_ID"):
+    ENGINE_NODE_ID = f"{ENGINE_NODE_ID}-{os.getpid()}"
+LEASE_TTL = int(os.environ.get("TASK_LEASE_TTL", 30))
+LEASE_HEARTBEAT = 10
+NODES_KEY = "scut_order:nodes"
+ENGINE_STOP_CHANNEL = "scut_order:engine_task_stop"
+
+_HSET_IF_EXISTS_LUA = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+_LEASE_ACQUIRE_LUA = """
+local owner = redis.call('GET', KEYS[1])
+if (not owner) or owner == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', tonumber(ARGV[2]))
+    return 1
+end
+return 0
+"""
+
+_LEASE_RENEW_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+    return 1
+end
+return 0
+"""
+
+_LEASE_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_hset_if_exists_script = redis_client.register_script(_HSET_IF_EXISTS_LUA)
+_lease_acquire_script = redis_client.register_script(_LEASE_ACQUIRE_LUA)
+_lease_renew_script = redis_client.register_script(_LEASE_RENEW_LUA)
+_lease_release_script = redis_client.register_script(_LEASE_RELEASE_LUA)
+
+def _lease_key(task_id):
+    return f"scut_order:lease:{task_id}"
+
+# task_id -> 最近一次成功获取/续约的时间，Redis 不可用时据此判断租约是否可能已过期
+_LEASE_CONFIRMED_AT = {}
+
+def acquire_task_lease(task_id, ttl=None):
+    """获取任务租约（无人持有或本节点已持有时成功）"""
+    try:
+        ok = bool(_lease_acquire_script(keys=[_lease_key(task_id)], args=[ENGINE_NODE_ID, ttl or LEASE_TTL]))
+    except Exception as e:
+        print(f"Lease acquire error: {e}")
+        return False
+    if ok:
+        _LEASE_CONFIRMED_AT[task_id] = time.time()
+    return ok
+
+def renew_task_lease(task_id, ttl=None):
+    """续约；返回 False 表示租约已被其他节点接管，或已超过 TTL 没能续约成功"""
+    try:
+        ok = bool(_lease_renew_script(keys=[_lease_key(task_id)], args=[ENGINE_NODE_ID, ttl or LEASE_TTL]))
+    except Exception as e:
+        # Redis 暂时不可用时无法判断归属：上次续约后的 TTL 内保持运行，
+        # 超过 TTL 则租约可能已过期并被其他节点接管，必须停止，避免双节点同时运行
+        print(f"Lease renew error: {e}")
+        return time.time() - _LEASE_CONFIRMED_AT.get(task_id, 0) < (ttl or LEASE_TTL)
+    if ok:
+        _LEASE_CONFIRMED_AT[task_id] = time.time()
+    else:
+        _LEASE_CONFIRMED_AT.pop(task_id, None)
+    return ok
+
+def release_task_lease(task_id):
+    _LEASE_CONFIRMED_AT.pop(task_id, None)
+    try:
+        _lease_release_script(keys=[_lease_key(task_id)], args=[ENGINE_NODE_ID])
     except: pass
 
+def get_task_lease_owner(task_id):
+    try:
+        return redis_client.get(_lease_key(task_id))
+    except: return None
+
+def node_heartbeat():
+    """登记本节点心跳，返回存活节点列表（顺带清理长时间无心跳的节点）"""
+    now = time.time()
+    try:
+        redis_client.hset(NODES_KEY, ENGINE_NODE_ID, now)
+        nodes = redis_client.hgetall(NODES_KEY)
+    except Exception as e:
+        print(f"Node heartbeat error: {e}")
+        return [ENGINE_NODE_ID]
+    alive = []
+    for node, ts in nodes.items():
+        age = now - float(ts)
+        if age <= LEASE_TTL:
+            alive.append(node)
+        elif age > 10 * LEASE_TTL:
+            try: redis_client.hdel(NODES_KEY, node)
+            except: pass
+    return alive or [ENGINE_NODE_ID]
+
+def preferred_node(task_id, nodes):
+    """一致性哈希（最高随机权重）：节点增减时只有少量任务改变归属"""
+    return max(nodes, key=lambda n: hashlib.md5(f"{n}:{task_id}".encode()).hexdigest())
+
+# --- 浏览器服务 (browser_farm.py) ---
+# BROWSER_FARM=true 时本进程不启动 Chrome：登录、2FA 等待、Token 嗅探都通过本机 RPC
+# 交给独立的 browser_farm 进程（节点 ID 固定为 BROWSER_FARM_NODE），API / Celery / 任务引擎共用
+BROWSER_FARM_NODE = "browser-farm"
+BROWSER_FARM_ENABLED = os.environ.get("BROWSER_FARM", "false").lower() == "true"
+IS_BROWSER_FARM = os.environ.get("SCUT_ROLE") == "browser_farm"
+
+def use_browser_farm():
+    return BROWSER_FARM_ENABLED and not IS_BROWSER_FARM
+
+def call_browser_farm(method, *args, timeout=None):
+    """调用 browser_farm；不可达时按登录失败处理"""
+    try:
+        return call_local_rpc(BROWSER_FARM_NODE, method, *args, timeout=timeout or LOGIN_LOCK_TTL)
+    except RuntimeError as e:
+        add_log(f"❌ 浏览器服务调用失败 ({method}): {e}")
+        return "error", f"浏览器服务不可用: {e}"
+
+def publish_task_stop(task_id):
+    """通知持有该任务的节点停止它"""
+    try:
+        redis_client.publish(ENGINE_STOP_CHANNEL, task_id)
+    except Exception as e:
+        print(f"Publish task stop error: {e}")
+
+# --- 本机进程间 RPC (Unix Socket) ---
+# 多 worker 模式下，只能由持有对象的进程操作的资源（如等待 2FA 的浏览器）
+# 通过 multiprocessing.connection 在本机 Unix Socket 上调用：每个节点监听 {LOCAL_RPC_DIR}/{节点ID}.sock
+# multiprocessing.connection 会反序列化 (pickle) 收到的数据，而服务以 root 运行：
+# - LOCAL_RPC_AUTHKEY 必须是随机生成的密钥（至少 32 个字符），未设置时不启用 RPC
+# - Socket 目录必须是属主为本用户、权限 0700 的私有目录（见 ensure_private_dir）
+LOCAL_RPC_DIR = os.environ.get("LOCAL_RPC_DIR", "/run/scut_order_rpc")
+LOCAL_RPC_AUTHKEY = os.environ.get("LOCAL_RPC_AUTHKEY", "").encode()
+LOCAL_RPC_MIN_KEY_LEN = 32
+_LOCAL_RPC_HANDLERS = {}
+_local_rpc_thread = None
+
+def local_rpc_address(node=None):
+    return os.path.join(LOCAL_RPC_DIR, f"{node or ENGINE_NODE_ID}.sock")
+
+def _local_rpc_authkey():
+    if len(LOCAL_RPC_AUTHKEY) < LOCAL_RPC_MIN_KEY_LEN:
+        raise RuntimeError(f"LOCAL_RPC_AUTHKEY 未设置或少于 {LOCAL_RPC_MIN_KEY_LEN} 个字符")
+    return LOCAL_RPC_AUTHKEY
+
+def register_local_rpc(name, fn):
+    _LOCAL_RPC_HANDLERS[name] = fn
+
+def _serve_local_rpc_conn(conn):
+    try:
+        method, args, kwargs = conn.recv()
+        fn = _LOCAL_RPC_HANDLERS.get(method)
+        if fn is None:
+            conn.send(("error", f"未知 RPC 方法: {method}"))
+        else:
+            try:
+                conn.send(("ok", fn(*args, **kwargs)))
+            except Exception as e:
+                conn.send(("error", str(e)))
+    except Exception as e:
+        print(f"Local RPC error: {e}")
+    finally:
+        try: conn.close()
+        except: pass
+
+def _local_rpc_server():
+    from multiprocessing.connection import Listener
+    try:
+        authkey = _local_rpc_authkey()
+        ensure_private_dir(LOCAL_RPC_DIR)
+    except (RuntimeError, OSError) as e:
+        add_log(f"⚠️ 本机 RPC 未启动: {e}")
+        return
+    address = local_rpc_address()
+    if os.path.lexists(address):
+        os.remove(address)
+    with Listener(address, family="AF_UNIX", authkey=authkey) as listener:
+        os.chmod(address, 0o600)
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"Local RPC accept error: {e}")
+                continue
+            threading.Thread(target=_serve_local_rpc_conn, args=(conn,), daemon=True).start()
+
+def start_local_rpc_server():
+    """启动本机 RPC 服务（幂等；Windows 不支持 Unix Socket，跳过）"""
+    global _local_rpc_thread
+    if sys.platform == "win32":
+        return
+    if _local_rpc_thread is None or not _local_rpc_thread.is_alive():
+        _local_rpc_thread = threading.Thread(target=_local_rpc_server, daemon=True, name="LocalRPC")
+        _local_rpc_thread.start()
+        atexit.register(lambda: os.path.exists(local_rpc_address()) and os.remove(local_rpc_address()))
+
+def call_local_rpc(node, method, *args, timeout=60, **kwargs):
+    """调用本机另一个节点上注册的方法；失败抛出 RuntimeError"""
+    from multiprocessing.connection import Client
+    try:
+        authkey = _local_rpc_authkey()
+        ensure_private_dir(LOCAL_RPC_DIR)
+    except OSError as e:
+        raise RuntimeError(f"RPC 目录不可用: {e}")
+    try:
+        conn = Client(local_rpc_address(node), family="AF_UNIX", authkey=authkey)
+    except (OSError, EOFError) as e:
+        raise RuntimeError(f"节点 {node} 不可达: {e}")
+    try:
+        conn.send((method, args, kwargs))
+        if not conn.poll(timeout):
+            raise RuntimeError(f"RPC {method} 超时")
+        status, result = conn.recv()
+    finally:
+        conn.close()
+    if status != "ok":
+        raise RuntimeError(result)
+    return result
+
 def load_all_tasks_from_redis():
     """从 Redis 加载所有任务 (纯数据，不含线程)"""
     try:
@@ -429,26 +1253,220 @@ def send_lock_failed_email(receiver, account_name, venue_name, fail_reason="未
     except Exception as e:
         add_log(f"❌ 邮件发送失败: {e}")
 
+# ================= Chrome 进程/内存治理 (/proc) =================
+# 直接读取 /proc：按 ACTIVE_DRIVER_PIDS 统计每个 driver 进程树的内存，超出预算的强制结束；
+# 只清理能确认属于本系统的进程（本进程的子进程、或带本系统 user-data-dir 的孤儿），不误杀其他 Chrome
+CHROME_DRIVER_MAX_MB = int(os.environ.get("CHROME_DRIVER_MAX_MB", 800))    # 单个 driver 进程树
+CHROME_TOTAL_MAX_MB = int(os.environ.get("CHROME_TOTAL_MAX_MB", 2500))     # 本进程全部浏览器
+CHROME_GOVERNOR_INTERVAL = int(os.environ.get("CHROME_GOVERNOR_INTERVAL", 30))
+TEMP_DIR_REAP_AGE = 600  # 启动时只清理 10 分钟前创建的 chrome_* 临时目录，避免误删其他 worker 正在用的
+_PAGE_KB = (os.sysconf("SC_PAGE_SIZE") // 1024) if hasattr(os, "sysconf") else 4
+_CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+ORPHAN_MIN_AGE = 60  # 刚启动、尚未登记到 ACTIVE_DRIVER_PIDS 的 chromedriver 不算孤儿
+_KILLED_DRIVER_PIDS = set()  # 被治理器结束的 driver，登录流程据此提前退出
+_GOVERNOR_STATS = {"last_sweep": 0, "drivers": {}, "total_mb": 0, "killed_orphans": 0,
+                   "killed_over_budget": 0, "evicted_2fa": 0, "reaped_dirs": 0}
+_GOVERNOR_LOCK = threading.Lock()
+
+def _read_proc_table():
+    """扫描一次 /proc：pid -> {ppid, name, rss_mb, age}"""
+    table = {}
+    try:
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError):
+        uptime = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                data = f.read()
+            # 第 2 个字段（进程名）可能含空格，从右括号之后解析
+            fields = data.rsplit(")", 1)[1].split()
+            table[int(entry)] = {
+                "ppid": int(fields[1]),
+                "name": data[data.index("(") + 1:data.rindex(")")],
+                "rss_mb": int(fields[21]) * _PAGE_KB / 1024,
+                "age": uptime - int(fields[19]) / _CLK_TCK,
+            }
+        except (OSError, ValueError, IndexError):
+            continue
+    return table
+
+def _proc_cmdline(pid):
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return f.read().replace(b"\0", b" ").decode(errors="ignore")
+    except OSError:
+        return ""
+
+def _process_tree(children, root):
+    pids, stack = [root], [root]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            pids.append(child)
+            stack.append(child)
+    return pids
+
+def _kill_pids(pids):
+    # 先杀子进程再杀根，避免子进程被重新挂到 init
+    for pid in reversed(pids):
+        try:
+            os.kill(pid, 9)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+def _is_our_browser_cmdline(cmdline):
+    """是否使用本系统的 user-data-dir（临时目录或持久化 Profile）"""
+    return (f"--user-data-dir={os.path.join(tempfile.gettempdir(), 'chrome_')}" in cmdline
+            or f"--user-data-dir={PROFILE_ROOT}" in cmdline)
+
+def is_driver_killed(driver):
+    return getattr(driver, "_pid", None) in _KILLED_DRIVER_PIDS
+
+def _reap_orphans(table, children):
+    """结束孤儿 chromedriver/chrome：父进程是本进程但已不在活跃列表，或已被 init 收养且确认属于本系统"""
+    me = os.getpid()
+    orphan_parents = {me} if me == 1 else {me, 1}
+    with PID_LOCK:
+        active = set(ACTIVE_DRIVER_PIDS)
+    killed = 0
+    for pid, proc in table.items():
+        if pid in active or proc["ppid"] not in orphan_parents or proc["age"] < ORPHAN_MIN_AGE:
+            continue
+        tree = _process_tree(children, pid)
+        if proc["name"].startswith("chromedriver"):
+            # 被 init 收养的 chromedriver 命令行无法区分归属，必须有浏览器子进程证明是本系统启动的；
+            # 没有子进程的可能属于本机其他程序，不处理
+            if proc["ppid"] != me and not any(_is_our_browser_cmdline(_proc_cmdline(p)) for p in tree[1:]):
+                continue
+        elif not ("chrome" in proc["name"] and proc["ppid"] != me and _is_our_browser_cmdline(_proc_cmdline(pid))):
+            continue
+        _kill_pids(tree)
+        killed += 1
+    return killed
+
+def _reap_temp_dirs(table):
+    """清理不再被任何进程使用的 chrome_* 临时目录"""
+    tmp = tempfile.gettempdir()
+    in_use = " ".join(_proc_cmdline(pid) for pid, p in table.items() if "chrome" in p["name"])
+    reaped = 0
+    try:
+        names = [n for n in os.listdir(tmp) if n.startswith("chrome_")]
+    except OSError:
+        return 0
+    for name in names:
+        path = os.path.join(tmp, name)
+        try:
+            if not os.path.isdir(path) or path in in_use or time.time() - os.path.getmtime(path) < TEMP_DIR_REAP_AGE:
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        reaped += 1
+    return reaped
+
+def chrome_governor_sweep(reap_dirs=False):
+    """
+    一次治理：清理孤儿进程 -> 统计各 driver 内存 -> 单个超限的结束 -> 总量超限时
+    先淘汰最早的 2FA 等待浏览器，再结束占用最大的浏览器
+    """
+    if not os.path.isdir("/proc"):
+        return
+    with _GOVERNOR_LOCK:
+        table = _read_proc_table()
+        children = {}
+        for pid, proc in table.items():
+            children.setdefault(proc["ppid"], []).append(pid)
+
+        killed_orphans = _reap_orphans(table, children)
+
+        with PID_LOCK:
+            active = [pid for pid in ACTIVE_DRIVER_PIDS if pid in table]
+        trees = {pid: _process_tree(children, pid) for pid in active}
+        usage = {pid: sum(table[p]["rss_mb"] for p in tree if p in table) for pid, tree in trees.items()}
+
+        with DRIVER_MAP_LOCK:
+            pending_by_pid = {getattr(data.get("driver"), "_pid", None): name
+                              for name, data in PENDING_DRIVERS.items() if isinstance(data, dict)}
+
+        killed_over = 0
+        for pid, mb in list(usage.items()):
+            if mb > CHROME_DRIVER_MAX_MB:
+                add_log(f"🧯 浏览器 PID {pid} 内存 {mb:.0f}MB 超过单实例上限 {CHROME_DRIVER_MAX_MB}MB，已强制结束")
+                _KILLED_DRIVER_PIDS.add(pid)
+                if pid in pending_by_pid:
+                    # 等待 2FA 的浏览器：同时移除等待记录和 Redis 中的归属
+                    discard_pending_driver(pending_by_pid[pid])
+                _kill_pids(trees[pid])
+                usage.pop(pid)
+                killed_over += 1
+
+        evicted = 0
+        total = sum(usage.values())
+        if total > CHROME_TOTAL_MAX_MB:
+            with DRIVER_MAP_LOCK:
+                pending = sorted(
+                    ((data.get("timestamp", 0), name, getattr(data.get("driver"), "_pid", None))
+                     for name, data in PENDING_DRIVERS.items() if isinstance(data, dict) and not data.get("in_use")))
+            for _, name, pid in pending:
+                if total <= CHROME_TOTAL_MAX_MB:
+                    break
+                add_log(f"🧯 浏览器总内存 {total:.0f}MB 超过上限，释放 [{name}] 的 2FA 等待浏览器")
+                discard_pending_driver(name)
+                total -= usage.pop(pid, 0)
+                evicted += 1
+            for pid, mb in sorted(usage.items(), key=lambda x: -x[1]):
+                if total <= CHROME_TOTAL_MAX_MB:
+                    break
+                add_log(f"🧯 浏览器总内存 {total:.0f}MB 超过上限 {CHROME_TOTAL_MAX_MB}MB，结束 PID {pid} ({mb:.0f}MB)")
+                _KILLED_DRIVER_PIDS.add(pid)
+                _kill_pids(trees[pid])
+                usage.pop(pid)
+                total -= mb
+                killed_over += 1
+
+        reaped = _reap_temp_dirs(table) if reap_dirs else 0
+        _GOVERNOR_STATS.update({
+            "last_sweep": time.time(),
+            "drivers": {pid: round(mb, 1) for pid, mb in usage.items()},
+            "total_mb": round(sum(usage.values()), 1),
+        })
+        _GOVERNOR_STATS["killed_orphans"] += killed_orphans
+        _GOVERNOR_STATS["killed_over_budget"] += killed_over
+        _GOVERNOR_STATS["evicted_2fa"] += evicted
+        _GOVERNOR_STATS["reaped_dirs"] += reaped
+
+def get_chrome_governor_stats():
+    with _GOVERNOR_LOCK:
+        return {**_GOVERNOR_STATS, "drivers": dict(_GOVERNOR_STATS["drivers"]),
+                "driver_max_mb": CHROME_DRIVER_MAX_MB, "total_max_mb": CHROME_TOTAL_MAX_MB}
+
 def kill_zombie_processes():
     """ 
     强制清理所有相关的残留进程
     """
+    if use_browser_farm():
+        return  # 浏览器都在 browser_farm 进程中，由它自己清理
     try:
         if sys.platform == "win32":
             subprocess.run(["taskkill", "/F", "/IM", "chromedriver.exe", "/T"], capture_output=True, check=False)
             subprocess.run(["taskkill", "/F", "/IM", "chrome.exe", "/T"], capture_output=True, check=False)
         else:
-            subprocess.run(["pkill", "-9", "chromedriver"], capture_output=True, check=False)
-            subprocess.run(["pkill", "-9", "chrome"], capture_output=True, check=False)
+            # 只清理本系统的孤儿进程和遗留临时目录，不影响其他 worker 和无关的 Chrome
+            chrome_governor_sweep(reap_dirs=True)
         # add_log("🧹 已执行僵尸进程强力清理")
     except Exception:
         pass  # 静默处理，不打印日志
 
 def process_health_check():
     """
-    进程健康巡检：主动发现并清理不属于当前活跃列表的残留进程
+    进程健康巡检：主动发现并清理不属于当前活跃列表的残留进程，并执行内存预算
     支持 Windows 和 Linux
     """
+    if use_browser_farm():
+        return
     try:
         if sys.platform == "win32":
             output = subprocess.check_output('tasklist /FI "IMAGENAME eq chromedriver.exe" /FO CSV /NH', shell=True).decode('gbk', errors='ignore')
@@ -465,18 +1483,9 @@ def process_health_check():
                         except ValueError:
                             pass
         else:
-            # Linux: 使用 pgrep 查找 chromedriver 进程
-            try:
-                output = subprocess.check_output(['pgrep', '-f', 'chromedriver'], text=True)
-                pids = [int(p.strip()) for p in output.strip().split('\n') if p.strip()]
-                for pid in pids:
-                    with PID_LOCK:
-                        if pid not in ACTIVE_DRIVER_PIDS:
-                            subprocess.run(["kill", "-9", str(pid)], capture_output=True)
-            except subprocess.CalledProcessError:
-                pass  # 没有找到进程，正常情况
-    except Exception:
-        pass
+            chrome_governor_sweep()
+    except Exception as e:
+        add_log(f"⚠️ 浏览器治理异常: {e}")
 
 
 # 定期健康检查线程
@@ -484,9 +1493,9 @@ _health_check_thread = None
 _health_check_stop = threading.Event()
 
 def _health_check_daemon():
-    """后台线程：每 5 分钟执行一次进程健康检查"""
+    """后台线程：定期执行进程健康检查（/proc 扫描开销很小，默认 30 秒一次）"""
     while not _health_check_stop.is_set():
-        _health_check_stop.wait(timeout=300)  # 5 分钟
+        _health_check_stop.wait(timeout=CHROME_GOVERNOR_INTERVAL)
         if not _health_check_stop.is_set():
             process_health_check()
 
@@ -515,6 +1524,9 @@ def _auto_refresh_daemon():
         if _auto_refresh_stop.is_set(): break
         
         try:
+            # 多 worker 时只由持有租约的一个进程执行主动续期
+            if MULTI_WORKER and not acquire_task_lease("daemon:auto_refresh", ttl=300):
+                continue
             now = time.time()
             users_to_refresh = []
             
@@ -571,9 +1583,16 @@ def start_auto_refresh_daemon():
         add_log("🛡️ Session 自动保活服务已启动 (45m/check)")
     
     # ✅ 启动 2FA driver 清理线程
-    cleanup_thread = threading.Thread(target=_cleanup_expired_drivers, daemon=True, name="DriverCleanup")
-    cleanup_thread.start()
-    add_log("🧹 2FA Driver 清理服务已启动 (10m 超时)")
+    start_driver_cleanup_daemon()
+
+_driver_cleanup_thread = None
+
+def start_driver_cleanup_daemon():
+    global _driver_cleanup_thread
+    if _driver_cleanup_thread is None or not _driver_cleanup_thread.is_alive():
+        _driver_cleanup_thread = threading.Thread(target=_cleanup_expired_drivers, daemon=True, name="DriverCleanup")
+        _driver_cleanup_thread.start()
+        add_log(f"🧹 2FA Driver 清理服务已启动 ({TWO_FA_HOLD_TTL // 60}m 超时, 上限 {TWO_FA_MAX_HOLDS} 个)")
 
 def stop_auto_refresh_daemon():
     _auto_refresh_stop.set()
@@ -598,50 +1617,215 @@ def _cleanup_on_exit():
 
 atexit.register(_cleanup_on_exit)
 
-def _do_init_browser(selected_ua):
-    """
-    内部实现：实际启动浏览器的逻辑
-    返回 driver 或 None
-    """
-    global DRIVER_PATH
-    
-    # 1. 驱动检查 - 优先使用系统常见路径
-    if not DRIVER_PATH:
-        # 优先检测自定义的 chromedriver-new
-        possible_paths = [
-            "/usr/bin/chromedriver-new", "/usr/local/bin/chromedriver-new", "chromedriver-new",
-            "/usr/bin/chromedriver",
-            "/usr/lib/chromium-browser/chromedriver",
-            "/usr/local/bin/chromedriver",
-            "/snap/bin/chromium.chromedriver"
-        ]
-        for p in possible_paths:
-            # 简单检查是否存在
-            if os.popen(f"which {p}").read().strip() or os.path.exists(p):
-                 DRIVER_PATH = p
-                 break
 
-        if not DRIVER_PATH:
-            try:
-                from webdriver_manager.chrome import ChromeDriverManager
-                DRIVER_PATH = ChromeDriverManager().install()
-            except: pass
+# ================= 精简浏览器模式 =================
+# 登录只需要 SSO 表单和预订页发出的带 Token 请求：图片/媒体/字体和第三方域名一律不加载
+# 尚未在真实统一认证页面上完成验证，默认关闭，确认登录正常后再通过 BROWSER_LEAN=true 开启
+BROWSER_LEAN = os.environ.get("BROWSER_LEAN", "false").lower() == "true"
+LEAN_WINDOW_SIZE = (1280, 800)
+# 允许解析的域名（逗号分隔，支持 * 通配），其余域名在 DNS 层直接失败
+LEAN_ALLOWED_HOSTS = [h.strip() for h in os.environ.get("BROWSER_ALLOWED_HOSTS", "*.scut.edu.cn").split(",") if h.strip()]
+LEAN_BLOCKED_URLS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico", "*.bmp",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+    "*.mp4", "*.webm", "*.mp3", "*.ogg", "*.wav", "*.m3u8",
+]
+LEAN_CHROME_ARGS = [
+    "--blink-settings=imagesEnabled=false",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--disable-notifications",
+    "--disable-breakpad",
+    "--disable-features=Translate,MediaRouter,OptimizationHints,AutofillServerCommunication,InterestFeedContentSuggestions",
+    "--no-first-run",
+    "--no-default-browser-check",
+    "--mute-audio",
+    "--force-device-scale-factor=1",
+]
+
+def _apply_lean_options(options):
+    for arg in LEAN_CHROME_ARGS:
+        options.add_argument(arg)
+    if LEAN_ALLOWED_HOSTS:
+        excludes = ", ".join(f"EXCLUDE {h}" for h in LEAN_ALLOWED_HOSTS)
+        options.add_argument(f"--host-resolver-rules=MAP * ~NOTFOUND , {excludes}")
+    options.add_experimental_option("prefs", {
+        "profile.managed_default_content_settings.images": 2,
+        "profile.default_content_setting_values.notifications": 2,
+    })
+    # 性能日志只用来嗅探 Token，只保留 Network 事件
+    options.add_experimental_option("perfLoggingPrefs", {"enableNetwork": True, "enablePage": False})
+
+# ================= 持久化浏览器 Profile =================
+# 开启后每个用户复用自己的 user-data-dir，SSO Cookie、"校内账号登录" 选择和设备信任状态得以保留，
+# 保活登录常常直接凭 SSO Cookie 跳转拿到 Token；文件锁保证同一 Profile 同时只被一个浏览器使用
+BROWSER_PROFILES = os.environ.get("BROWSER_PROFILES", "false").lower() == "true"
+# Profile 里保存着 SSO 登录态，必须放在属主为本用户、权限 0700 的私有目录（见 ensure_private_dir）
+PROFILE_ROOT = os.environ.get("BROWSER_PROFILE_DIR") or "/var/lib/scut_order/profiles"
+PROFILE_MAX_MB = int(os.environ.get("BROWSER_PROFILE_MAX_MB", 60))        # 单个 Profile 上限，超出则重建
+PROFILE_TOTAL_MAX_MB = int(os.environ.get("BROWSER_PROFILE_TOTAL_MB", 1024))
+PROFILE_MAX_COUNT = int(os.environ.get("BROWSER_PROFILE_MAX_COUNT", 50))
+# 关闭浏览器后删除的缓存目录（登录不依赖它们，体积却占大头）
+PROFILE_CACHE_DIRS = ["Cache", "Code Cache", "GPUCache", "Service Worker", "GrShaderCache", "ShaderCache", "blob_storage"]
 
-    if not DRIVER_PATH:
-        # 最后兜底
-        DRIVER_PATH = "chromedriver"
+try:
+    import fcntl
+except ImportError:  # Windows 不支持 flock，退回临时目录
+    fcntl = None
 
-    # 2. 获取并发许可
-    acquired = BROWSER_SEMAPHORE.acquire(blocking=True, timeout=30)
-    if not acquired:
-        add_log("❌ 浏览器并发限制已达上限，请稍后再试")
+def _profile_name(username):
+    return re.sub(r'[^0-9A-Za-z_-]', '_', str(username))
+
+def _dir_size_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total / (1024 * 1024)
+
+def _try_lock(lock_path):
+    """非阻塞加锁，成功返回文件句柄"""
+    fd = open(lock_path, 'a')
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+    except OSError:
+        fd.close()
         return None
 
-    options = webdriver.ChromeOptions()
-    if os.environ.get("HEADLESS", "true").lower() != "false":
-        options.add_argument("--headless=new")
-        
-    # 解决服务器环境下的启动问题
+def acquire_browser_profile(username):
+    """
+    获取用户的持久化 Profile 目录并加锁
+    返回 (profile_dir, lock_fd)；未启用或已被其他浏览器占用时返回 (None, None)
+    """
+    if not BROWSER_PROFILES or not username or fcntl is None:
+        return None, None
+    try:
+        ensure_private_dir(PROFILE_ROOT)
+        name = _profile_name(username)
+        lock_fd = _try_lock(os.path.join(PROFILE_ROOT, f"{name}.lock"))
+        if not lock_fd:
+            add_log(f"🔒 [{username}] Profile 正被其他浏览器使用，本次使用临时目录")
+            return None, None
+        profile_dir = os.path.join(PROFILE_ROOT, name)
+        os.makedirs(profile_dir, exist_ok=True)
+        # 上次崩溃遗留的单例锁会让 Chrome 拒绝启动；此时已持有文件锁，可以安全删除
+        for f in ("SingletonLock", "SingletonSocket", "SingletonCookie"):
+            try:
+                os.remove(os.path.join(profile_dir, f))
+            except OSError:
+                pass
+        return profile_dir, lock_fd
+    except Exception as e:
+        add_log(f"⚠️ [{username}] Profile 获取失败: {e}")
+        return None, None
+
+def may_reuse_browser_profile(username, password):
+    """
+    Profile 中的 SSO Cookie 可以不经密码校验直接登录，
+    只有密码与已保存 Session 一致时（保活续期、自动救援）才能复用，否则任何人输入该学号都能登录
+    """
+    if not BROWSER_PROFILES or not username or not password:
+        return False
+    session = get_session(username)
+    return bool(session) and session.get('password') == password
+
+def release_browser_profile(profile_dir, lock_fd):
+    """浏览器退出后：清缓存、超限重建、更新 LRU 时间并解锁，然后按总量淘汰"""
+    try:
+        for d in PROFILE_CACHE_DIRS:
+            for base in (profile_dir, os.path.join(profile_dir, "Default")):
+                shutil.rmtree(os.path.join(base, d), ignore_errors=True)
+        if _dir_size_mb(profile_dir) > PROFILE_MAX_MB:
+            add_log(f"🧹 Profile {os.path.basename(profile_dir)} 超过 {PROFILE_MAX_MB}MB，已重建")
+            shutil.rmtree(profile_dir, ignore_errors=True)
+        else:
+            os.utime(profile_dir, None)
+    except Exception:
+        pass
+    finally:
+        try:
+            lock_fd.close()  # 关闭句柄即释放 flock
+        except Exception:
+            pass
+    _evict_browser_profiles()
+
+def _evict_browser_profiles():
+    """按最近使用时间淘汰 Profile，直到数量和总大小都在上限内；正在使用的 Profile 跳过"""
+    try:
+        entries = []
+        for name in os.listdir(PROFILE_ROOT):
+            path = os.path.join(PROFILE_ROOT, name)
+            if os.path.isdir(path):
+                entries.append((os.path.getmtime(path), path, _dir_size_mb(path)))
+    except OSError:
+        return
+    entries.sort()
+    count = len(entries)
+    total = sum(e[2] for e in entries)
+    for _, path, size in entries:
+        if count <= PROFILE_MAX_COUNT and total <= PROFILE_TOTAL_MAX_MB:
+            break
+        lock_fd = _try_lock(f"{path}.lock")
+        if not lock_fd:
+            continue
+        try:
+            shutil.rmtree(path, ignore_errors=True)
+            count -= 1
+            total -= size
+        finally:
+            lock_fd.close()
+
+def _apply_lean_blocking(driver):
+    """通过 CDP 在网络层拦截图片/媒体/字体请求"""
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": LEAN_BLOCKED_URLS})
+    except Exception as e:
+        add_log(f"⚠️ 资源拦截设置失败（继续使用完整模式）: {e}")
+
+def _do_init_browser(selected_ua, username=None):
+    """
+    内部实现：实际启动浏览器的逻辑
+    返回 driver 或 None
+    """
+    global DRIVER_PATH
+    
+    _load_selenium()
+
+    # 1. 驱动检查 - 优先使用系统常见路径（结果按二进制指纹缓存）
+    if not DRIVER_PATH:
+        DRIVER_PATH = get_chromedriver_path()
+
+        if not DRIVER_PATH:
+            try:
+                from webdriver_manager.chrome import ChromeDriverManager
+                DRIVER_PATH = ChromeDriverManager().install()
+            except: pass
+
+    if not DRIVER_PATH:
+        # 最后兜底
+        DRIVER_PATH = "chromedriver"
+
+    # 2. 获取并发许可；名额被等待验证码的浏览器占满时淘汰最早的空闲 hold，否则新登录会一直排队到超时
+    acquired = BROWSER_SEMAPHORE.acquire(blocking=True, timeout=BROWSER_ADMISSION_WAIT)
+    if not acquired and evict_oldest_2fa_hold("浏览器名额已满"):
+        acquired = BROWSER_SEMAPHORE.acquire(blocking=True, timeout=30 - BROWSER_ADMISSION_WAIT)
+    if not acquired:
+        add_log("❌ 浏览器并发限制已达上限，请稍后再试")
+        return None
+
+    options = webdriver.ChromeOptions()
+    if os.environ.get("HEADLESS", "true").lower() != "false":
+        options.add_argument("--headless=new")
+        
+    # 解决服务器环境下的启动问题
     options.add_argument("--no-sandbox")
     options.add_argument("--disable-dev-shm-usage")
     options.add_argument("--disable-gpu")
@@ -650,9 +1834,10 @@ def _do_init_browser(selected_ua):
     options.add_argument("--remote-debugging-port=0")
     options.add_argument(f"--user-agent={selected_ua}")
     
-    # 设置临时用户数据目录（避免多实例冲突）
-    import tempfile
-    user_data_dir = tempfile.mkdtemp(prefix="chrome_")
+    # 用户数据目录：优先使用该用户的持久化 Profile，否则使用临时目录（避免多实例冲突）
+    user_data_dir, profile_lock = acquire_browser_profile(username)
+    if not user_data_dir:
+        user_data_dir = tempfile.mkdtemp(prefix="chrome_")
     options.add_argument(f"--user-data-dir={user_data_dir}")
     
     # 隐藏 Selenium 特征
@@ -663,9 +1848,14 @@ def _do_init_browser(selected_ua):
     # 开启性能日志
     options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
     
-    # 随机窗口大小
-    width = random.randint(1024, 1920)
-    height = random.randint(768, 1080)
+    if BROWSER_LEAN:
+        # 精简模式：固定小窗口，关闭用不到的 Chrome 功能
+        width, height = LEAN_WINDOW_SIZE
+        _apply_lean_options(options)
+    else:
+        # 随机窗口大小
+        width = random.randint(1024, 1920)
+        height = random.randint(768, 1080)
     options.add_argument(f"--window-size={width},{height}")
 
     try:
@@ -680,6 +1870,11 @@ def _do_init_browser(selected_ua):
                 })
             """
         })
+        # 页面变化计数器：登录状态机据此等待 DOM 变化而不是固定 sleep
+        driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": _PAGE_EVENT_JS})
+        driver.set_script_timeout(10)
+        if BROWSER_LEAN:
+            _apply_lean_blocking(driver)
         
         driver.set_page_load_timeout(30)
         
@@ -688,6 +1883,7 @@ def _do_init_browser(selected_ua):
         driver._pid = pid
         driver._user_agent = selected_ua  # 保存UA到driver对象
         driver._user_data_dir = user_data_dir  # 保存临时目录用于清理
+        driver._profile_lock = profile_lock  # 持久化 Profile 的文件锁，关闭时释放而不删除目录
         with PID_LOCK: ACTIVE_DRIVER_PIDS.add(pid)
         # add_log(f"✅ 浏览器已启动 (PID: {pid}, UA: {selected_ua[:50]}...)")
         
@@ -696,18 +1892,20 @@ def _do_init_browser(selected_ua):
     except Exception as e:
         add_log(f"❌ 浏览器启动失败: {e}")
         # 清理临时目录
-        if user_data_dir and os.path.exists(user_data_dir):
+        if profile_lock:
+            release_browser_profile(user_data_dir, profile_lock)
+        elif user_data_dir and os.path.exists(user_data_dir):
             shutil.rmtree(user_data_dir, ignore_errors=True)
         try: BROWSER_SEMAPHORE.release()
         except: pass
         return None
 
 
-def init_browser():
+def init_browser(username=None):
     """ 
     工厂模式：每次调用返回全新的 driver 实例 
     添加随机化指纹（User-Agent, 分辨率）和 Selenium 特征隐藏
-    支持失败重试机制
+    支持失败重试机制；传入 username 且开启 BROWSER_PROFILES 时复用该用户的 Profile
     """
     # 候选 UA 列表
     USER_AGENTS = [
@@ -717,6 +1915,9 @@ def init_browser():
         "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"
     ]
     selected_ua = random.choice(USER_AGENTS)
+    if username and BROWSER_PROFILES:
+        # 持久化 Profile 固定 UA，避免同一设备的 Cookie 配上不同浏览器指纹
+        selected_ua = USER_AGENTS[int(hashlib.md5(str(username).encode()).hexdigest(), 16) % len(USER_AGENTS)]
     
     # 最多尝试2次
     for attempt in range(2):
@@ -729,7 +1930,7 @@ def init_browser():
             process_health_check()
             time.sleep(1)
         
-        driver = _do_init_browser(selected_ua)
+        driver = _do_init_browser(selected_ua, username)
         if driver:
             return driver
     
@@ -744,6 +1945,7 @@ def close_driver(driver):
     
     pid = getattr(driver, '_pid', None)
     user_data_dir = getattr(driver, '_user_data_dir', None)
+    profile_lock = getattr(driver, '_profile_lock', None)
     
     try:
         driver.quit()
@@ -755,9 +1957,8 @@ def close_driver(driver):
                 if sys.platform == "win32":
                     subprocess.run(["taskkill", "/F", "/PID", str(pid), "/T"], 
                                    capture_output=True, check=False)
-                else:
-                    subprocess.run(["kill", "-9", str(pid)], 
-                                   capture_output=True, check=False)
+                elif pid not in _KILLED_DRIVER_PIDS:
+                    _kill_pids([pid])
                 add_log(f"🗑️ 强制终止进程 PID: {pid}")
             except Exception as kill_err:
                 add_log(f"⚠️ 强制杀进程失败: {kill_err}")
@@ -766,9 +1967,12 @@ def close_driver(driver):
         if pid:
             with PID_LOCK: 
                 ACTIVE_DRIVER_PIDS.discard(pid)
+            _KILLED_DRIVER_PIDS.discard(pid)
         
-        # 2. 清理临时用户数据目录
-        if user_data_dir and os.path.exists(user_data_dir):
+        # 2. 清理临时用户数据目录（持久化 Profile 只释放锁）
+        if profile_lock:
+            release_browser_profile(user_data_dir, profile_lock)
+        elif user_data_dir and os.path.exists(user_data_dir):
             try:
                 shutil.rmtree(user_data_dir, ignore_errors=True)
                 # add_log(f"🧹 已清理临时目录: {user_data_dir}")
@@ -782,29 +1986,36 @@ def close_driver(driver):
             pass  # 信号量可能已被释放
 
 
+def _drain_token(driver):
+    """ 读取一次性能日志，返回其中带 Bearer 的 Token（没有则 None） """
+    try:
+        logs = driver.get_log("performance")
+    except:
+        return None
+    for entry in logs:
+        try:
+            message = json.loads(entry["message"])["message"]
+            if message["method"] == "Network.requestWillBeSent":
+                req = message["params"]["request"]
+                headers = req.get("headers", {})
+                auth = None
+                for k, v in headers.items():
+                    if k.lower() == "authorization":
+                        auth = v
+                        break
+                if auth and "Bearer" in auth:
+                    return auth.replace("Bearer ", "").strip()
+        except:
+            continue
+    return None
+
 def sniff_token(driver, timeout=0.5):
     """ 快速嗅探 Token (非阻塞式，但支持 timeout 轮询) """
     start_time = time.time()
     while time.time() - start_time < timeout:
-        try:
-            logs = driver.get_log("performance")
-            for entry in logs:
-                try:
-                    message = json.loads(entry["message"])["message"]
-                    if message["method"] == "Network.requestWillBeSent":
-                        req = message["params"]["request"]
-                        headers = req.get("headers", {})
-                        auth = None
-                        for k, v in headers.items():
-                            if k.lower() == "authorization":
-                                auth = v
-                                break
-                        if auth and "Bearer" in auth:
-                            return auth.replace("Bearer ", "").strip()
-                except:
-                    continue
-        except:
-            pass
+        token = _drain_token(driver)
+        if token:
+            return token
         
         # 如果是快速嗅探（timeout很短），不需要 sleep 太多
         if timeout > 1:
@@ -824,91 +2035,148 @@ def extract_user_info(token):
     except: return None
 
 
-def check_and_click_campus_login(driver):
-    """ 检测并点击'校内账号登录'按钮 """
-    try:
-        # 方式1: 查找包含特定文字的按钮或div
-        xpath_list = [
-            "//button[contains(., '校内账号登录')]",
-            "//div[contains(text(), '校内账号登录')]",
-            "//span[contains(text(), '校内账号登录')]",
-            "//a[contains(text(), '校内账号登录')]",
-            "//button[contains(., '校内登录')]",
-            "//div[contains(text(), '校内登录')]",
-            "//*[contains(@class, 'login') and contains(text(), '校内')]",
-        ]
-        
-        for xpath in xpath_list:
-            try:
-                elems = driver.find_elements(By.XPATH, xpath)
-                for elem in elems:
-                    if elem.is_displayed():
-                        # add_log(f"🔍 找到按钮: {elem.text[:20] if elem.text else 'no-text'}")
-                        try:
-                            elem.click()
-                        except:
-                            driver.execute_script("arguments[0].click();", elem)
-                        return True
-            except:
-                pass
+# ================= 登录页元素探测 =================
+# 每个角色的候选定位策略（按原有优先级排列）：(类型, 表达式)
+# - css / xpath: 第一个可见且可用的匹配元素
+# - button_text: 文字包含表达式（或 campus）的可见按钮
+# - exists: 元素存在即可（2FA 验证码框）
+LOGIN_PAGE_STRATEGIES = {
+    "2fa": [("exists", "#PM1")],
+    "campus": [
+        ("xpath", "//button[contains(., '校内账号登录')]"),
+        ("xpath", "//div[contains(text(), '校内账号登录')]"),
+        ("xpath", "//span[contains(text(), '校内账号登录')]"),
+        ("xpath", "//a[contains(text(), '校内账号登录')]"),
+        ("xpath", "//button[contains(., '校内登录')]"),
+        ("xpath", "//div[contains(text(), '校内登录')]"),
+        ("xpath", "//*[contains(@class, 'login') and contains(text(), '校内')]"),
+        ("css", "#root > div > div > div > div > div > div:nth-child(2) > button"),
+        ("css", "button.campus-login"),
+        ("css", "[class*='campus'][class*='login']"),
+        ("css", "button:nth-child(2)"),  # 通常是第二个按钮
+        ("button_text", "校内"),
+    ],
+    "un": [("css", "#un"), ("css", "#username"), ("css", "#account"),
+           ("css", "input[name='username']"), ("css", "input[name='account']")],
+    "pd": [("css", "#pd"), ("css", "#password"), ("css", "input[name='password']"),
+           ("css", "input[type='password']")],
+    "btn": [
+        ("css", "#index_login_btn > input"),  # 旧版
+        ("css", "input[value='登录']"),
+        ("css", "input[value='Log In']"),
+        ("css", "button[type='submit']"),
+        ("css", ".btn-primary"),
+        ("css", "#login-button"),
+        ("xpath", "//button[contains(., '登录')] | //span[contains(., '登录')]/parent::button"),
+    ],
+}
+
+# 通用兜底策略在不同页面会命中不相干的元素，只在本轮按原优先级使用，不写入页面缓存
+SELECTOR_CACHE_SKIP = {f"{kind}:{expr}" for kind, expr in [
+    ("css", "#root > div > div > div > div > div > div:nth-child(2) > button"),
+    ("css", "button:nth-child(2)"),
+    ("button_text", "校内"),
+    ("css", "button[type='submit']"),
+    ("css", ".btn-primary"),
+    ("css", "input[type='password']"),
+]}
+
+# 一次 execute_script 完成全部探测；页面指纹 (host + path) 上次命中的策略优先尝试
+_LOGIN_PROBE_JS = """
+var strategies = arguments[0], cache = arguments[1];
+var fp = location.host + location.pathname;
+var prefer = cache[fp] || {};
+function visible(el) {
+    if (!el.getClientRects().length) return false;
+    var st = window.getComputedStyle(el);
+    return st.visibility !== 'hidden' && st.display !== 'none';
+}
+function find(kind, expr) {
+    var out = [], i;
+    try {
+        if (kind === 'css' || kind === 'exists') {
+            out = Array.prototype.slice.call(document.querySelectorAll(expr));
+        } else if (kind === 'xpath') {
+            var snap = document.evaluate(expr, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+            for (i = 0; i < snap.snapshotLength; i++) out.push(snap.snapshotItem(i));
+        } else if (kind === 'button_text') {
+            var buttons = document.getElementsByTagName('button');
+            for (i = 0; i < buttons.length; i++) {
+                var t = (buttons[i].innerText || '').trim();
+                if (t.indexOf(expr) >= 0 || t.toLowerCase().indexOf('campus') >= 0) out.push(buttons[i]);
+            }
+        }
+    } catch (e) {}
+    return out;
+}
+var res = {fp: fp, url: location.href};
+for (var role in strategies) {
+    var list = strategies[role].slice();
+    var p = prefer[role];
+    if (p) list.sort(function (a, b) { return (b[0] + ':' + b[1] === p) - (a[0] + ':' + a[1] === p); });
+    for (var i = 0; i < list.length; i++) {
+        var kind = list[i][0], els = find(kind, list[i][1]), hit = null;
+        for (var j = 0; j < els.length; j++) {
+            if (kind === 'exists' || (visible(els[j]) && !els[j].disabled)) { hit = els[j]; break; }
+        }
+        if (hit) {
+            res[role] = hit;
+            res[role + '_key'] = kind + ':' + list[i][1];
+            if (typeof hit.value === 'string') res[role + '_value'] = hit.value;
+            break;
+        }
+    }
+}
+return res;
+"""
 
-        # 方式2: 备用CSS选择器
-        css_selectors = [
-            "#root > div > div > div > div > div > div:nth-child(2) > button",
-            "button.campus-login",
-            "[class*='campus'][class*='login']",
-            "button:nth-child(2)",  # 通常是第二个按钮
-        ]
-        
-        for css in css_selectors:
-            try:
-                elem = driver.find_element(By.CSS_SELECTOR, css)
-                if elem.is_displayed():
-                    # add_log(f"🔍 通过CSS找到按钮: {css[:30]}")
-                    try:
-                        elem.click()
-                    except:
-                        driver.execute_script("arguments[0].click();", elem)
-                    return True
-            except:
-                pass
+_SELECTOR_CACHE = {}  # 页面指纹 -> {角色: 命中的策略}
+_SELECTOR_CACHE_LOCK = threading.Lock()
+SELECTOR_CACHE_MAX_PAGES = 64
 
-        # 方式3: 遍历所有按钮，查找包含"校内"或"内"的
-        try:
-            all_buttons = driver.find_elements(By.TAG_NAME, "button")
-            # add_log(f"🔍 页面上共有 {len(all_buttons)} 个按钮")
-            for btn in all_buttons:
-                btn_text = btn.text.strip() if btn.text else ""
-                if btn.is_displayed() and ("校内" in btn_text or "Campus" in btn_text.lower()):
-                    add_log(f"🔍 找到匹配按钮: {btn_text}")
-                    try:
-                        btn.click()
-                    except:
-                        driver.execute_script("arguments[0].click();", btn)
-                    return True
-        except:
-            pass
+def probe_login_page(driver):
+    """
+    一次往返探测登录页所有关键元素
+    返回 dict：fp / url，以及命中角色的 <role>（WebElement）、<role>_key、<role>_value；失败返回空 dict
+    """
+    with _SELECTOR_CACHE_LOCK:
+        cache = {fp: dict(roles) for fp, roles in _SELECTOR_CACHE.items()}
+    try:
+        res = driver.execute_script(_LOGIN_PROBE_JS, LOGIN_PAGE_STRATEGIES, cache) or {}
+    except Exception:
+        return {}
+    fp = res.get("fp")
+    hits = {role: res[f"{role}_key"] for role in LOGIN_PAGE_STRATEGIES
+            if res.get(f"{role}_key") and res[f"{role}_key"] not in SELECTOR_CACHE_SKIP}
+    if fp and hits:
+        with _SELECTOR_CACHE_LOCK:
+            if fp not in _SELECTOR_CACHE and len(_SELECTOR_CACHE) >= SELECTOR_CACHE_MAX_PAGES:
+                _SELECTOR_CACHE.pop(next(iter(_SELECTOR_CACHE)))
+            _SELECTOR_CACHE.setdefault(fp, {}).update(hits)
+    return res
+
+def _click_element(driver, elem):
+    try:
+        elem.click()
+    except Exception:
+        driver.execute_script("arguments[0].click();", elem)
 
+def check_and_click_campus_login(driver, probe=None):
+    """ 检测并点击'校内账号登录'按钮 """
+    try:
+        if probe is None:
+            probe = probe_login_page(driver)
+        elem = probe.get("campus")
+        if elem:
+            _click_element(driver, elem)
+            return True
     except Exception as e:
         add_log(f"⚠️ 检测校内登录按钮异常: {e}")
     return False
 
 
-def find_visible_input(driver, selectors):
-    """ 在一组选择器中找到第一个可见的输入框 """
-    for sel in selectors:
-        try:
-            elems = driver.find_elements(By.CSS_SELECTOR, sel)
-            for elem in elems:
-                if elem.is_displayed() and elem.is_enabled():
-                    return elem
-        except:
-            pass
-    return None
-
-
 def fill_input_robust(driver, elem, text):
-    """ 强力输入：清除 -> 输入 -> JS赋值 -> 触发事件 """
+    """ 强力输入：清除 -> 输入 -> JS赋值 -> 触发事件；返回输入框最终的值是否正确 """
     try:
         # 1. 尝试正常输入
         elem.click()
@@ -924,50 +2192,140 @@ def fill_input_robust(driver, elem, text):
                 arguments[0].dispatchEvent(new Event('change', { bubbles: true }));
                 arguments[0].blur();
             """, elem, text)
+            if elem.get_attribute('value') != text:
+                add_log("❌ 输入框的值与预期不符，JS 赋值也未生效")
+                return False
         return True
     except Exception as e:
         add_log(f"❌ 输入出错: {e}")
         return False
 
 
-def click_login_btn(driver):
+def click_login_btn(driver, probe=None):
     """ 智能寻找登录按钮并点击 """
-    # 常见的登录按钮选择器
-    selectors = [
-        "#index_login_btn > input",  # 旧版
-        "input[value='登录']",
-        "input[value='Log In']",
-        "button[type='submit']",
-        ".btn-primary",
-        "#login-button"
-    ]
-
-    # 1. 精确匹配
-    for sel in selectors:
-        try:
-            elems = driver.find_elements(By.CSS_SELECTOR, sel)
-            for elem in elems:
-                if elem.is_displayed():
-                    try:
-                        elem.click()
-                    except:
-                        driver.execute_script("arguments[0].click();", elem)
-                    return True
-        except:
-            pass
-
-    # 2. 模糊匹配文字
     try:
-        xpath = "//button[contains(., '登录')] | //span[contains(., '登录')]/parent::button"
-        elems = driver.find_elements(By.XPATH, xpath)
-        for elem in elems:
-            if elem.is_displayed():
-                elem.click()
-                return True
-    except:
+        if probe is None:
+            probe = probe_login_page(driver)
+        elem = probe.get("btn")
+        if elem:
+            _click_element(driver, elem)
+            return True
+    except Exception:
         pass
     return False
 
+# ================= 登录状态机 =================
+# 页面内计数器：DOM 变化时递增并唤醒等待者（导航后由新文档重新安装）
+_PAGE_EVENT_JS = """
+(function () {
+    window.__scutSeq = 0;
+    window.__scutWaiters = [];
+    var bump = function () {
+        window.__scutSeq++;
+        var waiters = window.__scutWaiters;
+        window.__scutWaiters = [];
+        for (var i = 0; i < waiters.length; i++) waiters[i]();
+    };
+    var observe = function () {
+        // 只关注节点增删：属性变化（动画、焦点样式）过于频繁，状态机另有 500ms 兜底轮询
+        new MutationObserver(bump).observe(document.documentElement, {childList: true, subtree: true});
+        bump();
+    };
+    if (document.readyState === 'loading') document.addEventListener('DOMContentLoaded', observe);
+    else observe();
+})();
+"""
+
+_WAIT_PAGE_EVENT_JS = """
+var seq = arguments[0], ms = arguments[1], done = arguments[arguments.length - 1];
+var cur = window.__scutSeq || 0;
+if (!window.__scutWaiters) return setTimeout(function () { done(cur); }, ms);  // 计数器未安装：退化为定时轮询
+if (cur !== seq) return done(cur);
+var timer = setTimeout(function () { done(window.__scutSeq || 0); }, ms);
+window.__scutWaiters.push(function () {
+    clearTimeout(timer);
+    setTimeout(function () { done(window.__scutSeq); }, 50);  // 合并同一批渲染产生的多次变化
+});
+"""
+
+LOGIN_TIMEOUT = 60
+LOGIN_EVENT_WAIT_MS = 500   # 没有页面事件时最多等这么久再查一次网络日志
+LOGIN_ACTION_RETRY = 2      # 同一页面上重复同一动作的最小间隔（等待上次动作生效）
+LOGIN_TIMINGS = collections.deque(maxlen=200)
+LOGIN_TIMINGS_LOCK = threading.Lock()
+
+def wait_for_page_event(driver, seq, timeout_ms=LOGIN_EVENT_WAIT_MS):
+    """
+    阻塞到页面发生 DOM 变化/跳转或超时，返回新的计数值
+    页面跳转会中断脚本，视为事件发生
+    """
+    try:
+        return driver.execute_async_script(_WAIT_PAGE_EVENT_JS, seq, timeout_ms)
+    except Exception:
+        return -1
+
+class LoginPhaseTimer:
+    """记录登录各阶段耗时：enter() 切换阶段，finish() 汇总并写入 LOGIN_TIMINGS"""
+    def __init__(self, username):
+        self.username = username
+        self.start = time.time()
+        self.phase = "launch"
+        self.phase_start = self.start
+        self.phases = {}
+
+    def enter(self, phase):
+        if phase == self.phase:
+            return
+        now = time.time()
+        self.phases[self.phase] = self.phases.get(self.phase, 0) + now - self.phase_start
+        self.phase, self.phase_start = phase, now
+
+    def finish(self, result):
+        self.enter("done")
+        total = time.time() - self.start
+        record = {"username": self.username, "result": result, "total": round(total, 2),
+                  "phases": {k: round(v, 2) for k, v in self.phases.items()}, "time": self.start}
+        with LOGIN_TIMINGS_LOCK:
+            LOGIN_TIMINGS.append(record)
+        detail = " / ".join(f"{k} {v:.1f}" for k, v in self.phases.items())
+        add_log(f"⏱️ [{self.username}] 登录 {result} {total:.1f}s ({detail})")
+        return record
+
+def get_login_timing_stats():
+    """最近登录的总耗时分位数和各阶段平均耗时"""
+    with LOGIN_TIMINGS_LOCK:
+        records = list(LOGIN_TIMINGS)
+    if not records:
+        return {"count": 0}
+    totals = sorted(r["total"] for r in records)
+    phase_sum, phase_count = {}, {}
+    for r in records:
+        for k, v in r["phases"].items():
+            phase_sum[k] = phase_sum.get(k, 0) + v
+            phase_count[k] = phase_count.get(k, 0) + 1
+    results = collections.Counter(r["result"] for r in records)
+    return {
+        "count": len(records),
+        "results": dict(results),
+        "p50": totals[len(totals) // 2],
+        "p95": totals[min(len(totals) - 1, int(len(totals) * 0.95))],
+        "phase_avg": {k: round(phase_sum[k] / phase_count[k], 2) for k in phase_sum},
+    }
+
+def _collect_cookies(driver, username):
+    """Token 出现后读取 Cookies；为空时等下一次页面事件再读（最多 3 次）"""
+    seq = 0
+    for attempt in range(3):
+        try:
+            cookies = {c['name']: c['value'] for c in driver.get_cookies()}
+            if cookies:
+                return cookies
+        except Exception as e:
+            if attempt == 2:
+                add_log(f"⚠️ [{username}] Cookie获取失败（重试{attempt+1}次）: {e}")
+        seq = wait_for_page_event(driver, seq, 300)
+    return {}
+
 def execute_login_logic(username, password, driver=None):
     """
     执行登录流程。
@@ -977,50 +2335,43 @@ def execute_login_logic(username, password, driver=None):
     - status: "error", result=msg
     """
     if not check_whitelist(username): return "error", "白名单拒绝"
+    if driver is None and use_browser_farm():
+        return call_browser_farm("login", username, password)
     # add_log(f"🚀 [{username}] 启动智能登录 (60s超时)...")
+    timer = LoginPhaseTimer(username)
     
     if not driver:
-        driver = init_browser()
+        # 密码未与已保存 Session 核对过时使用临时目录，不能凭 Profile 中的 SSO Cookie 登录
+        driver = init_browser(username if may_reuse_browser_profile(username, password) else None)
         if not driver: return "error", "浏览器启动失败"
     
         if not driver: return "error", "浏览器启动失败"
     
     # add_log(f"🌐 [{username}] 浏览器就绪，正在打开登录页...")
     # 确保打开页面
+    timer.enter("open")
     if "venue" not in driver.current_url and "sso" not in driver.current_url:
         driver.get("https://venue.spe.scut.edu.cn/vb-user/login")
     # add_log(f"📄 当前页面标题: {driver.title}")
 
-    # 定义可能的账号密码框选择器 (包含 SCUT SSO 的常见ID)
-    un_selectors = ["#un", "#username", "#account", "input[name='username']", "input[name='account']"]
-    pd_selectors = ["#pd", "#password", "input[name='password']", "input[type='password']"]
-
+    # 账号密码框、按钮等候选选择器见 LOGIN_PAGE_STRATEGIES (包含 SCUT SSO 的常见ID)
     start_time = time.time()
-    last_action_time = 0
+    seq = 0
+    last_action = (None, None, 0)  # (动作, 页面, 时间)
 
-    # === 智能循环 ===
-    while time.time() - start_time < 60:
-        # 0. 降低循环频率
-        time.sleep(1)
+    # === 状态机：每次页面变化（DOM 变化 / 跳转）或 500ms 无事件时推进一步 ===
+    while time.time() - start_time < LOGIN_TIMEOUT:
+        if is_driver_killed(driver):
+            timer.finish("killed")
+            close_driver(driver)
+            return "error", "浏览器内存超限，已被结束"
 
-        # 1. 优先嗅探 Token
-        token = sniff_token(driver, timeout=0.5)
+        # 1. 优先检查网络日志中的 Token
+        token = _drain_token(driver)
         if token:
 #            add_log(f"🎉 [{username}] 成功获取 Token")
-            # --- 关键修改：获取 Cookies ---
-            # 稍作等待确保 Cookie 写入
-            time.sleep(0.5) 
-            cookies = {}
-            # 添加重试机制
-            for attempt in range(3):
-                try:
-                    time.sleep(0.3 * (attempt + 1))  # 递增延迟: 0.3s, 0.6s, 0.9s
-                    cookies = {c['name']: c['value'] for c in driver.get_cookies()}
-                    if cookies:  # 成功获取
-                        break
-                except Exception as e:
-                    if attempt == 2:  # 最后一次尝试失败
-                        add_log(f"⚠️ [{username}] Cookie获取失败（重试{attempt+1}次）: {e}")
+            timer.enter("cookies")
+            cookies = _collect_cookies(driver, username)
             
             close_driver(driver)
             
@@ -1038,70 +2389,61 @@ def execute_login_logic(username, password, driver=None):
                 "last_updated": time.time()
             }
             save_session(username, session_data)
+            timer.finish("success")
             
             return "success", {"token": token, "cookies": cookies, "user_agent": user_agent}
 
-        # 2. 检测 2FA 界面 (#PM1 是特定的验证码框ID)
-        # 直接进入验证码输入模式，让用户填写验证码
-        try:
-            if len(driver.find_elements(By.ID, "PM1")) > 0:
-                add_log(f"🔐 [{username}] 检测到二次验证界面，等待用户输入验证码...")
-                save_pending_driver(username, driver)  # ✅ 使用新函数（会关闭旧 driver）
-                return "need_2fa", "等待验证码"
-        except Exception as e2fa_err:
-            add_log(f"⚠️ [{username}] 2FA检测异常: {e2fa_err}")
-            pass
-
-
-        # 3. 页面动作 (每隔2秒执行一次，避免频繁操作)
-        if time.time() - last_action_time < 2:
-            continue
-
-        last_action_time = time.time()
-
-        # A. 检测 "校内账号登录" 并点击
-        if check_and_click_campus_login(driver):
-            # add_log("🔄 正在跳转...")
-            continue
-
-        # B. 检测 账号/密码 框
-        un_elem = find_visible_input(driver, un_selectors)
-        pd_elem = find_visible_input(driver, pd_selectors)
-
-        if un_elem and pd_elem:
-            # 获取当前值
-            curr_un = un_elem.get_attribute('value')
-            curr_pd = pd_elem.get_attribute('value')
-
-            # 填账号
-            if curr_un != username:
-#                add_log("⌨️  检测到账号框为空或不匹配，正在填充...")
-                fill_input_robust(driver, un_elem, username)
-
-            # 填密码
-            if curr_pd != password:
-#                add_log("⌨️  检测到密码框为空或不匹配，正在填充...")
-                fill_input_robust(driver, pd_elem, password)
-
-            # 如果都填好了，点击登录
-            # 重新获取值确认
-            if un_elem.get_attribute('value') == username and pd_elem.get_attribute('value') == password:
-                # add_log("🖱️ 凭证已填充，尝试点击登录按钮...")
-                if click_login_btn(driver):
-                    # add_log("⏳ 点击成功，等待页面跳转...")
-                    time.sleep(2)
-            continue
+        # 2. 一次 JS 探测拿到本轮需要的全部元素，避免逐个选择器往返
+        probe = probe_login_page(driver)
+        page = probe.get("fp")
+
+        # 检测 2FA 界面 (#PM1 是特定的验证码框ID)，直接进入验证码输入模式，让用户填写验证码
+        if probe.get("2fa"):
+            add_log(f"🔐 [{username}] 检测到二次验证界面，等待用户输入验证码...")
+            timer.finish("need_2fa")
+            if not save_pending_driver(username, driver):  # ✅ 使用新函数（会关闭旧 driver）
+                return "error", "等待验证码的用户过多，请稍后重新登录"
+            return "need_2fa", "等待验证码"
+
+        # 3. 根据页面状态执行动作；同一页面同一动作在生效前不重复执行
+        un_elem, pd_elem = probe.get("un"), probe.get("pd")
+        action = "campus" if probe.get("campus") else ("credentials" if un_elem and pd_elem else None)
+        repeated = action == last_action[0] and page == last_action[1] and time.time() - last_action[2] < LOGIN_ACTION_RETRY
+
+        if action == "campus" and not repeated:
+            # A. "校内账号登录" 选择页
+            timer.enter("campus")
+            check_and_click_campus_login(driver, probe)
+            last_action = (action, page, time.time())
+        elif action == "credentials" and not repeated:
+            # B. 账号/密码 框（探测结果已带当前值）
+            timer.enter("credentials")
+            un_ok = probe.get("un_value") == username or fill_input_robust(driver, un_elem, username)
+            pd_ok = probe.get("pd_value") == password or fill_input_robust(driver, pd_elem, password)
+            # 都填好了就点击登录（fill_input_robust 内部已校验并兜底 JS 赋值）
+            if un_ok and pd_ok and click_login_btn(driver, probe):
+                timer.enter("submit")
+            last_action = (action, page, time.time())
+        elif action is None and timer.phase not in ("open", "submit"):
+            # 页面跳转/加载中
+            timer.enter("redirect")
+
+        # 4. 等待下一次页面变化
+        seq = wait_for_page_event(driver, seq)
 
     # 超时
+    timer.finish("timeout")
     close_driver(driver)
     return "error", "Login Timeout (60s)"
 
 
 # --- 登录并发控制器 (新增) ---
+LOGIN_LOCK_TTL = 150  # 跨进程登录锁的最长持有时间（登录超时 60 秒 + 浏览器启动）
+
 class LoginCoordinator:
     def __init__(self):
         self._lock = threading.Lock()
-        self._active_logins = {}  # username -> {"event": Event, "result": None}
+        self._active_logins = {}  # (username, password) -> {"event": Event, "result": None}
 
     def login(self, username, password):
         """
@@ -1111,22 +2453,23 @@ class LoginCoordinator:
         must_login = False
         context = None
 
+        # 只和密码相同的请求共享结果
+        key = (username, password)
         with self._lock:
-            if username in self._active_logins:
+            if key in self._active_logins:
                 # 已经有任务在跑，搭便车
-                context = self._active_logins[username]
+                context = self._active_logins[key]
             else:
                 # 我是带头大哥
                 must_login = True
                 context = {"event": threading.Event(), "result": None}
-                self._active_logins[username] = context
+                self._active_logins[key] = context
         
         if must_login:
             try:
                 # 执行真正的登录逻辑
                 # add_log(f"⚡ [Coordinator] 线程 {threading.current_thread().name} 获得登录权")
-                status, res = execute_login_logic(username, password)
-                context["result"] = (status, res)
+                context["result"] = self._login_across_processes(username, password)
             except Exception as e:
                 context["result"] = ("error", str(e))
             finally:
@@ -1134,8 +2477,8 @@ class LoginCoordinator:
                 context["event"].set()
                 # 清理记录
                 with self._lock:
-                    if username in self._active_logins and self._active_logins[username] is context:
-                        del self._active_logins[username]
+                    if self._active_logins.get(key) is context:
+                        del self._active_logins[key]
             return context["result"]
         else:
             # 等待者
@@ -1143,6 +2486,39 @@ class LoginCoordinator:
             context["event"].wait()
             return context["result"]
 
+    def _login_across_processes(self, username, password):
+        """
+        多 worker 模式下用 Redis 锁保证同一用户同一时刻只有一个进程启动浏览器，
+        其他进程等待锁释放后直接读取结果（单 worker 时直接登录）
+        """
+        if not MULTI_WORKER:
+            return execute_login_logic(username, password)
+        lock_key = f"scut_order:login_lock:{username}"
+        # 结果只分享给密码相同的请求，密码错误的请求不能拿到别人的登录结果
+        pwd_hash = hashlib.sha256(f"{username}:{password}".encode()).hexdigest()[:32]
+        result_key = f"scut_order:login_result:{username}:{pwd_hash}"
+        owner = f"{ENGINE_NODE_ID}:{os.urandom(8).hex()}"
+        if redis_client.set(lock_key, owner, nx=True, ex=LOGIN_LOCK_TTL):
+            try:
+                status, res = execute_login_logic(username, password)
+                redis_client.set(result_key, json.dumps([status, res]), ex=60)
+                return status, res
+            finally:
+                # 只删除自己持有的锁（超时后锁可能已被其他进程重新获取）
+                try:
+                    _lease_release_script(keys=[lock_key], args=[owner])
+                except Exception:
+                    pass
+        # 其他进程正在登录，等待其结果
+        deadline = time.time() + LOGIN_LOCK_TTL
+        while time.time() < deadline and redis_client.exists(lock_key):
+            time.sleep(0.5)
+        raw = redis_client.get(result_key)
+        if raw:
+            status, res = json.loads(raw)
+            return status, res
+        return execute_login_logic(username, password)
+
 # 全局单例
 LOGIN_COORDINATOR = LoginCoordinator()
 
@@ -1150,6 +2526,383 @@ def deduplicated_login(username, password):
     """ 包装函数，供外部调用 """
     return LOGIN_COORDINATOR.login(username, password)
 
+def complete_2fa(username, code):
+    """
+    在持有 driver 的进程中提交验证码并嗅探 Token（阻塞，由 API 线程池或本机 RPC 调用）
+    使用期间 driver 标记为占用，不会被名额淘汰或超时清理关闭
+    """
+    driver = checkout_pending_driver(username)
+    
+    if not driver:
+        if get_pending_driver(username):
+            return {"status": "error", "msg": "验证码正在提交中，请稍候"}
+        return {"status": "error", "msg": "Session expired or browser closed"}
+    
+    try:
+        return _submit_2fa_code(username, driver, code)
+    finally:
+        checkin_pending_driver(username, driver)
+
+def _submit_2fa_code(username, driver, code):
+    """complete_2fa 的实现：填入验证码、点击登录并等待 Token"""
+    add_log(f"📨 [{username}] 提交验证码: {code}")
+    
+    try:
+        # 使用用户提供的特定 ID: #PM1
+        input_box = driver.find_element(By.ID, "PM1")
+        input_box.clear()
+        input_box.send_keys(code)
+        add_log(f"✅ [{username}] 验证码已填入")
+        
+        # 尝试点击登录
+        clicked = False
+        try:
+            # 1. 尝试 input
+            btn = driver.find_element(By.CSS_SELECTOR, "#index_login_btn > input")
+            btn.click()
+            clicked = True
+            add_log(f"✅ [{username}] 点击登录按钮 (方式1)")
+        except:
+            try:
+                # 2. 尝试 span 容器
+                btn = driver.find_element(By.ID, "index_login_btn")
+                btn.click()
+                clicked = True
+                add_log(f"✅ [{username}] 点击登录按钮 (方式2)")
+            except:
+                # 3. JS 强制点击
+                try:
+                    btn = driver.find_element(By.CSS_SELECTOR, ".login_box_landing_btn")
+                    driver.execute_script("arguments[0].click();", btn)
+                    clicked = True
+                    add_log(f"✅ [{username}] 点击登录按钮 (方式3-JS)")
+                except: pass
+        
+        if not clicked:
+            add_log(f"⚠️ [{username}] 无法找到登录提交按钮")
+            return {"status": "error", "msg": "无法找到登录提交按钮"}
+        
+        # 等待页面跳转 (关键！)
+        add_log(f"⏳ [{username}] 等待页面跳转...")
+        time.sleep(2)  # 先等待 2 秒让页面跳转
+        
+        # 检查是否出现"校内账号登录"选择页面
+        for _ in range(3):  # 最多检测 3 次
+            current_url = driver.current_url
+            add_log(f"📍 [{username}] 当前页面: {current_url}")
+            
+            # 尝试检测并点击"校内账号登录"
+            if check_and_click_campus_login(driver):
+                add_log(f"👆 [{username}] 检测到账号类型选择页面，点击'校内账号登录'")
+                time.sleep(2)  # 等待跳转
+            else:
+                # 没有检测到选择页面，跳出循环
+                break
+        
+        # 再次检查当前页面
+        current_url = driver.current_url
+        add_log(f"📍 [{username}] 最终页面: {current_url}")
+        
+        # 如果已经跳转到 booking 页面，说明登录成功，开始嗅探 Token
+        # 增加嗅探时间到 30 秒
+        add_log(f"🔍 [{username}] 开始嗅探 Token (30s)...")
+        token = sniff_token(driver, 30)
+
+        
+        if token:
+            # 提取 Cookies
+            cookies = {}
+            try:
+                cookies = {c['name']: c['value'] for c in driver.get_cookies()}
+                add_log(f"🍪 [{username}] 获取到 {len(cookies)} 个 Cookies")
+            except Exception as cookie_err:
+                add_log(f"⚠️ [{username}] Cookies 提取失败: {cookie_err}")
+            
+            close_driver(driver)
+            # 移除 pending (使用新函数)
+            remove_pending_driver(username)
+            
+            # 更新 Session (保存到 Redis)
+            existing = get_session(username) or {}
+            session_data = {
+                "token": token,
+                "cookies": cookies,
+                "last_updated": time.time(),
+                "password": existing.get("password"),
+                "email": existing.get("email"),
+                "user_agent": existing.get("user_agent")
+            }
+            save_session(username, session_data)
+            
+            add_log(f"🎉 [{username}] 验证成功，已登录")
+            add_log(f"🔑 Token: {token[:50]}...")
+            return {"status": "success", "token": token}
+        else:
+            # Token 未捕获，尝试刷新页面触发新请求
+            add_log(f"⚠️ [{username}] 首次嗅探失败，尝试刷新页面...")
+            try:
+                driver.get("https://venue.spe.scut.edu.cn/vb-user/booking")
+                time.sleep(2)
+                token = sniff_token(driver, 10)
+                if token:
+                    cookies = {c['name']: c['value'] for c in driver.get_cookies()}
+                    close_driver(driver)
+                    # 移除 pending (使用新函数)
+                    remove_pending_driver(username)
+                    # 保存到 Redis
+                    existing = get_session(username) or {}
+                    session_data = {
+                        "token": token, "cookies": cookies,
+                        "last_updated": time.time(),
+                        "password": existing.get("password"),
+                        "email": existing.get("email"),
+                        "user_agent": existing.get("user_agent")
+                    }
+                    save_session(username, session_data)
+                    add_log(f"🎉 [{username}] 刷新后获取 Token 成功")
+                    return {"status": "success", "token": token}
+            except Exception as refresh_err:
+                add_log(f"⚠️ 刷新尝试失败: {refresh_err}")
+            
+            add_log(f"❌ [{username}] 2FA 验证后未检测到 Token (超时)")
+            return {"status": "error", "msg": "验证超时或失败，请重新登录"}
+    
+    except Exception as e:
+        add_log(f"❌ 2FA Error: {e}")
+        return {"status": "error", "msg": str(e)}
+
+# --- 上游限流 (全局令牌桶，跨进程共享) ---
+# 所有发往学校接口的请求先经过 acquire_upstream_slot()：
+# - 全局令牌桶：限制整个系统的总请求速率
+# - 优先级：低优先级请求必须给高优先级保留一部分令牌（续订 > 月场 > 捡漏 > 页面查询）
+# - 用户公平：每个用户再有一个较小的令牌桶，避免单个用户挤占全局额度（续订不受此限制）
+PRIORITY_RENEW = "renew"
+PRIORITY_MONTHLY = "monthly"
+PRIORITY_SNIPE = "snipe"
+PRIORITY_UI = "ui"
+
+UPSTREAM_RATE = float(os.environ.get("UPSTREAM_RATE", 20))          # 全局每秒请求数
+UPSTREAM_BURST = float(os.environ.get("UPSTREAM_BURST", 40))        # 全局桶容量
+UPSTREAM_USER_RATE = float(os.environ.get("UPSTREAM_USER_RATE", 3)) # 单用户每秒请求数
+UPSTREAM_USER_BURST = float(os.environ.get("UPSTREAM_USER_BURST", 6))
+
+# 各优先级：(需为更高优先级保留的桶容量比例, 最长等待秒数, 超时后是否仍放行)
+PRIORITY_POLICY = {
+    PRIORITY_RENEW:   (0.0,  0.5, True),
+    PRIORITY_MONTHLY: (0.1,  1.0, True),
+    PRIORITY_SNIPE:   (0.25, 5.0, False),
+    PRIORITY_UI:      (0.5, 10.0, False),
+}
+
+_TOKEN_BUCKET_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local function take(key, rate, burst, reserve)
+    local v = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(v[1]) or burst
+    local ts = tonumber(v[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    local need = 1 + reserve
+    if tokens < need then
+        return tokens, (need - tokens) / rate
+    end
+    return tokens, 0
+end
+local g_rate, g_burst, reserve = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local u_rate, u_burst = tonumber(ARGV[4]), tonumber(ARGV[5])
+local g_tokens, g_wait = take(KEYS[1], g_rate, g_burst, reserve)
+local u_tokens, u_wait = 0, 0
+if u_rate > 0 then
+    u_tokens, u_wait = take(KEYS[2], u_rate, u_burst, 0)
+end
+local wait = math.max(g_wait, u_wait)
+if wait > 0 then
+    return tostring(wait)
+end
+redis.call('HSET', KEYS[1], 'tokens', g_tokens - 1, 'ts', now)
+redis.call('EXPIRE', KEYS[1], 60)
+if u_rate > 0 then
+    redis.call('HSET', KEYS[2], 'tokens', u_tokens - 1, 'ts', now)
+    redis.call('EXPIRE', KEYS[2], 60)
+end
+return '0'
+"""
+_token_bucket_script = redis_client.register_script(_TOKEN_BUCKET_LUA)
+GOVERNOR_METRICS_KEY = "scut_order:ratelimit:metrics"
+
+def _record_governor_wait(priority, waited, timed_out):
+    try:
+        if waited < 0.01: bucket = "lt10ms"
+        elif waited < 0.1: bucket = "lt100ms"
+        elif waited < 1: bucket = "lt1s"
+        else: bucket = "ge1s"
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hincrby(GOVERNOR_METRICS_KEY, f"{priority}:count", 1)
+        pipe.hincrbyfloat(GOVERNOR_METRICS_KEY, f"{priority}:wait_total", waited)
+        pipe.hincrby(GOVERNOR_METRICS_KEY, f"{priority}:{bucket}", 1)
+        if timed_out:
+            pipe.hincrby(GOVERNOR_METRICS_KEY, f"{priority}:timeout", 1)
+        pipe.execute()
+    except Exception:
+        pass
+
+def acquire_upstream_slot(priority=PRIORITY_UI, username=None):
+    """
+    获取一次上游请求许可（阻塞等待，最长等待时间由优先级决定）
+    返回 True 表示可以发送；False 表示等待超时且该优先级不允许强行发送
+    Redis 不可用时直接放行
+    """
+    reserve_ratio, max_wait, pass_on_timeout = PRIORITY_POLICY.get(priority, PRIORITY_POLICY[PRIORITY_UI])
+    reserve = UPSTREAM_BURST * reserve_ratio
+    # 续订不占用用户额度，保证续订永远优先
+    user_rate = 0 if (priority == PRIORITY_RENEW or not username) else UPSTREAM_USER_RATE
+    user_key = f"scut_order:ratelimit:user:{username or '-'}"
+
+    start = time.time()
+    while True:
+        try:
+            wait = float(_token_bucket_script(
+                keys=["scut_order:ratelimit:global", user_key],
+                args=[UPSTREAM_RATE, UPSTREAM_BURST, reserve, user_rate, UPSTREAM_USER_BURST]
+            ))
+        except Exception:
+            return True
+        waited = time.time() - start
+        if wait <= 0:
+            _record_governor_wait(priority, waited, False)
+            return True
+        if waited + wait > max_wait:
+            _record_governor_wait(priority, waited, True)
+            return pass_on_timeout
+        time.sleep(wait + random.uniform(0, 0.02))
+
+def get_governor_metrics():
+    """按优先级汇总限流等待指标"""
+    try:
+        raw = redis_client.hgetall(GOVERNOR_METRICS_KEY)
+    except Exception:
+        return {}
+    metrics = {}
+    for k, v in raw.items():
+        priority, _, field = k.partition(":")
+        metrics.setdefault(priority, {})[field] = float(v)
+    for m in metrics.values():
+        if m.get("count"):
+            m["wait_avg"] = m.get("wait_total", 0) / m["count"]
+    return metrics
+
+# --- 上游错误分类与熔断 ---
+# 错误分为四类，只有传输失败和服务端错误会计入熔断：
+# - transport: 超时 / 连接失败
+# - server:    HTTP 5xx / 429
+# - auth:      返回 HTML 登录页 / 401 / 403（走救援流程）
+# - business:  接口正常返回但业务拒绝（场地已被订等），保持快速重试
+UPSTREAM_OK = "ok"
+UPSTREAM_ERR_TRANSPORT = "transport"
+UPSTREAM_ERR_SERVER = "server"
+UPSTREAM_ERR_AUTH = "auth"
+UPSTREAM_ERR_BUSINESS = "business"
+
+def classify_upstream_response(resp):
+    """根据 HTTP 响应判断错误类型（业务层成功与否由调用方结合 JSON 判断）"""
+    if resp.status_code >= 500 or resp.status_code == 429:
+        return UPSTREAM_ERR_SERVER
+    content_type = resp.headers.get('Content-Type', '').lower()
+    if resp.status_code in (401, 403) or 'text/html' in content_type:
+        return UPSTREAM_ERR_AUTH
+    if resp.status_code != 200:
+        return UPSTREAM_ERR_BUSINESS
+    return UPSTREAM_OK
+
+
+class CircuitBreaker:
+    """
+    单个上游接口的熔断器
+    - 连续 failure_threshold 次传输/服务端错误 → 打开，期间直接拒绝请求
+    - 打开时长按跳闸次数指数增长（带抖动），到期后放行一个探测请求（半开）
+    - 探测成功 → 关闭并重置；失败 → 再次打开
+    - 续订请求不受熔断限制（它们最重要，且频率本身很低）
+    """
+    def __init__(self, name, failure_threshold=5, base_open=2.0, max_open=60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_open = base_open
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._failures = 0        # 连续失败次数
+        self._trips = 0           # 连续跳闸次数
+        self._open_until = 0
+        self._probe_at = 0        # 半开探测请求的发出时间（0 表示没有探测）
+
+    def allow(self, priority=None):
+        if priority == PRIORITY_RENEW:
+            return True
+        with self._lock:
+            if self._open_until == 0:
+                return True
+            now = time.time()
+            # 探测请求可能因限流等原因没有真正发出，10 秒后允许新的探测
+            if now < self._open_until or now - self._probe_at < 10:
+                return False
+            self._probe_at = now  # 半开：只放行一个探测
+            return True
+
+    def record(self, result):
+        tripped = None
+        with self._lock:
+            if result in (UPSTREAM_ERR_TRANSPORT, UPSTREAM_ERR_SERVER):
+                self._failures += 1
+                if self._probe_at or self._failures >= self.failure_threshold:
+                    self._trips += 1
+                    open_for = min(self.max_open, self.base_open * (2 ** (self._trips - 1)))
+                    self._open_until = time.time() + open_for * random.uniform(0.8, 1.2)
+                    tripped = (open_for, self._trips)
+                self._probe_at = 0
+            else:
+                # 成功或业务拒绝都说明接口可用
+                self._failures = 0
+                self._trips = 0
+                self._open_until = 0
+                self._probe_at = 0
+        # add_log 会访问 Redis，放到锁外
+        if tripped:
+            add_log(f"⚡ 上游接口 {self.name} 熔断 {tripped[0]:.0f}s (第 {tripped[1]} 次)")
+
+    def retry_delay(self, default, cap=None):
+        """
+        调用方失败后应等待的时间：
+        接口健康（或仅业务拒绝）时返回 default，否则按连续失败次数指数退避（带抖动）
+        """
+        with self._lock:
+            failures = self._failures
+            remaining = max(0, self._open_until - time.time())
+        if failures == 0 and remaining == 0:
+            return default
+        backoff = min(self.max_open, 0.5 * (2 ** max(0, failures - 1)))
+        delay = max(default, backoff, remaining)
+        if cap is not None:
+            delay = min(delay, cap)
+        return delay * random.uniform(0.8, 1.2)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "state": "closed" if self._open_until == 0 else ("half_open" if time.time() >= self._open_until else "open"),
+                "failures": self._failures,
+                "trips": self._trips,
+                "open_remaining": max(0, round(self._open_until - time.time(), 1)),
+            }
+
+
+UPSTREAM_BREAKERS = {
+    "booking": CircuitBreaker("booking"),   # 场地查询
+    "apply": CircuitBreaker("apply"),       # 预定 / 续订
+    "orders": CircuitBreaker("orders"),     # 订单查询
+}
+
+def get_breaker_states():
+    return {name: b.snapshot() for name, b in UPSTREAM_BREAKERS.items()}
+
 def ms_to_dt(ms):
     try: return datetime.datetime.fromtimestamp(ms / 1000).strftime("%Y-%m-%d %H:%M:%S")
     except: return ""
@@ -1178,20 +2931,21 @@ def _normalize_order_records(payload):
                 "price": float(o.get("receivable") or o.get("receipts") or o.get("amount") or 0),
                 "orderNo": o.get("orderNo"),
                 "statusDesc": o.get("statusDesc") or o.get("statusName") or o.get("status") or "",
-                "createdAt": ms_to_dt(o.get("createdAt"))
+                "createdAt": ms_to_dt(o.get("createdAt")),
+                "createdAtMs": int(o.get("createdAt") or 0)
             })
     data = payload.get("data")
     if isinstance(data, dict):
         return {"records": records, "page": data.get("page"), "total": data.get("total")}
     return {"records": records}
 
-def fetch_orders_internal(token, status_value, page=1, page_size=10, cookies=None, username=None):
+def fetch_orders_internal(token, status_value, page=1, page_size=10, cookies=None, username=None, priority=PRIORITY_UI):
     """
     查询订单列表（四种状态），对齐用户提供的抓包脚本：
     GET https://venue.spe.scut.edu.cn/api/pc/order/rental/orders/page
     参数：page, pageSize, status （status 为单个整数：1/2/3/4）
     """
-    url = "https://venue.spe.scut.edu.cn/api/pc/order/rental/orders/page"
+    url = f"{UPSTREAM_BASE}/api/pc/order/rental/orders/page"
 
     headers = {
         "accept": "application/json, text/plain, */*",
@@ -1203,8 +2957,22 @@ def fetch_orders_internal(token, status_value, page=1, page_size=10, cookies=Non
 
     params = {"page": int(page), "pageSize": int(page_size), "status": int(status_value)}
 
+    breaker = UPSTREAM_BREAKERS["orders"]
+    used_creds = [token, cookies]  # 最后一次请求使用的凭证（救援后为新凭证）
+
     def _do_request(tok, ck):
-        return requests.get(url, headers={**headers, "authorization": f"Bearer {tok}"}, params=params, cookies=ck, timeout=15)
+        used_creds[:] = [tok, ck]
+        if not breaker.allow(priority):
+            raise RuntimeError("订单接口熔断中，请稍后重试")
+        if not acquire_upstream_slot(priority, username):
+            raise RuntimeError("上游限流，请稍后重试")
+        try:
+            r = requests.get(url, headers={**headers, "authorization": f"Bearer {tok}"}, params=params, cookies=ck, timeout=15)
+        except requests.RequestException:
+            breaker.record(UPSTREAM_ERR_TRANSPORT)
+            raise
+        breaker.record(classify_upstream_response(r))
+        return r
 
     try:
         # 1) 首次请求
@@ -1245,26 +3013,28 @@ def fetch_orders_internal(token, status_value, page=1, page_size=10, cookies=Non
 
         payload = resp.json()
         # 兼容 code=1 或 code=200
-        if payload.get("code") not in (1, 200) and payload.get("status") not in ("success",):
+        if not _payload_confirms_token(payload):
             # 有些接口会用 msg/状态说明
             return None
 
+        mark_token_valid(*used_creds)
         return _normalize_order_records(payload)
 
     except Exception as e:
         add_log(f"❌ 订单查询异常: {e}")
         return None
 
-def fetch_venue_data(token, date_str, cookies=None, username=None, user_agent=None):
+def fetch_venue_data(token, date_str, cookies=None, username=None, user_agent=None, priority=PRIORITY_UI):
     """
     使用 chaxun.txt 的逻辑进行数据查询，支持 Cookie 和 自动救援
     参数:
         cookies: 必须传入，学校后端同时验证 Token + Cookie
         user_agent: 可选，传入特定UA以保持一致性
+        priority: 上游限流优先级
     """
     dt = datetime.datetime.strptime(date_str, "%Y-%m-%d")
     ts = int(dt.replace(hour=0,minute=0,second=0).timestamp() * 1000)
-    url = "https://venue.spe.scut.edu.cn/api/pc/venue/pc/booking"
+    url = f"{UPSTREAM_BASE}/api/pc/venue/pc/booking"
     
     # 使用传入的UA或默认UA
     ua = user_agent or "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/144.0.0.0 Safari/537.36"
@@ -1288,7 +3058,17 @@ def fetch_venue_data(token, date_str, cookies=None, username=None, user_agent=No
     try:
         # 1. 尝试第一次请求（需要 Token + Cookie 同时验证）
         # print(f"DEBUG: fetch_venue_data calling requests.post... token={token[:10]}...", flush=True)
-        resp = requests.post(url, headers=headers, json=payload, cookies=cookies, timeout=8)
+        breaker = UPSTREAM_BREAKERS["booking"]
+        if not breaker.allow(priority):
+            return None
+        if not acquire_upstream_slot(priority, username):
+            return None
+        try:
+            resp = requests.post(url, headers=headers, json=payload, cookies=cookies, timeout=8)
+        except requests.RequestException:
+            breaker.record(UPSTREAM_ERR_TRANSPORT)
+            raise
+        breaker.record(classify_upstream_response(resp))
         # print(f"DEBUG: fetch_venue_data response: {resp.status_code}", flush=True)
         
         # 2. 核心救援逻辑：检测是否返回了 HTML (登录页)
@@ -1339,13 +3119,20 @@ def fetch_venue_data(token, date_str, cookies=None, username=None, user_agent=No
                             add_log("✅ 救援成功！使用新凭证重试请求...")
                             # 使用新凭证重试
                             headers["authorization"] = f"Bearer {new_token}"
+                            if not acquire_upstream_slot(priority, username):
+                                # 新凭证已写入 Redis，下一轮查询直接使用即可
+                                add_log(f"⏳ [{username}] 上游限流，救援后的重试推迟到下一轮")
+                                return None
                             resp = requests.post(url, headers=headers, json=payload, cookies=new_cookies, timeout=8)
                             
                             # 立即解析结果
                             if resp.status_code == 200:
                                 res_json = resp.json()
                                 if (res_json.get("code") == 1 or res_json.get("code") == 200) and "data" in res_json:
-                                    return res_json["data"].get("venueSessionResponses", [])
+                                    sessions = res_json["data"].get("venueSessionResponses", [])
+                                    publish_venue_snapshot(date_str, sessions)
+                                    mark_token_valid(new_token, new_cookies)
+                                    return sessions
                         elif status == "need_2fa":
                             # 新增：救援需要 2FA 验证，返回特殊标记让前端处理
                             add_log(f"⚠️ [{username}] 救援需要 2FA 验证，等待用户输入...")
@@ -1365,29 +3152,176 @@ def fetch_venue_data(token, date_str, cookies=None, username=None, user_agent=No
                 res_json = resp.json()
                 # print(f"DEBUG: fetch_venue_data json: {str(res_json)[:100]}", flush=True)
                 if (res_json.get("code") == 1 or res_json.get("code") == 200) and "data" in res_json:
-                    return res_json["data"].get("venueSessionResponses", [])
+                    sessions = res_json["data"].get("venueSessionResponses", [])
+                    publish_venue_snapshot(date_str, sessions)
+                    mark_token_valid(token, cookies)
+                    return sessions
             except:
                 pass # JSON 解析失败，或者仍然是 HTML
                 
     except Exception as e:
         add_log(f"❌ 数据查询异常: {e}")
     return None
-def check_token_validity(token, cookies=None, username=None, user_agent=None):
+# --- Token 有效性 ---
+# 最近一次成功的上游 JSON 响应即可证明 (Token, Cookie) 有效：在 Redis 记录一个短 TTL 标记，
+# 缓存登录、锁场任务、月场开抢前的校验直接命中，不再请求上游；未命中时用 pageSize=1 的订单接口轻量探测
+TOKEN_VALID_TTL = int(os.environ.get("TOKEN_VALID_TTL", 60))
+TOKEN_VALID_PREFIX = "scut_order:token_ok:"
+
+def _credential_fingerprint(token, cookies):
+    raw = (token or "") + "|" + json.dumps(cookies or {}, sort_keys=True)
+    return hashlib.md5(raw.encode()).hexdigest()
+
+def _payload_confirms_token(payload):
+    """上游业务码为 1/200（或 status=success）才能证明凭证有效"""
+    return isinstance(payload, dict) and (payload.get("code") in (1, 200) or payload.get("status") == "success")
+
+def mark_token_valid(token, cookies):
+    """上游确认凭证有效（见 _payload_confirms_token）：记录该凭证近期有效"""
+    if not token:
+        return
+    try:
+        redis_client.set(TOKEN_VALID_PREFIX + _credential_fingerprint(token, cookies), 1, ex=TOKEN_VALID_TTL)
+    except Exception:
+        pass
+
+def _token_recently_valid(token, cookies):
+    try:
+        return bool(redis_client.exists(TOKEN_VALID_PREFIX + _credential_fingerprint(token, cookies)))
+    except Exception:
+        return False
+
+def _forget_token(token, cookies):
+    try:
+        redis_client.delete(TOKEN_VALID_PREFIX + _credential_fingerprint(token, cookies))
+    except Exception:
+        pass
+
+def probe_token(token, cookies=None, user_agent=None, priority=PRIORITY_UI):
+    """
+    轻量探测：查询 1 条订单
+    返回 True（有效）/ False（被重定向到登录页或 401/403）/ None（熔断、限流或网络问题，无法判断）
+    """
+    url = f"{UPSTREAM_BASE}/api/pc/order/rental/orders/page"
+    headers = {
+        "accept": "application/json, text/plain, */*",
+        "authorization": f"Bearer {token}",
+        "user-agent": user_agent or "Mozilla/5.0",
+        "origin": "https://venue.spe.scut.edu.cn",
+        "referer": "https://venue.spe.scut.edu.cn/vb-user/booking",
+    }
+    breaker = UPSTREAM_BREAKERS["orders"]
+    if not breaker.allow(priority) or not acquire_upstream_slot(priority, None):
+        return None
+    try:
+        resp = UPSTREAM_HTTP.get(url, headers=headers, params={"page": 1, "pageSize": 1, "status": 1}, cookies=cookies, timeout=5)
+    except requests.RequestException:
+        breaker.record(UPSTREAM_ERR_TRANSPORT)
+        return None
+    result = classify_upstream_response(resp)
+    breaker.record(result)
+    if result == UPSTREAM_ERR_AUTH:
+        return False
+    if result != UPSTREAM_OK:
+        return None
+    try:
+        payload = resp.json()
+    except ValueError:
+        return None
+    if _payload_confirms_token(payload):
+        return True
+    return None
+
+def check_token_validity(token, cookies=None, username=None, user_agent=None, priority=PRIORITY_UI):
     """
-    检查 Token + Cookie 是否仍可用于获取订场数据（通过 booking 接口探测）。
+    检查 Token + Cookie 是否仍可用于获取订场数据。
     注意：学校后端同时验证 Token 和 Cookie，两者都需要有效
+    返回三态，由调用方决定如何处理无法判断的情况:
+        True:  有正面证据（近期有效标记，或上游返回 code 1/200）
+        False: 上游明确拒绝（跳转登录页 / 401 / 403），且未能救援
+        None:  无法判断（熔断、限流、网络异常、无法识别的响应），不能当作有效
     参数:
+        username: 传入时失效会通过 fetch_venue_data 触发自动救援
         user_agent: 传入UA以保持与login时一致
     """
     try:
+        # 1. 近期有成功的上游响应：直接视为有效
+        if _token_recently_valid(token, cookies):
+            return True
+        # 2. 轻量探测
+        valid = probe_token(token, cookies, user_agent, priority)
+        if valid:
+            mark_token_valid(token, cookies)
+            return True
+        if valid is False:
+            _forget_token(token, cookies)
+            if not username:
+                return False
+        # 3. 无法判断或需要救援：回退到 booking 接口（带 username 时会自动救援，成功时会标记凭证有效）
         today = datetime.datetime.now().strftime("%Y-%m-%d")
-        sessions = fetch_venue_data(token, today, cookies, username=username, user_agent=user_agent)
-        # fetch_venue_data 失败时返回 None
-        # print(f"DEBUG: check_token_validity result: {sessions is not None}", flush=True)
-        return sessions is not None
-    except:
-        # print("DEBUG: check_token_validity exception", flush=True)
-        return False
+        sessions = fetch_venue_data(token, today, cookies, username=username, user_agent=user_agent, priority=priority)
+        if isinstance(sessions, list):
+            return True
+        # 已确认失效且救援没有成功：仍是失效；否则无法判断
+        return False if valid is False else None
+    except Exception as e:
+        add_log(f"⚠️ Token 校验异常: {e}")
+        return None
+
+# --- 预定请求对冲 (Hedging) ---
+# 续订窗口只有 30 秒，单个慢请求（5 秒超时）会拖住整轮续订。
+# 对冲：首个请求超过近期 p95 耗时仍未返回，就用连接池里的另一条连接再发一次。
+HEDGE_ENABLED = os.environ.get("BOOKING_HEDGE", "true").lower() != "false"
+HEDGE_MIN_DELAY = 0.3
+HEDGE_MAX_DELAY = 2.0
+HEDGE_METRICS_KEY = "scut_order:hedge:metrics"
+_APPLY_LATENCIES = collections.deque(maxlen=200)
+_APPLY_LATENCY_LOCK = threading.Lock()
+# 首个请求和对冲请求分池：对冲请求堆积时不会让首个请求排队
+_HEDGE_PRIMARY_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("HEDGE_WORKERS", 16)), thread_name_prefix="HedgePrimary")
+_HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("HEDGE_WORKERS", 16)), thread_name_prefix="Hedge")
+
+# 预定接口共用的连接池（keep-alive），对冲请求会使用池中另一条连接
+# 禁止 Session 保存响应 Cookie，避免不同用户之间串 Cookie
+UPSTREAM_HTTP = requests.Session()
+UPSTREAM_HTTP.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+UPSTREAM_HTTP.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+def _record_apply_latency(seconds):
+    with _APPLY_LATENCY_LOCK:
+        _APPLY_LATENCIES.append(seconds)
+
+def get_hedge_delay():
+    """对冲延迟：近期预定请求耗时的 p95（样本不足时取 1 秒）"""
+    with _APPLY_LATENCY_LOCK:
+        samples = sorted(_APPLY_LATENCIES)
+    if len(samples) < 20:
+        return 1.0
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, p95))
+
+def _incr_hedge_metric(field):
+    try:
+        redis_client.hincrby(HEDGE_METRICS_KEY, field, 1)
+    except Exception:
+        pass
+
+def _check_hedge_duplicate(future, desc):
+    try:
+        if future.result()[0]:
+            _incr_hedge_metric("duplicates")
+            add_log(f"⚠️ [Hedge] 对冲请求均成功，可能产生重复订单: {desc}，请检查订单列表")
+    except Exception:
+        pass
+
+def get_hedge_metrics():
+    try:
+        raw = redis_client.hgetall(HEDGE_METRICS_KEY)
+        metrics = {k: int(v) for k, v in raw.items()}
+    except Exception:
+        metrics = {}
+    metrics["delay"] = round(get_hedge_delay(), 3)
+    return metrics
 
 def get_booking_params(date_str):
     dt = datetime.datetime.strptime(date_str, "%Y-%m-%d")
@@ -1397,19 +3331,10 @@ def get_booking_params(date_str):
     weekday = dt.isoweekday()
     return timestamp, weekday
 
-def send_booking_request(token, user_id, date_str, start_time, end_time, venue_id, price=40, stadium_id=1, cookies=None, user_agent=None):
-    """
-    发送预定请求
-    注意：学校后端同时验证 Token + Cookie，必须传入 cookies
-    返回: (成功/失败, 消息, 新Cookie字典或None)
-    """
-    belong_date, week = get_booking_params(date_str)
-    url = "https://venue.spe.scut.edu.cn/api/pc/order/rental/orders/apply"
-
+def _apply_headers(token, user_agent=None):
     # 使用传入的UA，如果没有则使用默认值
     ua = user_agent or "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/143.0.0.0 Safari/537.36"
-    
-    headers = {
+    return {
         "authorization": f"Bearer {token}",
         "content-type": "application/json",
         "user-agent": ua,
@@ -1417,35 +3342,208 @@ def send_booking_request(token, user_id, date_str, start_time, end_time, venue_i
         "referer": "https://venue.spe.scut.edu.cn/vb-user/booking"
     }
 
+def _rental(date_str, start_time, end_time, venue_id):
+    belong_date, week = get_booking_params(date_str)
+    return {
+        "belongDate": belong_date,
+        "week": week,
+        "start": start_time,
+        "end": end_time,
+        "venueId": int(venue_id)
+    }
+
+def _post_apply(token, user_id, rentals, receipts, stadium_id=1, cookies=None, user_agent=None, priority=PRIORITY_SNIPE, username=None):
+    """
+    向预定接口发送一次 apply 请求（rentals 可包含多个场次）
+    返回: (成功/失败, 消息, 结果分类)；分类为 UPSTREAM_* 常量，本地熔断/限流拒绝时为 None
+    """
+    url = f"{UPSTREAM_BASE}/api/pc/order/rental/orders/apply"
     payload = {
         "userId": user_id,
-        "receipts": price,
+        "receipts": receipts,
         "buyerSource": 4,
         "stadiumId": stadium_id,
         "mode": "week",
-        "rentals": [{
-            "belongDate": belong_date,
-            "week": week,
-            "start": start_time,
-            "end": end_time,
-            "venueId": int(venue_id)
-        }]
+        "rentals": rentals
     }
 
     try:
+        breaker = UPSTREAM_BREAKERS["apply"]
+        if not breaker.allow(priority):
+            return False, "预定接口熔断中，请稍后重试", None
+        if not acquire_upstream_slot(priority, username):
+            return False, "上游限流，请稍后重试", None
         # 必须同时使用 Token + Cookie（学校后端验证需要）
-        resp = requests.post(url, headers=headers, json=payload, cookies=cookies, timeout=5)
-        if resp.status_code == 200:
+        try:
+            req_start = time.time()
+            resp = UPSTREAM_HTTP.post(url, headers=_apply_headers(token, user_agent), json=payload, cookies=cookies, timeout=5)
+            _record_apply_latency(time.time() - req_start)
+        except requests.RequestException as e:
+            if isinstance(e, requests.Timeout):
+                # 超时也计入耗时窗口，否则上游变慢时 p95 反而偏低
+                _record_apply_latency(time.time() - req_start)
+            breaker.record(UPSTREAM_ERR_TRANSPORT)
+            return False, str(e), UPSTREAM_ERR_TRANSPORT
+        result = classify_upstream_response(resp)
+        if result == UPSTREAM_OK:
             res_json = resp.json()
+            if _payload_confirms_token(res_json):
+                mark_token_valid(token, cookies)
             if res_json.get("code") == 200 or "成功" in str(res_json):
+                breaker.record(UPSTREAM_OK)
                 # 注意:学校后端在续订成功时不返回Set-Cookie头
                 # 只能通过定期重新登录来刷新Cookie
-                return True, "预定成功", None  # 第三个参数保持None
-            return False, res_json.get("msg", str(res_json)), None
-        return False, f"HTTP {resp.status_code}", None
+                return True, "预定成功", UPSTREAM_OK
+            breaker.record(UPSTREAM_ERR_BUSINESS)
+            return False, res_json.get("msg", str(res_json)), UPSTREAM_ERR_BUSINESS
+        breaker.record(result)
+        return False, f"HTTP {resp.status_code}", result
     except Exception as e:
         return False, str(e), None
 
+def _send_booking_once(token, user_id, date_str, start_time, end_time, venue_id, price=40, stadium_id=1, cookies=None, user_agent=None, priority=PRIORITY_SNIPE, username=None):
+    """
+    发送一次预定请求（send_booking_request 的单次实现）
+    返回: (成功/失败, 消息, None)
+    """
+    ok, msg, _ = _post_apply(
+        token, user_id, [_rental(date_str, start_time, end_time, venue_id)], price,
+        stadium_id, cookies, user_agent, priority, username
+    )
+    return ok, msg, None  # 第三个参数保持None
+
+def _hedged_call(fn, args, desc):
+    """
+    对冲执行 fn(*args)：超过 p95 耗时仍未返回时再发一次，取先成功的结果
+    fn 返回值的第一个元素表示是否成功
+    """
+    first = _HEDGE_PRIMARY_EXECUTOR.submit(fn, *args)
+    done, _ = wait([first], timeout=get_hedge_delay())
+    if done:
+        return first.result()
+
+    # 首个请求超时未返回，发出对冲请求
+    _incr_hedge_metric("fired")
+    pending = {first, _HEDGE_EXECUTOR.submit(fn, *args)}
+    first_failure = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = None
+        for f in done:
+            res = f.result()
+            if not res[0]:
+                first_failure = first_failure or res
+            elif winner is None:
+                winner = f
+            else:
+                # 两个请求在同一轮一起成功
+                _check_hedge_duplicate(f, desc)
+        if winner is not None:
+            # 另一请求若稍后也成功，说明产生了重复订单
+            for other in pending:
+                other.add_done_callback(lambda fut, d=desc: _check_hedge_duplicate(fut, d))
+            if winner is not first:
+                _incr_hedge_metric("won")
+            return winner.result()
+    return first_failure
+
+def send_booking_request(token, user_id, date_str, start_time, end_time, venue_id, price=40, stadium_id=1, cookies=None, user_agent=None, priority=PRIORITY_SNIPE, username=None, hedge=False):
+    """
+    发送预定请求
+    注意：学校后端同时验证 Token + Cookie，必须传入 cookies
+    priority/username: 上游限流的优先级和计费用户（锁场续订请传 PRIORITY_RENEW）
+    hedge: 开启请求对冲。首个请求超过 p95 耗时仍未返回时，在另一条连接上再发一次，
+           取先成功的结果；两次都成功会记录为重复预定
+    返回: (成功/失败, 消息, 新Cookie字典或None)
+    """
+    args = (token, user_id, date_str, start_time, end_time, venue_id, price, stadium_id, cookies, user_agent, priority, username)
+    if not (hedge and HEDGE_ENABLED):
+        return _send_booking_once(*args)
+    return _hedged_call(_send_booking_once, args, f"{username or user_id} {date_str} {start_time} 场地{venue_id}")
+
+# --- 批量预定 (一次 apply 提交多个场次) ---
+# apply 接口的 rentals 是列表：连续几个小时或多块场地可以合并为一个请求，
+# 锁场续订也因此每轮只需一次请求。上游整单拒绝时逐个场次重试，定位部分失败。
+# 整单被拒而逐个全部成功可能只是场地状态在两次请求之间变化（如有人取消），不能据此认定不支持合并：
+# 拒绝消息明确表示不支持多场次，或连续 BATCH_UNSUPPORTED_STRIKES 次出现这种情况，才在一段时间内直接逐个发送。
+BATCH_APPLY_ENABLED = os.environ.get("BOOKING_BATCH", "true").lower() != "false"
+BATCH_UNSUPPORTED_TTL = 3600
+BATCH_UNSUPPORTED_STRIKES = int(os.environ.get("BATCH_UNSUPPORTED_STRIKES", 3))
+BATCH_UNSUPPORTED_HINTS = [h for h in os.environ.get("BATCH_UNSUPPORTED_HINTS", "不支持,仅支持,只能预定一个,只能选择一个").split(",") if h]
+_BATCH_STATE = {"unsupported_until": 0, "strikes": 0}
+
+def _slot_desc(slot):
+    return f"{slot.get('startTime')}-{slot.get('endTime')} 场地{slot.get('venueId')}"
+
+def send_batch_booking_request(token, user_id, date_str, slots, stadium_id=1, cookies=None, user_agent=None, priority=PRIORITY_SNIPE, username=None, hedge=False):
+    """
+    批量预定同一天的多个场次
+    - slots: [{startTime, endTime, venueId, price}]
+    - 先合并为一个 apply 请求；上游业务拒绝时逐个场次预定（部分成功）
+    - 网络/上游故障时不拆分（整单可能已生效），全部按失败返回由调用方重试
+    返回: (成功场次列表, [(失败场次, 消息)])
+    """
+    slots = list(slots or [])
+    if not slots:
+        return [], []
+
+    def _single(slot):
+        return send_booking_request(
+            token, user_id, date_str, slot['startTime'], slot['endTime'], slot['venueId'],
+            slot.get('price', 40), stadium_id, cookies=cookies, user_agent=user_agent,
+            priority=priority, username=username, hedge=hedge
+        )
+
+    if len(slots) == 1 or not BATCH_APPLY_ENABLED or time.time() < _BATCH_STATE["unsupported_until"]:
+        booked, failed = [], []
+        for slot in slots:
+            ok, msg, _ = _single(slot)
+            if ok:
+                booked.append(slot)
+            else:
+                failed.append((slot, msg))
+        return booked, failed
+
+    rentals = [_rental(date_str, s['startTime'], s['endTime'], s['venueId']) for s in slots]
+    receipts = sum(s.get('price', 40) for s in slots)
+    args = (token, user_id, rentals, receipts, stadium_id, cookies, user_agent, priority, username)
+    desc = f"{username or user_id} {date_str} " + ", ".join(_slot_desc(s) for s in slots)
+    if hedge and HEDGE_ENABLED:
+        ok, msg, kind = _hedged_call(_post_apply, args, desc)
+    else:
+        ok, msg, kind = _post_apply(*args)
+    if ok:
+        _BATCH_STATE["strikes"] = 0
+        return slots, []
+    if kind != UPSTREAM_ERR_BUSINESS:
+        return [], [(s, msg) for s in slots]
+
+    # 整单被拒：逐个场次预定，找出具体失败的场次
+    add_log(f"⚠️ [Batch] 合并预定被拒 ({msg})，逐个场次重试: {desc}", username=username)
+    booked, failed = [], []
+    for slot in slots:
+        ok, single_msg, _ = _single(slot)
+        if ok:
+            booked.append(slot)
+        else:
+            failed.append((slot, single_msg))
+    if failed:
+        _BATCH_STATE["strikes"] = 0  # 确有场次不可订，整单被拒属正常业务拒绝
+        return booked, failed
+    hint = next((h for h in BATCH_UNSUPPORTED_HINTS if h in str(msg)), None)
+    _BATCH_STATE["strikes"] += 1
+    if hint:
+        reason = f"拒绝消息包含「{hint}」"
+    elif _BATCH_STATE["strikes"] >= BATCH_UNSUPPORTED_STRIKES:
+        reason = f"连续 {_BATCH_STATE['strikes']} 次整单被拒而逐个全部成功"
+    else:
+        add_log(f"ℹ️ [Batch] 整单被拒而逐个全部成功 ({_BATCH_STATE['strikes']}/{BATCH_UNSUPPORTED_STRIKES})，暂不停用合并: {msg}")
+        return booked, failed
+    _BATCH_STATE["unsupported_until"] = time.time() + BATCH_UNSUPPORTED_TTL
+    _BATCH_STATE["strikes"] = 0
+    add_log(f"ℹ️ [Batch] 上游不接受多场次合并（{reason}: {msg}），{BATCH_UNSUPPORTED_TTL // 60} 分钟内改为逐个预定")
+    return booked, failed
+
 def try_rescue_token(username, reason="unknown"):
     """
     尝试经过自动登录流程救援失效的 Token。
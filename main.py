@@ -2,27 +2,37 @@ from fastapi import FastAPI, Request, BackgroundTasks
 from fastapi.responses import JSONResponse, FileResponse, HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-import os, uvicorn, uuid, requests, json, time, asyncio, threading, datetime
+import os, uvicorn, uuid, requests, json, time, asyncio, threading, datetime, socket, collections
+from concurrent.futures import ThreadPoolExecutor
 from core import (
-    add_log, redis_client, execute_login_logic, deduplicated_login, fetch_venue_data, 
+    add_log, redis_client, execute_login_logic, deduplicated_login, 
     extract_user_info, check_whitelist, PENDING_DRIVERS, DRIVER_MAP_LOCK,
-    close_driver, sniff_token, fetch_orders_internal, send_booking_request,
+    close_driver, fetch_orders_internal, send_booking_request,
     kill_zombie_processes, check_token_validity,
     # 新版 Redis 函数 (唯一数据源)
     save_session, get_session, get_all_sessions, update_session_field,
-    save_order_cache, get_order_cache, clear_order_cache,
+    clear_order_cache,
+    save_order_index, get_order_index_updated_at, get_order_page,
     save_venue_cache, get_venue_cache,
     # 兼容性保留 (已废弃)
     USER_SESSIONS, SESSION_LOCK, load_sessions_from_file, save_sessions_to_file,
     save_session_to_redis, get_session_from_redis,
     # 任务相关
     save_task_to_redis, remove_task_from_redis, load_all_tasks_from_redis,
-    send_lock_failed_email, send_email_notification, start_health_check_daemon, start_auto_refresh_daemon
+    save_task_checkpoint, load_task_checkpoints, get_task_checkpoint, sync_task_status,
+    ENGINE_NODE_ID, LEASE_HEARTBEAT, ENGINE_STOP_CHANNEL, acquire_task_lease, renew_task_lease,
+    release_task_lease, get_task_lease_owner, node_heartbeat, preferred_node, publish_task_stop,
+    send_lock_failed_email, send_email_notification, start_health_check_daemon, start_auto_refresh_daemon,
+    next_poll_interval, get_governor_metrics, PRIORITY_RENEW, PRIORITY_SNIPE,
+    get_2fa_owner, register_local_rpc, start_local_rpc_server, call_local_rpc, complete_2fa, discard_pending_driver,
+    UPSTREAM_BREAKERS, get_breaker_states, get_hedge_metrics, get_login_timing_stats, get_chrome_governor_stats, get_2fa_hold_stats, rank_snipe_candidates,
+    use_browser_farm, BROWSER_FARM_NODE,
+    send_batch_booking_request,
+    VenueSnapshot, fetch_venue_snapshot, SNAPSHOT_SHARE_AGE, natural_key, MULTI_WORKER
 )
-from selenium.webdriver.common.by import By
 from monthly_booking import (
     create_monthly_booking_task, get_monthly_tasks, cancel_monthly_task,
-    VENUE_ID_MAP
+    start_monthly_claim_daemon, VENUE_ID_MAP
 )
 
 app = FastAPI()
@@ -33,42 +43,148 @@ TASK_MANAGER = {}  # {task_id: {"type": "lock/snipe", "status": "xxx", "stop_eve
 
 # --- 数据缓存 (已废弃，保留兼容) ---
 # 注意：现在所有缓存都通过 Redis 操作，以下变量仅作为临时过渡
-# ORDER_CACHE = {}  # [已废弃] 使用 get_order_cache() / save_order_cache()
+# ORDER_CACHE = {}  # [已废弃] 使用订单索引 save_order_index() / get_order_page()
 # VENUE_CACHE = {}  # [已废弃] 使用 get_venue_cache() / save_venue_cache()
 CACHE_TIMEOUT = 300  # 5分钟缓存 (用于 Redis TTL)
 
+# --- 阻塞调用调度 ---
+# requests / Selenium 都是同步阻塞调用，不能直接在 async 处理函数里执行，否则会卡住整个事件循环。
+# 所有阻塞路径通过 run_blocking() 交给专用线程池；每个接口有独立的并发上限，
+# 线程池大小等于各上限之和，慢接口（登录、2FA）不会占满其他接口的线程。
+ENDPOINT_LIMITS = {
+    "login": int(os.environ.get("LIMIT_LOGIN", 4)),
+    "token_check": int(os.environ.get("LIMIT_TOKEN_CHECK", 8)),  # 缓存 Token 校验，不与浏览器登录抢名额
+    "2fa": int(os.environ.get("LIMIT_2FA", 4)),
+    "orders": int(os.environ.get("LIMIT_ORDERS", 8)),
+    "book": int(os.environ.get("LIMIT_BOOK", 8)),
+    "venues": int(os.environ.get("LIMIT_VENUES", 4)),
+    "admin": int(os.environ.get("LIMIT_ADMIN", 2)),
+}
+ENDPOINT_QUEUE_TIMEOUT = 10  # 排队超过 10 秒直接返回繁忙
+BLOCKING_EXECUTOR = ThreadPoolExecutor(max_workers=sum(ENDPOINT_LIMITS.values()), thread_name_prefix="Blocking")
+_ENDPOINT_SEMAPHORES = {}
+_ENDPOINT_STATS = {name: {"inflight": 0, "rejected": 0, "completed": 0} for name in ENDPOINT_LIMITS}
+
+class EndpointBusy(Exception):
+    """接口并发已满且排队超时"""
+
+@app.exception_handler(EndpointBusy)
+async def _endpoint_busy_handler(request: Request, exc: EndpointBusy):
+    return JSONResponse(status_code=503, content={"status": "error", "msg": "系统繁忙，请稍后重试"})
+
+async def run_blocking(endpoint, fn, *args):
+    """在专用线程池中执行阻塞调用，受 endpoint 的并发上限约束"""
+    sem = _ENDPOINT_SEMAPHORES.get(endpoint)
+    if sem is None:
+        sem = _ENDPOINT_SEMAPHORES[endpoint] = asyncio.Semaphore(ENDPOINT_LIMITS[endpoint])
+    stats = _ENDPOINT_STATS[endpoint]
+    try:
+        await asyncio.wait_for(sem.acquire(), timeout=ENDPOINT_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        stats["rejected"] += 1
+        raise EndpointBusy(f"系统繁忙，请稍后重试 ({endpoint})")
+    stats["inflight"] += 1
+    try:
+        return await asyncio.get_event_loop().run_in_executor(BLOCKING_EXECUTOR, fn, *args)
+    finally:
+        stats["inflight"] -= 1
+        stats["completed"] += 1
+        sem.release()
+
+def get_blocking_stats():
+    return {name: dict(stats, limit=ENDPOINT_LIMITS[name]) for name, stats in _ENDPOINT_STATS.items()}
+
+# --- 事件循环延迟监控 ---
+# 每 LOOP_LAG_INTERVAL 秒调度一次，实际唤醒时间与预期的差值即为事件循环被阻塞的时长
+LOOP_LAG_INTERVAL = 0.1
+LOOP_LAG_WARN = 0.05  # 超过 50ms 打印警告
+_LOOP_LAG_SAMPLES = collections.deque(maxlen=600)  # 最近一分钟
+_LOOP_LAG_MAX = {"value": 0.0}
+
+async def _loop_lag_monitor():
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - start - LOOP_LAG_INTERVAL)
+        _LOOP_LAG_SAMPLES.append(lag)
+        _LOOP_LAG_MAX["value"] = max(_LOOP_LAG_MAX["value"], lag)
+        if lag > LOOP_LAG_WARN:
+            print(f"[LoopLag] 事件循环阻塞 {lag * 1000:.0f}ms", flush=True)
+
+def get_loop_lag_stats():
+    """最近一分钟事件循环延迟（毫秒）"""
+    samples = sorted(_LOOP_LAG_SAMPLES)
+    if not samples:
+        return {}
+    pick = lambda q: round(samples[min(len(samples) - 1, int(len(samples) * q))] * 1000, 1)
+    return {"p50": pick(0.5), "p99": pick(0.99), "max_1m": round(samples[-1] * 1000, 1),
+            "max_all": round(_LOOP_LAG_MAX["value"] * 1000, 1)}
+
 @app.on_event("startup")
 async def startup_event():
     """服务启动时执行"""
     # Redis 是唯一数据源，启动时日志提示
     add_log("💾 Redis 作为唯一数据源，系统已启动")
     
-    # 尝试从 Redis 恢复任务状态 (仅展示)
+    # 清理所有日志：每次部署只清理一次。多 worker 模式下各 worker 的父进程是同一个 uvicorn 主进程，
+    # 以 "主机名-主进程号" 标识本次启动，先抢到标记的 worker 负责清理，避免后启动的 worker 清掉已写入的日志
+    try:
+        boot_pid = os.getppid() if MULTI_WORKER else os.getpid()
+        if redis_client.set(f"scut_order:logs_cleared:{socket.gethostname()}-{boot_pid}", "1", nx=True, ex=86400):
+            # 清理全局日志
+            redis_client.delete("scut_order:logs:global")
+            # 清理所有用户日志
+            for key in redis_client.keys("scut_order:logs:*"):
+                redis_client.delete(key)
+            # 清理旧的日志 key（兼容）
+            redis_client.delete("scut_order:logs")
+            add_log("🗑️ 服务启动，日志已清理")
+    except Exception as e:
+        print(f"Failed to clear logs: {e}")
+    
+    # 从 Redis 恢复任务：有检查点的锁场/捡漏任务按原定时间点继续运行（需取得租约），
+    # 其他节点持有租约的任务不在本节点展示，没有检查点的旧任务仅展示
     try:
+        live_nodes = node_heartbeat()
         saved_tasks = load_all_tasks_from_redis()
-        with TASK_LOCK:
-            for tid, tdata in saved_tasks.items():
-                if tid not in TASK_MANAGER:
-                    # 标记为已停止 (因为重启后线程没了)
-                    tdata['status'] = f"{tdata.get('status')} (Restored)"
-                    tdata['stop_event'] = threading.Event() # Dummy event
-                    tdata['stop_event'].set()
-                    TASK_MANAGER[tid] = tdata
-        add_log(f"🔄 已恢复 {len(saved_tasks)} 个历史任务记录")
+        checkpoints = load_task_checkpoints()
+        resumed = 0
+        for tid, tdata in saved_tasks.items():
+            with TASK_LOCK:
+                if tid in TASK_MANAGER:
+                    continue
+            checkpoint = checkpoints.get(tid)
+            if checkpoint:
+                if preferred_node(tid, live_nodes) != ENGINE_NODE_ID and tdata.get('node') != ENGINE_NODE_ID:
+                    continue  # 交给一致性哈希选中的节点，无人认领时由心跳接管
+                if not acquire_task_lease(tid):
+                    continue  # 仍由其他存活节点运行
+                try:
+                    if resume_task(tid, tdata, checkpoint):
+                        resumed += 1
+                        continue
+                except Exception as e:
+                    add_log(f"⚠️ [Task {tid}] 恢复失败: {e}")
+                release_task_lease(tid)
+            elif get_task_lease_owner(tid):
+                continue
+            with TASK_LOCK:
+                # 标记为已停止 (因为重启后线程没了)
+                tdata['status'] = f"{tdata.get('status')} (Restored)"
+                tdata['stop_event'] = threading.Event() # Dummy event
+                tdata['stop_event'].set()
+                TASK_MANAGER[tid] = tdata
+        add_log(f"🔄 已恢复 {len(saved_tasks)} 个历史任务记录，其中 {resumed} 个继续运行")
     except: pass
     
-    # 清理所有日志
-    try:
-        # 清理全局日志
-        redis_client.delete("scut_order:logs:global")
-        # 清理所有用户日志
-        for key in redis_client.keys("scut_order:logs:*"):
-            redis_client.delete(key)
-        # 清理旧的日志 key（兼容）
-        redis_client.delete("scut_order:logs")
-        add_log("🗑️ 服务启动，日志已清理")
-    except Exception as e:
-        print(f"Failed to clear logs: {e}")
+    # 事件循环延迟监控
+    asyncio.ensure_future(_loop_lag_monitor())
+    
+    # 租约心跳与跨节点停止；本机 RPC（多 worker 时转交 2FA 验证码）
+    start_lease_daemon()
+    start_local_rpc_server()
+    start_monthly_claim_daemon()
     
     # 清理僵尸进程并启动健康检查守护线程
     kill_zombie_processes()
@@ -140,9 +256,9 @@ async def login(request: Request):
                 cookies = cached.get('cookies')
                 user_agent = cached.get('user_agent')  # 获取缓存的UA
                 
-                # 优化：禁用自动救援 (username=None)，如果 Token 失效则直接产生 False，触发后续 Selenium 登录
+                # 优化：禁用自动救援 (username=None)；只有确认有效 (True) 才秒登，失效或无法判断都走 Selenium 登录
                 # 传入user_agent保持UA一致性
-                if check_token_validity(token, cookies, username=None, user_agent=user_agent):
+                if await run_blocking("token_check", check_token_validity, token, cookies, None, user_agent) is True:
                     print(f">>> [DEBUG] Token check passed for {username}", flush=True)
                     try:
                         add_log(f"⚡ [{username}] 使用缓存 Token 秒登成功", username=username)
@@ -161,15 +277,10 @@ async def login(request: Request):
         
         # 2. 如果缓存无或无效，执行 Selenium 登录
         print(f">>> [DEBUG] 开始 Selenium 登录流程...", flush=True)
-        # 清理旧的 2FA driver（如果存在）
-        from core import get_pending_driver, remove_pending_driver
-        old_driver = get_pending_driver(username)
-        if old_driver:
-            close_driver(old_driver)
-            remove_pending_driver(username)
-
-        loop = asyncio.get_event_loop()
-        status, result = await loop.run_in_executor(None, deduplicated_login, username, password)
+        # 清理旧的 2FA driver（如果存在）：关闭浏览器和 RPC 都是阻塞调用
+        await run_blocking("2fa", _discard_old_2fa, username)
+
+        status, result = await run_blocking("login", deduplicated_login, username, password)
         print(f">>> [DEBUG] Selenium 登录返回: {status}", flush=True)
         
         if status == "success":
@@ -254,12 +365,35 @@ async def login(request: Request):
             add_log(f"❌ 登录失败: status={status}, result={result}")
             return JSONResponse(content={"status": "error", "msg": str(result)})
             
+    except EndpointBusy:
+        raise  # 交给 503 处理
     except Exception as e:
         import traceback
         traceback.print_exc()
         add_log(f"❌ 严重错误: {e}")
         return JSONResponse(content={"status": "error", "msg": str(e)})
 
+def _discard_old_2fa(username):
+    """重新登录前关闭该用户旧的 2FA driver（本进程或本机其他 worker 中）"""
+    from core import get_pending_driver, remove_pending_driver
+    old_driver = get_pending_driver(username)
+    if old_driver:
+        close_driver(old_driver)
+        remove_pending_driver(username)
+    else:
+        _discard_remote_2fa(username)
+
+def _discard_remote_2fa(username):
+    """多 worker 模式：通知本机其他 worker 关闭该用户旧的 2FA driver"""
+    owner = get_2fa_owner(username)
+    if owner and owner.get('node') != ENGINE_NODE_ID and owner.get('host') == socket.gethostname():
+        try:
+            call_local_rpc(owner['node'], "discard_2fa", username, timeout=10)
+        except RuntimeError as e:
+            print(f"Discard remote 2FA driver failed: {e}")
+
+register_local_rpc("discard_2fa", discard_pending_driver)
+
 @app.post("/api/submit_2fa")
 async def submit_2fa(request: Request):
     data = await request.json()
@@ -271,144 +405,31 @@ async def submit_2fa(request: Request):
     
     print(f">>> [DEBUG] 收到 2FA 验证码: username={username}, code={code}", flush=True)
     
-    # ✅ 使用新函数获取 driver
     from core import get_pending_driver
-    driver = get_pending_driver(username)
-    
-    if not driver:
-        return {"status": "error", "msg": "Session expired or browser closed"}
-    
-    add_log(f"📨 [{username}] 提交验证码: {code}")
+    if get_pending_driver(username):
+        return await run_blocking("2fa", complete_2fa, username, code)
     
-    try:
-        # 使用用户提供的特定 ID: #PM1
-        input_box = driver.find_element(By.ID, "PM1")
-        input_box.clear()
-        input_box.send_keys(code)
-        add_log(f"✅ [{username}] 验证码已填入")
-        
-        # 尝试点击登录
-        clicked = False
+    # 多 worker 模式：driver 可能在本机另一个 worker 进程中
+    owner = get_2fa_owner(username)
+    if owner and owner.get('node') != ENGINE_NODE_ID and owner.get('host') == socket.gethostname():
         try:
-            # 1. 尝试 input
-            btn = driver.find_element(By.CSS_SELECTOR, "#index_login_btn > input")
-            btn.click()
-            clicked = True
-            add_log(f"✅ [{username}] 点击登录按钮 (方式1)")
-        except:
-            try:
-                # 2. 尝试 span 容器
-                btn = driver.find_element(By.ID, "index_login_btn")
-                btn.click()
-                clicked = True
-                add_log(f"✅ [{username}] 点击登录按钮 (方式2)")
-            except:
-                # 3. JS 强制点击
-                try:
-                    btn = driver.find_element(By.CSS_SELECTOR, ".login_box_landing_btn")
-                    driver.execute_script("arguments[0].click();", btn)
-                    clicked = True
-                    add_log(f"✅ [{username}] 点击登录按钮 (方式3-JS)")
-                except: pass
-        
-        if not clicked:
-            add_log(f"⚠️ [{username}] 无法找到登录提交按钮")
-            return {"status": "error", "msg": "无法找到登录提交按钮"}
-        
-        # 等待页面跳转 (关键！)
-        add_log(f"⏳ [{username}] 等待页面跳转...")
-        await asyncio.sleep(2)  # 先等待 2 秒让页面跳转
-        
-        # 检查是否出现"校内账号登录"选择页面
-        from core import check_and_click_campus_login
-        for _ in range(3):  # 最多检测 3 次
-            current_url = driver.current_url
-            add_log(f"📍 [{username}] 当前页面: {current_url}")
-            
-            # 尝试检测并点击"校内账号登录"
-            if check_and_click_campus_login(driver):
-                add_log(f"👆 [{username}] 检测到账号类型选择页面，点击'校内账号登录'")
-                await asyncio.sleep(2)  # 等待跳转
-            else:
-                # 没有检测到选择页面，跳出循环
-                break
-        
-        # 再次检查当前页面
-        current_url = driver.current_url
-        add_log(f"📍 [{username}] 最终页面: {current_url}")
-        
-        # 如果已经跳转到 booking 页面，说明登录成功，开始嗅探 Token
-        # 增加嗅探时间到 30 秒
-        add_log(f"🔍 [{username}] 开始嗅探 Token (30s)...")
-        token = await asyncio.get_event_loop().run_in_executor(None, sniff_token, driver, 30)
-
-        
-        if token:
-            # 提取 Cookies
-            cookies = {}
-            try:
-                cookies = {c['name']: c['value'] for c in driver.get_cookies()}
-                add_log(f"🍪 [{username}] 获取到 {len(cookies)} 个 Cookies")
-            except Exception as cookie_err:
-                add_log(f"⚠️ [{username}] Cookies 提取失败: {cookie_err}")
-            
-            close_driver(driver)
-            # 移除 pending (使用新函数)
-            from core import remove_pending_driver
-            remove_pending_driver(username)
-            
-            # 更新 Session (保存到 Redis)
-            existing = get_session(username) or {}
-            session_data = {
-                "token": token,
-                "cookies": cookies,
-                "last_updated": time.time(),
-                "password": existing.get("password"),
-                "email": existing.get("email"),
-                "user_agent": existing.get("user_agent")
-            }
-            save_session(username, session_data)
-            
-            add_log(f"🎉 [{username}] 验证成功，已登录")
-            add_log(f"🔑 Token: {token[:50]}...")
-            return {"status": "success", "token": token}
-        else:
-            # Token 未捕获，尝试刷新页面触发新请求
-            add_log(f"⚠️ [{username}] 首次嗅探失败，尝试刷新页面...")
-            try:
-                driver.get("https://venue.spe.scut.edu.cn/vb-user/booking")
-                await asyncio.sleep(2)
-                token = await asyncio.get_event_loop().run_in_executor(None, sniff_token, driver, 10)
-                if token:
-                    cookies = {c['name']: c['value'] for c in driver.get_cookies()}
-                    close_driver(driver)
-                    # 移除 pending (使用新函数)
-                    from core import remove_pending_driver
-                    remove_pending_driver(username)
-                    # 保存到 Redis
-                    existing = get_session(username) or {}
-                    session_data = {
-                        "token": token, "cookies": cookies,
-                        "last_updated": time.time(),
-                        "password": existing.get("password"),
-                        "email": existing.get("email"),
-                        "user_agent": existing.get("user_agent")
-                    }
-                    save_session(username, session_data)
-                    add_log(f"🎉 [{username}] 刷新后获取 Token 成功")
-                    return {"status": "success", "token": token}
-            except Exception as refresh_err:
-                add_log(f"⚠️ 刷新尝试失败: {refresh_err}")
-            
-            add_log(f"❌ [{username}] 2FA 验证后未检测到 Token (超时)")
-            return {"status": "error", "msg": "验证超时或失败，请重新登录"}
+            return await run_blocking(
+                "2fa", lambda: call_local_rpc(owner['node'], "complete_2fa", username, code, timeout=90)
+            )
+        except RuntimeError as e:
+            add_log(f"⚠️ [{username}] 转交验证码失败: {e}")
     
-    except Exception as e:
-        add_log(f"❌ 2FA Error: {e}")
-        return {"status": "error", "msg": str(e)}
+    return {"status": "error", "msg": "Session expired or browser closed"}
+
+
+register_local_rpc("complete_2fa", complete_2fa)
 
 @app.get("/api/venues")
 async def venues(token: str, username: str = None):
+    return await run_blocking("venues", _query_venues, token, username)
+
+
+def _query_venues(token, username=None):
     print(f">>> [DEBUG] venues endpoint called. Token len={len(str(token))}", flush=True)
     
     try:
@@ -438,7 +459,6 @@ async def venues(token: str, username: str = None):
         print(f">>> [DEBUG] venues: username={username}, cookies count={len(cookies)}", flush=True)
 
         import datetime as dt
-        import re
         from concurrent.futures import ThreadPoolExecutor, as_completed
         
         dates = [(dt.datetime.now() + dt.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(8)]
@@ -447,37 +467,33 @@ async def venues(token: str, username: str = None):
         print(">>> [DEBUG] Starting ThreadPool for venues fetching...", flush=True)
         with ThreadPoolExecutor(max_workers=8) as ex:
             # 传递 username 以启用自动救援
-            futures = {ex.submit(fetch_venue_data, token, d, cookies, username): d for d in dates}
+            futures = {ex.submit(fetch_venue_snapshot, token, d, cookies, username): d for d in dates}
             for f in as_completed(futures):
                 d = futures[f]
                 try:
-                    raw_list = f.result()
+                    snapshot = f.result()
                 except Exception as exc:
                     print(f">>> [DEBUG] Thread error for {d}: {exc}", flush=True)
-                    raw_list = []
+                    snapshot = None
 
                 # 检测是否需要救援 2FA
-                if isinstance(raw_list, dict) and raw_list.get("__need_rescue_2fa__"):
+                if isinstance(snapshot, dict) and snapshot.get("__need_rescue_2fa__"):
                     add_log(f"🔐 [{username}] 需要 2FA 验证，通知前端弹窗")
                     return JSONResponse(content={
                         "status": "need_rescue_2fa",
                         "msg": "会话已过期，需要输入验证码",
-                        "username": raw_list.get("username")
+                        "username": snapshot.get("username")
                     })
 
                 venue_map = {}
-                if raw_list and isinstance(raw_list, list):
-                    for s in raw_list:
-                        status = 'sold'
-                        if s['availNum'] == 1: status = 'free'
-                        if s.get('fixedPurpose'): status = 'reserved'
-
+                if isinstance(snapshot, VenueSnapshot):
+                    for s in snapshot.sessions:
                         item = {
                             "name": s.get('venueName'),
-                            "venueId": str(s['venueId']),
+                            "venueId": s['_vid'],
                             "startTime": s['startTime'],
                             "endTime": s['endTime'],
-                            "status": status,
+                            "status": s['_status'],
                             "price": s['price'],
                             "stadiumId": s.get('stadiumId', 1),
                             "fixedPurpose": s.get('fixedPurpose')
@@ -488,7 +504,7 @@ async def venues(token: str, username: str = None):
                         venue_map[item['name']]["sessions"].append(item)
 
                 res = list(venue_map.values())
-                res.sort(key=lambda x: [int(t) if t.isdigit() else t for t in re.split('([0-9]+)', x['name'])])
+                res.sort(key=lambda x: natural_key(x['name']))
                 result[d] = res
 
         # add_log("✅ 场地数据查询成功")
@@ -511,6 +527,10 @@ async def venues(token: str, username: str = None):
 @app.post("/api/orders")
 async def get_orders(request: Request):
     data = await request.json()
+    return await run_blocking("orders", _get_orders, data)
+
+
+def _get_orders(data):
     token = data.get('token')
     # type: 'unpaid'(待支付), 'paid'(已支付), 'refund'(退款), 'closed'(已关闭)
     status_type = data.get('type', 'unpaid')
@@ -550,14 +570,9 @@ async def get_orders(request: Request):
     # 是否强制刷新
     force_refresh = bool(data.get("refreshAll") or data.get("forceRefresh") or data.get("prefetchAll"))
 
-    # 从 Redis 获取缓存
-    cache = get_order_cache(cache_key) if not force_refresh else None
-    need_refresh = force_refresh or (not cache) or (now - float(cache.get("updated_at", 0)) > CACHE_TIMEOUT)
-    
-    # 如果请求的是 'all'，我们必须确保缓存里有所有状态的数据
-    if status_type == 'all' and not need_refresh:
-        # Check if cache has all keys
-        if not cache.get("by_status"): need_refresh = True
+    # 只读取索引的更新时间，不解码订单数据
+    updated_at = get_order_index_updated_at(cache_key) if not force_refresh else None
+    need_refresh = force_refresh or updated_at is None or (now - updated_at > CACHE_TIMEOUT)
 
     if need_refresh:
         by_status = {}
@@ -574,36 +589,19 @@ async def get_orders(request: Request):
                 all_records.extend(recs)
                 if len(recs) < 10:  # 少于pageSize说明已到末页
                     break
-            
-            # 按 createdAtMs 降序排序
-            all_records.sort(key=lambda x: int(x.get("createdAtMs") or 0), reverse=True)
             by_status[st] = all_records
 
-        # 保存到 Redis 缓存
-        cache = {"updated_at": now, "by_status": by_status}
-        save_order_cache(cache_key, cache)
-
-    # 返回目标 status 的分页数据
-    if status_type == 'all':
-        # 如果请求所有，返回所有缓存数据（字典形式，key为 1,2,3,4）
-        # 前端需要适配这种格式，或者我们在这里展平成一个大列表，并带上 status 字段
-        all_flattened = []
-        cache_data = cache.get("by_status") or {}
-        status_name_map = {1: 'unpaid', 2: 'paid', 3: 'refund', 4: 'closed'}
-        for st_code, recs in cache_data.items():
-            for r in recs:
-                r['statusType'] = status_name_map.get(int(st_code), 'unknown')
-                all_flattened.append(r)
-        
-        # 按时间倒序
-        all_flattened.sort(key=lambda x: int(x.get("createdAtMs") or 0), reverse=True)
-        return {"status": "success", "data": {"records": all_flattened}} # 复用 records 字段
+        # 重建 Redis 订单索引（按 createdAt 排序由 ZSET 完成）
+        save_order_index(cache_key, by_status)
+
+    # 'all' 且未指定分页：返回全部记录（带 statusType 字段，前端按 Tab 过滤）
+    if status_type == 'all' and "page" not in data:
+        records, _ = get_order_page(cache_key)
+        return {"status": "success", "data": {"records": records}} # 复用 records 字段
 
-    records = (cache.get("by_status") or {}).get(str(target_status), []) or (cache.get("by_status") or {}).get(target_status, []) or []
     page = data.get("page", 1)
     page_size = data.get("pageSize", 10)
     
-    # 内存分页
     try:
         page = int(page or 1)
         page_size = int(page_size or 10)
@@ -613,10 +611,15 @@ async def get_orders(request: Request):
     page_size = max(min(page_size, 200), 1)
     start = (page - 1) * page_size
     end = start + page_size
+
+    # 直接从索引读取当前页
+    records, total = get_order_page(
+        cache_key, None if status_type == 'all' else target_status, start, end - 1
+    )
     
     result_data = {
-        "records": records[start:end],
-        "total": len(records),
+        "records": records,
+        "total": total,
         "page": page,
         "pageSize": page_size
     }
@@ -626,6 +629,10 @@ async def get_orders(request: Request):
 @app.post("/api/book/direct")
 async def book_direct(request: Request):
     data = await request.json()
+    return await run_blocking("book", _book_direct, data)
+
+
+def _book_direct(data):
     token = data.get('token')
     email = data.get('email')
     username = data.get('username')
@@ -646,12 +653,36 @@ async def book_direct(request: Request):
         cookies = session.get('cookies', {})
         user_agent = session.get('user_agent')
 
+    # 多个场次（slots）合并为一个预定请求，返回每个场次的结果
+    slots = _normalize_lock_slots(data.get('slots'), data.get('price', 40))
+    if slots:
+        add_log(f"⚡ [Direct] 尝试批量预定 {len(slots)} 个场次...", username=account_name)
+        booked, failed = send_batch_booking_request(
+            token, user_info['userId'], data['date'], slots, data.get('stadiumId', 1),
+            cookies=cookies, user_agent=user_agent, username=account_name
+        )
+        if booked:
+            add_log(f"✅ 批量预定成功 {len(booked)}/{len(slots)}", username=account_name)
+            if email:
+                order_details = f"日期: {data['date']}\n" + "\n".join(
+                    f"时间: {s['startTime']}-{s['endTime']} 场馆ID: {s['venueId']}" for s in booked)
+                send_email_notification(email, account_name, order_details)
+            clear_order_cache(account_name)
+        for slot, slot_msg in failed:
+            add_log(f"❌ {slot['startTime']} 场馆{slot['venueId']} 预定失败: {slot_msg}", username=account_name)
+        return {
+            "status": "success" if booked else "error",
+            "msg": "预定成功" if not failed else (failed[0][1] if not booked else f"部分成功 ({len(booked)}/{len(slots)})"),
+            "booked": booked,
+            "failed": [dict(slot, msg=slot_msg) for slot, slot_msg in failed]
+        }
+
     add_log(f"⚡ [Direct] 尝试预定 {data['startTime']} 的场地...", username=account_name)
     ok, msg, _ = send_booking_request(
         token, user_info['userId'],
         data['date'], data['startTime'], data['endTime'],
         data['venueId'], data.get('price', 40), data.get('stadiumId', 1),
-        cookies=cookies, user_agent=user_agent
+        cookies=cookies, user_agent=user_agent, username=account_name
     )
     
     if ok:
@@ -691,8 +722,31 @@ def get_cookie_exp_time(cookies):
         # 解析失败不影响主流程
         return None
 
+def _normalize_lock_slots(raw_slots, default_price=40):
+    """
+    批量锁场的场次格式: {startTime, endTime, venueId, price(可选), venueName(可选)}
+    """
+    slots = []
+    seen = set()
+    for s in raw_slots or []:
+        if not isinstance(s, dict) or not (s.get('startTime') and s.get('endTime') and s.get('venueId')):
+            continue
+        key = (s['startTime'], str(s['venueId']))
+        if key in seen:
+            continue
+        seen.add(key)
+        slots.append({
+            "startTime": s['startTime'],
+            "endTime": s['endTime'],
+            "venueId": s['venueId'],
+            "price": s.get('price', default_price),
+            "venueName": s.get('venueName') or f"场地{s['venueId']}"
+        })
+    slots.sort(key=lambda x: (x['startTime'], str(x['venueId'])))
+    return slots
+
 def lock_worker(task_id, stop_event, token, user_id, date, start_time, end_time, 
-                venue_id, price, account_name, venue_name, email=None):
+                venue_id, price, account_name, venue_name, email=None, slots=None, resume=None):
     """
     锁场保活 Worker - 基于精确时间点的续订逻辑
     
@@ -702,7 +756,16 @@ def lock_worker(task_id, stop_event, token, user_id, date, start_time, end_time,
     3. 在成功后 9分30秒（即10分钟到期前30秒）开始续订
     4. 续订窗口为 60 秒
     5. 续订成功后更新 last_success_time，进入下一轮循环
+    
+    slots: 同一天的多个场次 [{startTime, endTime, venueId, price, venueName}]，
+           每轮合并为一个续订请求；部分场次续订失败时放弃这些场次，其余继续锁定
+    resume: 重启前保存的检查点，按其中的 last_success_time 在原定时间点继续；
+            停机期间已错过续订窗口的场次立即补订
     """
+    lock_slots = list(slots) if slots else [{
+        "startTime": start_time, "endTime": end_time, "venueId": venue_id,
+        "price": price, "venueName": venue_name
+    }]
     # 当前凭证（从 Redis 获取）
     current_token = token
     current_cookies = {}
@@ -725,7 +788,32 @@ def lock_worker(task_id, stop_event, token, user_id, date, start_time, end_time,
     token_verified = False
     # 🔑 关键：记录上次成功预定/续订的精确时间点
     last_success_time = time.time()
-    add_log(f"🔒 [Task {task_id}] 锁场保活启动，基准时间: {datetime.datetime.now().strftime('%H:%M:%S')}", username=account_name)
+    if resume:
+        last_success_time = resume.get('last_success_time', last_success_time)
+        renew_count = resume.get('renew_count', 0)
+        current_credential_timestamp = max(current_credential_timestamp, resume.get('credential_timestamp', 0))
+        downtime_elapsed = time.time() - last_success_time
+        base_str = datetime.datetime.fromtimestamp(last_success_time).strftime('%H:%M:%S')
+        if downtime_elapsed >= 10 * 60:
+            add_log(f"♻️ [Task {task_id}] 重启恢复：上次成功 {base_str}，场地已于停机期间到期，立即补订", username=account_name)
+        else:
+            add_log(f"♻️ [Task {task_id}] 重启恢复：沿用基准时间 {base_str}（第 {renew_count} 次续订后）", username=account_name)
+    else:
+        add_log(f"🔒 [Task {task_id}] 锁场保活启动，基准时间: {datetime.datetime.now().strftime('%H:%M:%S')}", username=account_name)
+
+    def _checkpoint():
+        save_task_checkpoint(task_id, {
+            "phase": "lock",
+            "token": current_token, "user_id": user_id, "date": date,
+            "start_time": start_time, "end_time": end_time, "venue_id": venue_id, "price": price,
+            "account_name": account_name, "venue_name": venue_name, "email": email,
+            "slots": lock_slots,
+            "last_success_time": last_success_time,
+            "renew_count": renew_count,
+            "credential_timestamp": current_credential_timestamp
+        })
+
+    _checkpoint()
 
     # 时间配置（秒）
     TOKEN_CHECK_DELAY = 8 * 60       # 8分钟后检测Token
@@ -738,13 +826,21 @@ def lock_worker(task_id, stop_event, token, user_id, date, start_time, end_time,
 
     try:
         while not stop_event.is_set():
-            # 0. 检查场地开始时间是否已过 (自动停止)
+            # 0. 检查场地开始时间是否已过 (自动停止；批量锁场时只停止已开始的场次)
             try:
-                target_dt = datetime.datetime.strptime(f"{date} {start_time}", "%Y-%m-%d %H:%M")
-                if datetime.datetime.now() > target_dt:
+                now_dt = datetime.datetime.now()
+                active_slots = [
+                    s for s in lock_slots
+                    if datetime.datetime.strptime(f"{date} {s['startTime']}", "%Y-%m-%d %H:%M") >= now_dt
+                ]
+                if not active_slots:
                     add_log(f"⏰ [Task {task_id}] 已到达场地开始时间 ({date} {start_time})，任务自动结束", username=account_name)
                     stop_event.set()
                     break
+                if len(active_slots) < len(lock_slots):
+                    add_log(f"⏰ [Task {task_id}] {len(lock_slots) - len(active_slots)} 个场次已开始，不再续订", username=account_name)
+                    lock_slots = active_slots
+                    _checkpoint()
             except Exception as e:
                 add_log(f"⚠️ [Task {task_id}] 无法解析场地时间，跳过自动停止检查: {e}", username=account_name)
 
@@ -835,7 +931,11 @@ def lock_worker(task_id, stop_event, token, user_id, date, start_time, end_time,
                 if not token_verified:
                     add_log(f"🔍 [Task {task_id}] 开始验证Token有效性...", username=account_name)
                     # 注意：这里传入username，启用自动救援
-                    if check_token_validity(current_token, current_cookies, username=account_name, user_agent=current_user_agent):
+                    valid = check_token_validity(current_token, current_cookies, username=account_name, user_agent=current_user_agent, priority=PRIORITY_RENEW)
+                    if valid is None:
+                        # 上游繁忙无法判断：保留当前凭证，下一轮再验证
+                        add_log(f"⏳ [Task {task_id}] 暂时无法确认Token状态，稍后重试验证", username=account_name)
+                    elif valid:
                         add_log(f"✅ [Task {task_id}] Token验证通过，等待续订时机...", username=account_name)
                     else:
                         # Token失效，但fetch_venue_data已启动救援，同步最新凭证
@@ -846,7 +946,7 @@ def lock_worker(task_id, stop_event, token, user_id, date, start_time, end_time,
                             current_cookies = cached.get('cookies', current_cookies)
                             current_user_agent = cached.get('user_agent', current_user_agent)
                             add_log(f"🔄 [Task {task_id}] 已同步救援后的新凭证", username=account_name)
-                    token_verified = True
+                    token_verified = valid is not None
                 
                 # 🔑 检测 Cookie 是否即将过期，提前刷新凭证
                 # 添加冷却检查：如果刚刚刷新过（距上次刷新不足5分钟），跳过本次检测
@@ -933,6 +1033,9 @@ def lock_worker(task_id, stop_event, token, user_id, date, start_time, end_time,
             
             renew_start = time.time()
             round_success = False
+            pending_slots = list(lock_slots)   # 本轮尚未续订成功的场次
+            renewed_slots = []
+            round_first_success = None         # 本轮最早成功的时间（最早到期的场次决定下一轮时机）
             
             # 🔑 续订前强制同步最新凭证（避免使用旧 cookie 导致续订失败）
             # 因为 AutoRefresh 可能刚刚刷新了凭证，所以这里强制读取 Redis
@@ -949,16 +1052,23 @@ def lock_worker(task_id, stop_event, token, user_id, date, start_time, end_time,
                 if stop_event.is_set(): 
                     return
                 
-                # 发送续订请求（使用登录时的UA）
-                ok_renew, msg_renew, _ = send_booking_request(
-                    current_token, user_id, date, start_time, end_time,
-                    venue_id, price, cookies=current_cookies, user_agent=current_user_agent
+                # 发送续订请求（使用登录时的UA，所有场次合并为一个请求）
+                booked, failed = send_batch_booking_request(
+                    current_token, user_id, date, pending_slots,
+                    cookies=current_cookies, user_agent=current_user_agent,
+                    priority=PRIORITY_RENEW, username=account_name, hedge=True
                 )
+                if booked:
+                    renewed_slots.extend(booked)
+                    round_first_success = round_first_success or time.time()
+                    pending_slots = [s for s, _ in failed]
+                    if pending_slots:
+                        add_log(f"⚠️ [Task {task_id}] 部分场次续订失败 ({len(pending_slots)}/{len(lock_slots)}): {failed[0][1]}，继续重试", username=account_name)
                 
-                if ok_renew:
+                if not pending_slots:
                     renew_count += 1
                     # 🔑 关键：更新成功时间点
-                    last_success_time = time.time()
+                    last_success_time = round_first_success
                     add_log(f"✅ [Task {task_id}] 第 {renew_count} 次续订成功! 新基准: {datetime.datetime.now().strftime('%H:%M:%S')}", username=account_name)
                     
                     # 🔑 续订后刷新: 如果之前标记了需要刷新（Cookie 有效期 3-14 分钟）
@@ -984,7 +1094,8 @@ def lock_worker(task_id, stop_event, token, user_id, date, start_time, end_time,
                     round_success = True
                     break
                 
-                time.sleep(0.3)
+                # 业务拒绝快速重试；上游故障时指数退避（上限 2 秒，保证窗口内仍有多次尝试）
+                time.sleep(UPSTREAM_BREAKERS["apply"].retry_delay(0.3, cap=2.0))
             
             if not round_success and not stop_event.is_set():
                 # === 失败后立即尝试刷新凭证并重试 ===
@@ -1004,22 +1115,38 @@ def lock_worker(task_id, stop_event, token, user_id, date, start_time, end_time,
                             current_credential_timestamp = time.time()  # 🔑 更新凭证时间戳
                             add_log(f"✅ [Task {task_id}] 凭证刷新成功，立即重试续订...", username=account_name)
                             
-                            # 立即重试续订（3次机会）
+                            # 立即重试续订（3次机会，只重试本轮失败的场次）
                             for retry in range(3):
-                                ok_retry, msg_retry, _ = send_booking_request(
-                                    current_token, user_id, date, start_time, end_time,
-                                    venue_id, price, cookies=current_cookies, user_agent=current_user_agent
+                                booked, failed = send_batch_booking_request(
+                                    current_token, user_id, date, pending_slots,
+                                    cookies=current_cookies, user_agent=current_user_agent,
+                                    priority=PRIORITY_RENEW, username=account_name, hedge=True
                                 )
-                                if ok_retry:
+                                if booked:
+                                    renewed_slots.extend(booked)
+                                    round_first_success = round_first_success or time.time()
+                                    pending_slots = [s for s, _ in failed]
+                                if not pending_slots:
                                     renew_count += 1
-                                    last_success_time = time.time()
+                                    last_success_time = round_first_success
                                     add_log(f"✅ [Task {task_id}] 救援续订成功！（第 {retry + 1} 次尝试）", username=account_name)
                                     rescue_success = True
                                     break
-                                time.sleep(0.5)
+                                time.sleep(UPSTREAM_BREAKERS["apply"].retry_delay(0.5, cap=2.0))
                     except Exception as rescue_err:
                         add_log(f"⚠️ [Task {task_id}] 救援异常: {rescue_err}", username=account_name)
                 
+                if not rescue_success and renewed_slots:
+                    # 批量锁场部分失败：放弃失败的场次，其余场次继续锁定
+                    lost = ", ".join(f"{s.get('venueName') or s['venueId']} {s['startTime']}" for s in pending_slots)
+                    add_log(f"⚠️ [Task {task_id}] 以下场次续订失败，已放弃: {lost}", username=account_name)
+                    if email:
+                        send_lock_failed_email(email, account_name, lost, f"第 {renew_count + 1} 次续订时部分场次失败，其余场次继续锁定")
+                    lock_slots = renewed_slots
+                    renew_count += 1
+                    last_success_time = round_first_success
+                    rescue_success = True
+                
                 if not rescue_success:
                     add_log(f"❌ [Task {task_id}] 本轮续订失败，场地可能已丢失。", username=account_name)
                     # 发送失败邮件通知
@@ -1034,29 +1161,38 @@ def lock_worker(task_id, stop_event, token, user_id, date, start_time, end_time,
                     round_success = True  # 救援成功，标记为成功
             
             # 续订成功，更新状态
+            _checkpoint()
             with TASK_LOCK:
                 if task_id in TASK_MANAGER:
                     TASK_MANAGER[task_id]['status'] = f"已锁场: {venue_name}"
     
     finally:
         add_log(f"⏹️ [Task {task_id}] 锁场任务已停止", username=account_name)
-        with TASK_LOCK:
-            if task_id in TASK_MANAGER:
-                del TASK_MANAGER[task_id]
         # 同时从 Redis 删除，避免服务重启后重新加载
-        remove_task_from_redis(task_id)
+        _release_task(task_id)
 
 
 
 def snipe_worker(task_id, stop_event, token, user_id, date, start_time, end_time, 
-                price, username, target_venue_id=None, email=None):
+                price, username, target_venue_id=None, email=None,
+                venue_preference=None, alt_start_times=None):
     """
     自动捡漏/扫场 Worker
     1. 轮询场地状态
-    2. 发现可用场地立即预定
+    2. 发现可用场地立即预定（同一快照内按偏好依次尝试所有候选）
     3. 预定成功后，自动切换到锁场模式 (lock_worker)
+    
+    venue_preference: 按偏好排列的场地 ID 列表
+    alt_start_times: 首选时间之外可接受的开始时间（按偏好排列）
     """
     add_log(f"🔭 [Task {task_id}] 捡漏任务启动: {date} {start_time}", username=username)
+    save_task_checkpoint(task_id, {
+        "phase": "snipe",
+        "token": token, "user_id": user_id, "date": date,
+        "start_time": start_time, "end_time": end_time, "price": price,
+        "username": username, "target_venue_id": target_venue_id, "email": email,
+        "venue_preference": venue_preference, "alt_start_times": alt_start_times
+    })
     
     current_token = token
     current_cookies = {}
@@ -1073,6 +1209,7 @@ def snipe_worker(task_id, stop_event, token, user_id, date, start_time, end_time
             TASK_MANAGER[task_id]['status'] = "正在扫描场地..."
     
     retry_count = 0
+    poll_interval = 1.5  # 首轮使用默认间隔，之后按释放规律自适应
     
 
     # 限制最大重试次数或无限制? 通常捡漏是持续的
@@ -1086,7 +1223,7 @@ def snipe_worker(task_id, stop_event, token, user_id, date, start_time, end_time
                 break
         except: pass
 
-        if stop_event.wait(timeout=1.5): # 1.5s 轮询间隔
+        if stop_event.wait(timeout=poll_interval): # 自适应轮询间隔
             return
 
         # 1. 获取最新凭证 (从 Redis，自动救援支持)
@@ -1101,40 +1238,44 @@ def snipe_worker(task_id, stop_event, token, user_id, date, start_time, end_time
         # 2. 查询场地
         try:
             # 传递 username 以启用 fetch_venue_data 内部的自动救援
-            raw_list = fetch_venue_data(current_token, date, current_cookies, username=username)
+            # 多个任务盯同一天时，SNAPSHOT_SHARE_AGE 内复用其他任务刚查到的快照
+            snapshot = fetch_venue_snapshot(
+                current_token, date, current_cookies, username=username,
+                priority=PRIORITY_SNIPE, max_age=SNAPSHOT_SHARE_AGE
+            )
         except Exception as e:
             add_log(f"⚠️ [Task {task_id}] 查询异常: {e}", username=username)
             time.sleep(5)
             continue
             
-        if not raw_list:
+        # 根据预计释放时间调整下一轮间隔；上游故障时按熔断器退避
+        poll_interval = UPSTREAM_BREAKERS["booking"].retry_delay(next_poll_interval(date, start_time, target_venue_id))
+
+        if not isinstance(snapshot, VenueSnapshot):
             continue
             
-        # 3. 筛选可用场地
-        available_venue = None
-        for v in raw_list:
-            # 必须匹配开始时间
-            if v.get('startTime') != start_time: continue
-            
-            # 如果指定了场地ID，必须匹配
-            if target_venue_id and str(v.get('venueId')) != str(target_venue_id): continue
-            
-            # 检查状态: availNum=1 表示空闲
-            if v.get('availNum') == 1 and not v.get('fixedPurpose'):
-                available_venue = v
-                break
+        # 3. 从同一快照中取出所有候选并按偏好排序
+        candidates = rank_snipe_candidates(
+            snapshot, [start_time] + list(alt_start_times or []),
+            target_venue_id, venue_preference
+        )
         
-        if available_venue:
-            v_name = available_venue.get('venueName')
-            v_id = available_venue.get('venueId')
-            v_price = available_venue.get('price', price)
+        # 4. 依次尝试预定（使用登录时的UA），失败立即尝试下一个候选
+        for cand in candidates:
+            if stop_event.is_set():
+                break
+            v_name = cand.get('venueName')
+            v_id = cand.get('venueId')
+            v_price = cand.get('price', price)
+            c_start = cand.get('startTime')
+            c_end = cand.get('endTime') or end_time
             
-            add_log(f"🎯 [Task {task_id}] 发现可用场地: {v_name} ({v_id})", username=username)
+            add_log(f"🎯 [Task {task_id}] 发现可用场地: {v_name} ({v_id}) {c_start}", username=username)
             
-            # 4. 尝试预定（使用登录时的UA）
             ok, msg, _ = send_booking_request(
-                current_token, user_id, date, start_time, end_time,
-                v_id, v_price, cookies=current_cookies, user_agent=current_user_agent
+                current_token, user_id, date, c_start, c_end,
+                v_id, v_price, cookies=current_cookies, user_agent=current_user_agent,
+                username=username, hedge=True
             )
             
             if ok:
@@ -1145,7 +1286,7 @@ def snipe_worker(task_id, stop_event, token, user_id, date, start_time, end_time
                 session = get_session(username)
                 email = session.get('email') if session else None
                 if email:
-                    order_details = f"任务ID: {task_id}\n捡漏成功: {v_name}\n日期: {date} {start_time}"
+                    order_details = f"任务ID: {task_id}\n捡漏成功: {v_name}\n日期: {date} {c_start}"
                     send_email_notification(email, username, order_details)
 
                 # 5. 切换到锁场模式
@@ -1156,29 +1297,186 @@ def snipe_worker(task_id, stop_event, token, user_id, date, start_time, end_time
                     if task_id in TASK_MANAGER:
                         TASK_MANAGER[task_id]['type'] = 'lock'
                         TASK_MANAGER[task_id]['status'] = f"已捡漏: {v_name}"
-                        TASK_MANAGER[task_id]['info'] = f"[{username}] {date} {start_time} {v_name}"
+                        TASK_MANAGER[task_id]['info'] = f"[{username}] {date} {c_start} {v_name}"
 
                 # 启动锁场线程 (复用 lock_worker)
                 lock_worker(
-                    task_id, stop_event, current_token, user_id, date, start_time, end_time,
+                    task_id, stop_event, current_token, user_id, date, c_start, c_end,
                     v_id, v_price, username, v_name, email
                 )
                 return 
                 
-            else:
-                add_log(f"❌ [Task {task_id}] 预定失败: {msg}", username=username)
-        else:
-            pass
+            add_log(f"❌ [Task {task_id}] 预定失败: {msg}，尝试下一个候选", username=username)
 
         retry_count += 1
     
     # 退出时清理
     add_log(f"⏹️ [Task {task_id}] 捡漏任务已停止", username=username)
-    with TASK_LOCK:
-        if task_id in TASK_MANAGER:
-            del TASK_MANAGER[task_id]
     # 同时从 Redis 删除，避免服务重启后重新加载
+    _release_task(task_id)
+
+
+def resume_task(task_id, task_data, checkpoint):
+    """
+    按检查点恢复任务线程（服务重启后调用）
+    - phase=lock:  从上次成功时间点继续锁场（已过期则立即补订）
+    - phase=snipe: 重新开始扫描
+    返回是否已恢复
+    """
+    phase = (checkpoint or {}).get('phase')
+    stop_event = threading.Event()
+    if phase == 'lock':
+        c = checkpoint
+        target = lock_worker
+        args = (
+            task_id, stop_event, c['token'], c['user_id'], c['date'], c['start_time'], c['end_time'],
+            c['venue_id'], c['price'], c['account_name'], c['venue_name'], c.get('email')
+        )
+        kwargs = {"slots": c.get('slots'), "resume": c}
+        entry_type, status = "lock", f"已锁场: {c['venue_name']}"
+        info = f"[{c['account_name']}] {c['date']} {c['start_time']} {c['venue_name']}"
+    elif phase == 'snipe':
+        c = checkpoint
+        target = snipe_worker
+        args = (
+            task_id, stop_event, c['token'], c['user_id'], c['date'], c['start_time'], c['end_time'],
+            c['price'], c['username'], c.get('target_venue_id'), c.get('email')
+        )
+        kwargs = {"venue_preference": c.get('venue_preference'), "alt_start_times": c.get('alt_start_times')}
+        entry_type, status = "snipe", "正在扫描场地..."
+        info = task_data.get('info') or f"[{c['username']}] {c['date']} {c['start_time']} (捡漏)"
+    else:
+        return False
+
+    with TASK_LOCK:
+        TASK_MANAGER[task_id] = {
+            "type": entry_type,
+            "status": status,
+            "stop_event": stop_event,
+            "username": task_data.get('username'),
+            "info": info,
+            "node": ENGINE_NODE_ID,
+            "params": task_data.get('params', {})
+        }
+    t = threading.Thread(target=target, args=args, kwargs=kwargs, name=f"Resume-{task_id}")
+    t.daemon = True
+    t.start()
+    return True
+
+
+# --- 多节点任务分片 ---
+# 任务归属由 Redis 租约决定（见 core.acquire_task_lease）：
+# - 本节点每 LEASE_HEARTBEAT 秒续约自己的任务，并把状态同步到 scut_order:tasks 供任意节点查询
+# - 续约失败说明任务已被其他节点接管，本地线程停止但不删除任务记录
+# - 租约过期的孤儿任务由一致性哈希选中的节点先认领，下一轮仍无人认领则任意节点接管
+_ORPHANS_SEEN = set()
+_GHOSTS_SEEN = set()
+_lease_daemon_thread = None
+
+def _release_task(task_id):
+    """任务线程退出时调用：主动停止则删除任务记录；租约被接管则只清理本地状态"""
+    with TASK_LOCK:
+        entry = TASK_MANAGER.pop(task_id, None)
+    if entry and entry.get('lease_lost'):
+        return
     remove_task_from_redis(task_id)
+    release_task_lease(task_id)
+
+def _stop_local_task(task_id):
+    """停止本节点上运行的任务，返回是否找到"""
+    with TASK_LOCK:
+        if task_id not in TASK_MANAGER:
+            return False
+        task_info = TASK_MANAGER[task_id].get('info', '')
+        task_username = TASK_MANAGER[task_id].get('username')
+        TASK_MANAGER[task_id]['stop_event'].set()
+        TASK_MANAGER[task_id]['status'] = "Stopped"
+        # 从 Redis 删除任务（而不是保存更新），因为任务已停止
+        remove_task_from_redis(task_id)
+    # 使用用户要求的格式: 👀 [Task ID] : Info ---已停止
+    add_log(f"👀 [Task {task_id}] : {task_info} ---已停止", username=task_username)
+    return True
+
+def claim_orphan_tasks(live_nodes, eager=False):
+    """
+    认领没有租约的任务（有检查点才能恢复）
+    eager=False 时只认领一致性哈希指向本节点的任务；其余任务连续两轮无人认领后再接管
+    没有检查点的任务（如监控清单）无法恢复，连续两轮没有租约即删除记录
+    """
+    saved_tasks = load_all_tasks_from_redis()
+    claimed = 0
+    for tid, tdata in saved_tasks.items():
+        with TASK_LOCK:
+            entry = TASK_MANAGER.get(tid)
+            if entry and not entry['stop_event'].is_set():
+                continue
+        if get_task_lease_owner(tid):
+            _ORPHANS_SEEN.discard(tid)
+            _GHOSTS_SEEN.discard(tid)
+            continue
+        checkpoint = get_task_checkpoint(tid)
+        if not checkpoint:
+            # 第一轮只记录：新建任务在写入记录和取得租约之间也会短暂没有租约
+            if tid in _GHOSTS_SEEN:
+                _GHOSTS_SEEN.discard(tid)
+                remove_task_from_redis(tid)
+                add_log(f"🧹 [Task {tid}] 租约已过期且无法恢复，清理任务记录: {tdata.get('info', '')}", username=tdata.get('username'))
+            else:
+                _GHOSTS_SEEN.add(tid)
+            continue
+        mine = preferred_node(tid, live_nodes) == ENGINE_NODE_ID
+        if not (eager or mine or tid in _ORPHANS_SEEN):
+            _ORPHANS_SEEN.add(tid)
+            continue
+        _ORPHANS_SEEN.discard(tid)
+        if not acquire_task_lease(tid):
+            continue
+        if resume_task(tid, tdata, checkpoint):
+            claimed += 1
+            add_log(f"🤝 [Task {tid}] 由节点 {ENGINE_NODE_ID} 接管")
+        else:
+            release_task_lease(tid)
+    return claimed
+
+def _lease_daemon():
+    """心跳：续约、同步状态、接管孤儿任务"""
+    while True:
+        time.sleep(LEASE_HEARTBEAT)
+        try:
+            live_nodes = node_heartbeat()
+            with TASK_LOCK:
+                running = [(tid, entry) for tid, entry in TASK_MANAGER.items() if not entry['stop_event'].is_set()]
+            for tid, entry in running:
+                if renew_task_lease(tid):
+                    sync_task_status(tid, entry)
+                    continue
+                add_log(f"⚠️ [Task {tid}] 租约已被其他节点接管，本节点停止运行", username=entry.get('username'))
+                entry['lease_lost'] = True
+                entry['stop_event'].set()
+            claim_orphan_tasks(live_nodes)
+        except Exception as e:
+            print(f"Lease daemon error: {e}")
+
+def _engine_stop_listener():
+    """订阅跨节点停止请求"""
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(ENGINE_STOP_CHANNEL)
+            for msg in pubsub.listen():
+                if msg.get("type") == "message":
+                    _stop_local_task(msg["data"])
+        except Exception as e:
+            print(f"Engine stop listener error: {e}")
+            time.sleep(1)
+
+def start_lease_daemon():
+    global _lease_daemon_thread
+    if _lease_daemon_thread is None or not _lease_daemon_thread.is_alive():
+        node_heartbeat()
+        _lease_daemon_thread = threading.Thread(target=_lease_daemon, daemon=True, name="LeaseDaemon")
+        _lease_daemon_thread.start()
+        threading.Thread(target=_engine_stop_listener, daemon=True, name="EngineStopListener").start()
 
 
 @app.post("/api/task/monitor")
@@ -1208,6 +1506,12 @@ async def start_monitor(request: Request):
     if not username:
         username = u_info.get('account') if u_info else None
     
+    # 批量锁场：slots 为同一天的多个场次，合并为一个预定/续订请求
+    slots = _normalize_lock_slots(data.get('slots'), price)
+    if slots and is_lock_mode:
+        start_time, end_time, venue_id = slots[0]['startTime'], slots[0]['endTime'], slots[0]['venueId']
+        venue_name = f"{slots[0]['venueName']} 等 {len(slots)} 个场次" if len(slots) > 1 else slots[0]['venueName']
+    
     mode_str = "无限锁场" if (venue_id and is_lock_mode) else "自动捡漏"
     add_log(f"👀 [Task {tid}] 开始: {date} {start_time} {venue_name if venue_id else '自动可以场地'} ({mode_str})", username=username)
     
@@ -1221,11 +1525,22 @@ async def start_monitor(request: Request):
             cookies = session.get('cookies', {})
             user_agent = session.get('user_agent')
         
-        # 先执行单次预定（使用登录时的UA）
-        ok, msg, _ = send_booking_request(
-            token, user_id, date, start_time, end_time, venue_id, price,
-            cookies=cookies, user_agent=user_agent
-        )
+        # 先执行单次预定（使用登录时的UA），与 /api/book 共用 book 线程池，不阻塞事件循环
+        if slots:
+            booked, failed = await run_blocking("book", lambda: send_batch_booking_request(
+                token, user_id, date, slots,
+                cookies=cookies, user_agent=user_agent, username=username
+            ))
+            ok = bool(booked)
+            msg = failed[0][1] if failed else "预定成功"
+            for slot, slot_msg in failed:
+                add_log(f"⚠️ [Task {tid}] {slot['venueName']} {slot['startTime']} 预定失败: {slot_msg}", username=username)
+            slots = booked
+        else:
+            ok, msg, _ = await run_blocking("book", lambda: send_booking_request(
+                token, user_id, date, start_time, end_time, venue_id, price,
+                cookies=cookies, user_agent=user_agent, username=username
+            ))
         
         if ok:
             add_log(f"✅ [Task {tid}] 预定成功！启动锁场保活...", username=username)
@@ -1247,14 +1562,16 @@ async def start_monitor(request: Request):
                     "info": f"[{username}] {date} {start_time} {venue_name}",
                     "params": data # Save params for potential restore
                 }
+                task_data["node"] = ENGINE_NODE_ID
                 TASK_MANAGER[tid] = task_data
                 save_task_to_redis(tid, task_data)
+                acquire_task_lease(tid)
             
             # 启动 lock_worker 线程
             t = threading.Thread(target=lock_worker, args=(
                 tid, stop_event, token, user_id, date, start_time, end_time,
                 venue_id, price, username, venue_name, email
-            ))
+            ), kwargs={"slots": slots or None})
             t.daemon = True
             t.start()
             
@@ -1275,42 +1592,281 @@ async def start_monitor(request: Request):
             "info": f"[{username}] {date} {start_time} (捡漏)",
             "params": data
         }
+        task_data["node"] = ENGINE_NODE_ID
         TASK_MANAGER[tid] = task_data
         save_task_to_redis(tid, task_data)
+        acquire_task_lease(tid)
     
     t = threading.Thread(target=snipe_worker, args=(
         tid, stop_event, token, user_id, date, start_time, end_time,
         price, username, venue_id, email
-    ))
+    ), kwargs={
+        "venue_preference": data.get('venuePreference'),
+        "alt_start_times": data.get('altStartTimes')
+    })
     t.daemon = True
     t.start()
     
     return {"status": "success",  "task_id": tid, "msg": "自动捡漏任务已启动"}
 
 
+def _normalize_watch_targets(raw_targets):
+    """
+    监控目标格式: {date, startFrom, startTo, venueIds(可选), priority(可选, 越小越优先)}
+    兼容只传 startTime 的写法（等价于 startFrom = startTo = startTime）
+    priority 不是整数时抛出 ValueError
+    """
+    targets = []
+    for i, t in enumerate(raw_targets or []):
+        date = t.get('date')
+        start_from = t.get('startFrom') or t.get('startTime')
+        start_to = t.get('startTo') or t.get('startTime') or start_from
+        if not date or not start_from:
+            continue
+        venue_ids = {str(v) for v in (t.get('venueIds') or [])}
+        targets.append({
+            "date": date,
+            "startFrom": start_from,
+            "startTo": start_to,
+            "venueIds": venue_ids or None,
+            "priority": int(t.get('priority', i))  # 非数字由调用方返回 400
+        })
+    targets.sort(key=lambda x: x['priority'])
+    return targets
+
+
+def watchlist_worker(task_id, stop_event, token, user_id, username, targets,
+                     price=40, email=None, lock_mode=True, max_bookings=1):
+    """
+    监控清单 Worker：一个任务同时关注多个日期/时间段/场地组合
+    1. 每轮对清单涉及的每个日期只查询一次场地
+    2. 按 startTime 建立空闲场次索引，各目标直接按时间段查索引
+    3. 候选按目标优先级、开始时间排序，失败立即尝试下一个
+    4. 预定成功后（锁场模式）为该场地启动独立的锁场任务，达到 max_bookings 后结束
+    """
+    add_log(f"📋 [Task {task_id}] 监控清单启动: {len(targets)} 个目标", username=username)
+    
+    current_token = token
+    current_cookies = {}
+    current_user_agent = None
+    session = get_session(username)
+    if session:
+        current_cookies = session.get('cookies', {})
+        current_user_agent = session.get('user_agent')
+
+    with TASK_LOCK:
+        if task_id in TASK_MANAGER:
+            TASK_MANAGER[task_id]['status'] = "正在扫描场地..."
+
+    booked = 0
+    poll_interval = 1.5
+    try:
+        while not stop_event.is_set() and booked < max_bookings:
+            # 0. 移除已过开始时间的目标
+            now = datetime.datetime.now()
+            active = []
+            for t in targets:
+                try:
+                    if datetime.datetime.strptime(f"{t['date']} {t['startTo']}", "%Y-%m-%d %H:%M") > now:
+                        active.append(t)
+                except ValueError:
+                    active.append(t)
+            if len(active) != len(targets):
+                targets = active
+                add_log(f"⏰ [Task {task_id}] 部分目标已过期，剩余 {len(targets)} 个", username=username)
+            if not targets:
+                add_log(f"⏰ [Task {task_id}] 所有目标均已到达开始时间，任务自动结束", username=username)
+                break
+
+            if stop_event.wait(timeout=poll_interval):
+                break
+
+            # 1. 同步最新凭证
+            cached = get_session(username)
+            if cached and cached.get('token') and cached.get('token') != current_token:
+                current_token = cached['token']
+                current_cookies = cached.get('cookies', {})
+                current_user_agent = cached.get('user_agent')
+
+            # 2. 每个日期查询一次（快照自带 startTime -> 空闲场次 索引）
+            snapshots = {}
+            dates = sorted({t['date'] for t in targets})
+            for d in dates:
+                snapshot = fetch_venue_snapshot(
+                    current_token, d, current_cookies, username=username,
+                    priority=PRIORITY_SNIPE, max_age=SNAPSHOT_SHARE_AGE
+                )
+                if isinstance(snapshot, VenueSnapshot):
+                    snapshots[d] = snapshot
+
+            # 3. 计算下一轮间隔（取所有目标中最紧迫的）
+            intervals = []
+            for d in dates:
+                watched = [t for t in targets if t['date'] == d]
+                times = set()
+                if d in snapshots:
+                    for t in watched:
+                        times.update(snapshots[d].free_start_times(t['startFrom'], t['startTo']))
+                times.update(t['startFrom'] for t in watched)
+                intervals.append(next_poll_interval(d, times))
+            poll_interval = UPSTREAM_BREAKERS["booking"].retry_delay(min(intervals) if intervals else 1.5)
+
+            # 4. 生成候选并依次尝试
+            candidates = []
+            for t in targets:
+                snapshot = snapshots.get(t['date'])
+                if not snapshot:
+                    continue
+                for st in snapshot.free_start_times(t['startFrom'], t['startTo']):
+                    for sess in snapshot.free_by_start[st]:
+                        if t['venueIds'] and sess['_vid'] not in t['venueIds']:
+                            continue
+                        candidates.append((t, sess))
+
+            tried = set()
+            for t, cand in candidates:
+                if stop_event.is_set() or booked >= max_bookings:
+                    break
+                key = (t['date'], cand.get('startTime'), cand['_vid'])
+                if key in tried:
+                    continue  # 多个目标可能命中同一场次
+                tried.add(key)
+
+                v_name = cand.get('venueName')
+                v_id = cand.get('venueId')
+                v_price = cand.get('price', price)
+                c_start, c_end = cand.get('startTime'), cand.get('endTime')
+                add_log(f"🎯 [Task {task_id}] 发现可用场地: {t['date']} {c_start} {v_name}", username=username)
+
+                ok, msg, _ = send_booking_request(
+                    current_token, user_id, t['date'], c_start, c_end,
+                    v_id, v_price, cookies=current_cookies, user_agent=current_user_agent,
+                    username=username, hedge=True
+                )
+                if not ok:
+                    add_log(f"❌ [Task {task_id}] 预定失败: {msg}，尝试下一个候选", username=username)
+                    continue
+
+                booked += 1
+                add_log(f"✅ [Task {task_id}] 捡漏成功！({t['date']} {c_start} {v_name})", username=username)
+                if email:
+                    order_details = f"任务ID: {task_id}\n捡漏成功: {v_name}\n日期: {t['date']} {c_start}"
+                    send_email_notification(email, username, order_details)
+                # 已订到的时段不再重复抢
+                targets = [x for x in targets if not (x['date'] == t['date'] and x['startFrom'] <= c_start <= x['startTo'])]
+
+                if lock_mode:
+                    lock_tid = f"{task_id}-{booked}"
+                    lock_stop = threading.Event()
+                    with TASK_LOCK:
+                        lock_data = {
+                            "type": "lock",
+                            "status": f"已捡漏: {v_name}",
+                            "stop_event": lock_stop,
+                            "username": username,
+                            "info": f"[{username}] {t['date']} {c_start} {v_name}",
+                            "params": {"date": t['date'], "startTime": c_start, "endTime": c_end,
+                                       "venueId": v_id, "venueName": v_name, "price": v_price}
+                        }
+                        lock_data["node"] = ENGINE_NODE_ID
+                        TASK_MANAGER[lock_tid] = lock_data
+                        save_task_to_redis(lock_tid, lock_data)
+                        acquire_task_lease(lock_tid)
+                    threading.Thread(target=lock_worker, args=(
+                        lock_tid, lock_stop, current_token, user_id, t['date'], c_start, c_end,
+                        v_id, v_price, username, v_name, email
+                    ), daemon=True).start()
+                    add_log(f"🔐 [Task {task_id}] 已为 {v_name} 启动锁场任务 {lock_tid}", username=username)
+                break  # 清单已变化，下一轮重新计算候选
+
+            with TASK_LOCK:
+                if task_id in TASK_MANAGER:
+                    TASK_MANAGER[task_id]['status'] = f"监控中 ({len(targets)} 个目标, 已订 {booked})"
+    finally:
+        add_log(f"⏹️ [Task {task_id}] 监控清单任务已停止", username=username)
+        _release_task(task_id)
+
+
+@app.post("/api/task/watchlist")
+async def start_watchlist(request: Request):
+    """
+    启动监控清单任务：一个任务替代多个单场次捡漏任务
+    请求体: {token, username, email, targets: [{date, startFrom, startTo, venueIds, priority}],
+             lockMode, maxBookings, price}
+    """
+    data = await request.json()
+    tid = str(uuid.uuid4())[:8].upper()
+
+    token = data.get('token')
+    username = data.get('username')
+    email = data.get('email')
+    try:
+        targets = _normalize_watch_targets(data.get('targets'))
+        max_bookings = max(1, int(data.get('maxBookings', 1)))
+    except (TypeError, ValueError, AttributeError):
+        return JSONResponse(status_code=400, content={"status": "error", "msg": "监控目标格式错误：priority/maxBookings 必须为整数"})
+    if not targets:
+        return {"status": "error", "msg": "监控目标为空"}
+
+    u_info = extract_user_info(token)
+    user_id = u_info.get('userId') if u_info else None
+    if not username:
+        username = u_info.get('account') if u_info else None
+
+    summary = "; ".join(
+        f"{t['date']} {t['startFrom']}" + (f"-{t['startTo']}" if t['startTo'] != t['startFrom'] else "")
+        for t in targets[:3]
+    ) + (f" 等{len(targets)}个" if len(targets) > 3 else "")
+    add_log(f"👀 [Task {tid}] 开始监控清单: {summary}", username=username)
+
+    stop_event = threading.Event()
+    with TASK_LOCK:
+        task_data = {
+            "type": "watchlist",
+            "status": "初始化...",
+            "stop_event": stop_event,
+            "username": username,
+            "info": f"[{username}] {summary}",
+            # 任务记录对管理端可见，不保存 Token
+            "params": {k: v for k, v in data.items() if k != 'token'}
+        }
+        task_data["node"] = ENGINE_NODE_ID
+        TASK_MANAGER[tid] = task_data
+        save_task_to_redis(tid, task_data)
+        acquire_task_lease(tid)
+
+    t = threading.Thread(target=watchlist_worker, args=(
+        tid, stop_event, token, user_id, username, targets
+    ), kwargs={
+        "price": data.get('price', 40),
+        "email": email,
+        "lock_mode": bool(data.get('lockMode', True)),
+        "max_bookings": max_bookings
+    })
+    t.daemon = True
+    t.start()
+
+    return {"status": "success", "task_id": tid, "msg": "监控清单任务已启动"}
+
+
 @app.post("/api/task/stop")
 async def stop_task(request: Request):
-    """停止任务"""
+    """停止任务（任务可能运行在其他节点上）"""
     data = await request.json()
     task_id = data.get('taskId')
     
-    with TASK_LOCK:
-        if task_id in TASK_MANAGER:
-            task_info = TASK_MANAGER[task_id].get('info', '')
-            task_username = TASK_MANAGER[task_id].get('username')
-            
-            TASK_MANAGER[task_id]['stop_event'].set()
-            TASK_MANAGER[task_id]['status'] = "Stopped"
-            
-            # 从 Redis 删除任务（而不是保存更新），因为任务已停止
-            remove_task_from_redis(task_id)
-            
-            # 使用用户要求的格式: 👀 [Task ID] : Info ---已停止
-            add_log(f"👀 [Task {task_id}] : {task_info} ---已停止", username=task_username)
-            
-            # 为了让前端立即感知，我们可以稍微延迟一点点删除吗？
-            # 不，前端会乐观更新。后端这里只需要负责日志和信号。
-            return {"status": "success", "msg": "停止信号已发送"}
+    if _stop_local_task(task_id):
+        # 为了让前端立即感知，我们可以稍微延迟一点点删除吗？
+        # 不，前端会乐观更新。后端这里只需要负责日志和信号。
+        return {"status": "success", "msg": "停止信号已发送"}
+    
+    saved = load_all_tasks_from_redis().get(task_id)
+    if saved:
+        # 通知持有租约的节点停止；同时删除任务记录和检查点，避免宕机节点的任务被接管
+        publish_task_stop(task_id)
+        remove_task_from_redis(task_id)
+        add_log(f"👀 [Task {task_id}] : {saved.get('info', '')} ---已停止", username=saved.get('username'))
+        return {"status": "success", "msg": "停止信号已发送"}
     
     return {"status": "error", "msg": "任务不存在"}
 
@@ -1340,9 +1896,18 @@ async def get_logs(username: str = None):
 
 @app.get("/api/tasks")
 async def list_tasks(username: str = None):
-    """获取任务列表（按用户过滤）"""
+    """获取任务列表（按用户过滤，包含其他节点上运行的任务）"""
+    result = {}
+    for tid, info in load_all_tasks_from_redis().items():
+        if username and info.get("username") != username:
+            continue
+        result[tid] = {
+            "type": info.get("type"),
+            "status": info.get("status"),
+            "info": info.get("info")
+        }
+    # 本节点的任务以内存中的实时状态为准
     with TASK_LOCK:
-        result = {}
         for tid, info in TASK_MANAGER.items():
             # 如果指定了 username，只返回该用户的任务
             if username:
@@ -1353,7 +1918,7 @@ async def list_tasks(username: str = None):
                 "status": info.get("status"),
                 "info": info.get("info")
             }
-        return result
+    return result
 
 # ============== 月场预定 API ==============
 
@@ -1511,6 +2076,29 @@ async def remove_whitelist(request: Request):
     except Exception as e:
         return {"status": "error", "msg": str(e)}
 
+def _browser_stats():
+    """登录阶段耗时、浏览器内存和 2FA 等待占用；浏览器服务模式下这些都在 browser_farm 进程中，通过 stats RPC 获取"""
+    if not use_browser_farm():
+        return {"login": get_login_timing_stats(), "chrome": get_chrome_governor_stats(), "2fa": get_2fa_hold_stats()}
+    try:
+        farm = call_local_rpc(BROWSER_FARM_NODE, "stats", timeout=5)
+    except RuntimeError as e:
+        return {"login": {}, "chrome": {}, "2fa": {}, "farm": {"error": str(e)}}
+    return {"login": farm.pop("login", {}), "chrome": farm.pop("chrome", {}), "2fa": farm.pop("2fa", {}), "farm": farm}
+
+@app.get("/api/admin/governor")
+async def get_governor_stats():
+    """获取上游限流等待指标（按优先级）、各接口熔断状态、预定对冲统计、事件循环延迟、阻塞调用并发、登录阶段耗时、浏览器内存和 2FA 等待占用"""
+    return {
+        "status": "success",
+        "data": get_governor_metrics(),
+        "breakers": get_breaker_states(),
+        "hedge": get_hedge_metrics(),
+        "loop": get_loop_lag_stats(),
+        "blocking": get_blocking_stats(),
+        **(await run_blocking("admin", _browser_stats))
+    }
+
 @app.get("/api/admin/whitelist")
 async def get_whitelist():
     """获取白名单列表"""
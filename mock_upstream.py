@@ -0,0 +1,389 @@
+"""
+学校订场接口模拟服务 (Mock Upstream)
+
+在本地模拟 booking / apply / orders 接口和登录页跳转，用于离线压测与回归：
+- 可配置延迟、故障注入（5xx、卡死超时、Token 失效）和抢场竞争
+- 录制模式：转发到真实接口并保存请求/响应（去掉 Authorization/Cookie）
+- 回放模式：用录制的响应代替模拟数据
+
+用法:
+  python mock_upstream.py --port 5099 --latency 0.05 --fail-rate 0.05 --contention 0.3
+  python mock_upstream.py --record captures/      # 代理到真实接口并保存
+  python mock_upstream.py --replay captures/      # 回放保存的响应
+
+主程序设置 SCUT_UPSTREAM_BASE=http://127.0.0.1:5099 即可把所有接口请求指向本服务。
+运行时可通过 /__mock/config 修改参数，/__mock/stats 查看统计，/__mock/reset 重置场地。
+"""
+import argparse
+import base64
+import datetime
+import glob
+import hashlib
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+from starlette.concurrency import run_in_threadpool
+
+REAL_UPSTREAM = "https://venue.spe.scut.edu.cn"
+TZ_UTC8 = datetime.timezone(datetime.timedelta(hours=8))
+VENUES = [(500000000000000 + i, f"{i}号场") for i in range(1, 17)]
+SLOT_HOURS = range(8, 22)  # 08:00-22:00，每小时一场
+PRICE = 40
+STALL_SECONDS = 20  # 卡死请求的时长，超过客户端所有超时
+
+CONFIG = {
+    "latency": 0.0,       # 每个请求的基础延迟（秒）
+    "jitter": 0.0,        # 额外随机延迟上限（秒）
+    "fail_rate": 0.0,     # 返回 502 的概率
+    "stall_rate": 0.0,    # 卡死 STALL_SECONDS 的概率
+    "expire_rate": 0.0,   # 返回登录页 HTML（Token 失效）的概率
+    "contention": 0.0,    # 空闲场次被"别人"抢先的概率
+    "occupancy": 0.5,     # 初始已售比例
+    "hold_seconds": 0,    # 未支付订单多久后释放场次（0 表示不释放）
+    "seed": 0,
+    "record": None,       # 录制目录
+    "replay": None,       # 回放目录
+}
+
+app = FastAPI()
+_LOCK = threading.Lock()
+_SLOTS = {}        # date -> {(venueId, start): {"avail": bool, "owner": userId, "order": orderNo}}
+_ORDERS = []       # [{"orderNo", "userId", "createdAt", "status", "rentals", ...}]
+_EXPIRED = set()   # 被手动置为失效的 Token
+_REPLAY = {}       # (method, path, key) -> [capture]；key 为 None 时是该接口的全部录制
+_REPLAY_CYCLE = {}
+_ORDER_SEQ = itertools.count(1)
+_STATS = {"requests": {}, "injected": {"fail": 0, "stall": 0, "expire": 0},
+          "contention_lost": 0, "apply_ok": 0, "apply_rejected": 0}
+
+
+# ================= 工具 =================
+
+def make_token(user_id, account=None):
+    """生成结构与学校 JWT 相同（未签名）的 Token，core.extract_user_info 可解析"""
+    def b64(d):
+        return base64.urlsafe_b64encode(json.dumps(d).encode()).decode().rstrip("=")
+    payload = {"userId": user_id, "userInfo": {"userId": user_id, "sno": account or str(user_id)},
+               "exp": int(time.time()) + 86400}
+    return f"{b64({'alg': 'none'})}.{b64(payload)}.mock"
+
+def _user_of(request):
+    auth = request.headers.get("authorization", "")
+    token = auth[7:].strip() if auth.lower().startswith("bearer ") else ""
+    if not token or token in _EXPIRED:
+        return None, token
+    try:
+        p = token.split(".")[1]
+        d = json.loads(base64.urlsafe_b64decode(p + "=" * (-len(p) % 4)))
+        return str(d.get("userId") or (d.get("userInfo") or {}).get("userId") or token), token
+    except Exception:
+        return token, token  # 非 JWT 的 Token 也接受，直接作为用户标识
+
+def _date_of(ms):
+    return datetime.datetime.fromtimestamp(int(ms) / 1000, TZ_UTC8).strftime("%Y-%m-%d")
+
+def _login_page():
+    # 学校接口在会话失效时返回 200 + 登录页 HTML
+    return HTMLResponse("<!DOCTYPE html><html><head><title>统一身份认证</title></head>"
+                        "<body><div id='root'>请登录</div></body></html>")
+
+def _day_slots(date_str):
+    """某日的场地状态（首次访问时按 seed + 日期生成，保证可复现）"""
+    if date_str not in _SLOTS:
+        rng = random.Random(f"{CONFIG['seed']}:{date_str}")
+        _SLOTS[date_str] = {
+            (vid, f"{h:02d}:00"): {"avail": rng.random() >= CONFIG["occupancy"], "owner": None, "order": None}
+            for vid, _ in VENUES for h in SLOT_HOURS
+        }
+    return _SLOTS[date_str]
+
+def _release_expired_holds():
+    if not CONFIG["hold_seconds"]:
+        return
+    deadline = (time.time() - CONFIG["hold_seconds"]) * 1000
+    for order in _ORDERS:
+        if order["status"] == 1 and order["createdAt"] < deadline:
+            order["status"], order["statusDesc"] = 4, "已取消"
+            for r in order["rentals"]:
+                slot = _day_slots(_date_of(r["belongDate"])).get((r["venueId"], r["startTime"]))
+                if slot and slot["order"] == order["orderNo"]:
+                    slot.update(avail=True, owner=None, order=None)
+
+def _inject(endpoint):
+    """统一的延迟与故障注入；返回需要直接返回的响应或 None"""
+    with _LOCK:
+        _STATS["requests"][endpoint] = _STATS["requests"].get(endpoint, 0) + 1
+    delay = CONFIG["latency"] + random.random() * CONFIG["jitter"]
+    if delay:
+        time.sleep(delay)
+    r = random.random()
+    kind = None
+    if r < CONFIG["stall_rate"]:
+        kind = "stall"
+    elif r < CONFIG["stall_rate"] + CONFIG["fail_rate"]:
+        kind = "fail"
+    elif r < CONFIG["stall_rate"] + CONFIG["fail_rate"] + CONFIG["expire_rate"]:
+        kind = "expire"
+    if kind:
+        with _LOCK:
+            _STATS["injected"][kind] += 1
+    if kind == "stall":
+        time.sleep(STALL_SECONDS)
+    elif kind == "fail":
+        return JSONResponse({"code": 500, "msg": "系统繁忙"}, status_code=502)
+    elif kind == "expire":
+        return _login_page()
+    return None
+
+
+# ================= 录制 / 回放 =================
+
+def _replay_key(path, query, body):
+    if path.endswith("/venue/pc/booking"):
+        return str((body or {}).get("belongDate"))
+    if path.endswith("/orders/page"):
+        return f"{query.get('status')}:{query.get('page')}"
+    if path.endswith("/orders/apply"):
+        return hashlib.md5(json.dumps((body or {}).get("rentals"), sort_keys=True).encode()).hexdigest()
+    return None
+
+def load_captures(directory):
+    _REPLAY.clear()
+    for f in sorted(glob.glob(os.path.join(directory, "*", "*.json"))):
+        with open(f, encoding="utf-8") as fp:
+            cap = json.load(fp)
+        req = cap["request"]
+        key = _replay_key(req["path"], req.get("query") or {}, req.get("body"))
+        _REPLAY.setdefault((req["method"], req["path"], key), []).append(cap)
+        _REPLAY.setdefault((req["method"], req["path"], None), []).append(cap)
+    return sum(len(v) for k, v in _REPLAY.items() if k[2] is None)
+
+def _capture_response(cap):
+    resp = cap["response"]
+    body = resp["body"]
+    content = body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)
+    return Response(content, status_code=resp["status"], media_type=resp.get("content_type") or "application/json")
+
+def _replay(method, path, query, body):
+    key = _replay_key(path, query, body)
+    for k in ((method, path, key), (method, path, None)):
+        caps = _REPLAY.get(k)
+        if caps:
+            cycle = _REPLAY_CYCLE.setdefault(k, itertools.cycle(caps))
+            return _capture_response(next(cycle))
+    return JSONResponse({"code": 404, "msg": "没有可回放的录制"}, status_code=404)
+
+def _record(request, body):
+    """转发到真实接口并保存（不保存 Authorization/Cookie）"""
+    path = request.url.path
+    headers = {k: v for k, v in request.headers.items() if k.lower() in ("authorization", "cookie", "content-type", "user-agent", "accept")}
+    start = time.time()
+    r = requests.request(request.method, REAL_UPSTREAM + path, params=dict(request.query_params),
+                         json=body if body is not None else None, headers=headers, timeout=15)
+    content_type = r.headers.get("Content-Type", "")
+    try:
+        resp_body = r.json()
+    except ValueError:
+        resp_body = r.text
+    cap = {
+        "request": {"method": request.method, "path": path, "query": dict(request.query_params), "body": body},
+        "response": {"status": r.status_code, "content_type": content_type.split(";")[0], "body": resp_body},
+        "elapsed": round(time.time() - start, 3),
+        "time": time.time(),
+    }
+    folder = os.path.join(CONFIG["record"], path.strip("/").replace("/", "_"))
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, f"{int(time.time() * 1000)}.json"), "w", encoding="utf-8") as fp:
+        json.dump(cap, fp, ensure_ascii=False, indent=1)
+    return _capture_response(cap)
+
+@app.middleware("http")
+async def record_replay(request: Request, call_next):
+    path = request.url.path
+    if path.startswith("/__mock") or not (CONFIG["record"] or CONFIG["replay"]):
+        return await call_next(request)
+    raw = await request.body()
+    try:
+        body = json.loads(raw) if raw else None
+    except ValueError:
+        body = None
+    if CONFIG["record"]:
+        return await run_in_threadpool(_record, request, body)
+    injected = await run_in_threadpool(_inject, "replay")
+    return injected or _replay(request.method, path, dict(request.query_params), body)
+
+
+# ================= 模拟接口 =================
+
+@app.post("/api/pc/venue/pc/booking")
+def booking(payload: dict, request: Request):
+    injected = _inject("booking")
+    if injected:
+        return injected
+    user, _ = _user_of(request)
+    if not user:
+        return _login_page()
+    date_str = _date_of(payload.get("belongDate"))
+    with _LOCK:
+        _release_expired_holds()
+        slots = _day_slots(date_str)
+        sessions = [{
+            "venueId": vid,
+            "venueName": name,
+            "startTime": f"{h:02d}:00",
+            "endTime": f"{h + 1:02d}:00",
+            "availNum": 1 if slots[(vid, f"{h:02d}:00")]["avail"] else 0,
+            "price": PRICE,
+            "fixedPurpose": None,
+        } for vid, name in VENUES for h in SLOT_HOURS]
+    return {"code": 200, "msg": "success", "data": {"venueSessionResponses": sessions}}
+
+@app.post("/api/pc/order/rental/orders/apply")
+def apply(payload: dict, request: Request):
+    injected = _inject("apply")
+    if injected:
+        return injected
+    user, _ = _user_of(request)
+    if not user:
+        return _login_page()
+    rentals = payload.get("rentals") or []
+    if not rentals:
+        return {"code": 0, "msg": "参数错误"}
+    with _LOCK:
+        _release_expired_holds()
+        targets = []
+        for r in rentals:
+            slot = _day_slots(_date_of(r.get("belongDate"))).get((int(r.get("venueId") or 0), r.get("start")))
+            if slot is None:
+                return {"code": 0, "msg": "场次不存在"}
+            if slot["avail"] and random.random() < CONFIG["contention"]:
+                slot["avail"] = False  # 模拟其他用户抢先
+                _STATS["contention_lost"] += 1
+            if not slot["avail"]:
+                _STATS["apply_rejected"] += 1
+                return {"code": 0, "msg": "该场次已被预订，请选择其他场次"}
+            targets.append((r, slot))
+        order_no = f"MOCK{int(time.time())}{next(_ORDER_SEQ):05d}"
+        for r, slot in targets:
+            slot.update(avail=False, owner=user, order=order_no)
+        _ORDERS.append({
+            "orderNo": order_no,
+            "userId": user,
+            "projectName": "羽毛球",
+            "receivable": payload.get("receipts") or PRICE * len(rentals),
+            "status": 1,
+            "statusDesc": "待支付",
+            "createdAt": int(time.time() * 1000),
+            "rentals": [{
+                "belongDate": r.get("belongDate"),
+                "startTime": r.get("start"),
+                "endTime": r.get("end"),
+                "venueId": int(r.get("venueId")),
+                "venueName": dict(VENUES).get(int(r.get("venueId")), ""),
+            } for r, _ in targets],
+        })
+        _STATS["apply_ok"] += 1
+    # code=1 兼容月场预定的判断，msg 含"成功"兼容普通预定
+    return {"code": 1, "msg": "预定成功", "data": {"orderNo": order_no}}
+
+@app.get("/api/pc/order/rental/orders/page")
+def orders(request: Request, page: int = 1, pageSize: int = 10, status: int = 1):
+    injected = _inject("orders")
+    if injected:
+        return injected
+    user, _ = _user_of(request)
+    if not user:
+        return _login_page()
+    with _LOCK:
+        _release_expired_holds()
+        mine = [o for o in _ORDERS if o["userId"] == user and o["status"] == status]
+    mine.sort(key=lambda o: -o["createdAt"])
+    records = mine[(page - 1) * pageSize: page * pageSize]
+    return {"code": 200, "data": {"records": records, "page": page, "total": len(mine)}}
+
+@app.get("/vb-user/login")
+@app.get("/vb-user/booking")
+def login_redirect():
+    return _login_page()
+
+
+# ================= 控制接口 =================
+
+@app.post("/__mock/token")
+def issue_token(payload: dict):
+    """签发模拟 Token：{"userId": "...", "account": "..."}"""
+    user_id = str(payload.get("userId") or random.randint(10 ** 8, 10 ** 9))
+    return {"token": make_token(user_id, payload.get("account")), "userId": user_id}
+
+@app.post("/__mock/expire")
+def expire_token(payload: dict):
+    """让指定 Token 失效（之后的请求返回登录页）"""
+    _EXPIRED.add(payload.get("token"))
+    return {"status": "success"}
+
+@app.post("/__mock/config")
+def update_config(payload: dict):
+    # 先全部校验再写入，非法值返回 400 且不留下改了一半的配置
+    updates = {}
+    for k, v in payload.items():
+        if k in CONFIG and k not in ("record", "replay"):
+            try:
+                updates[k] = type(CONFIG[k])(v) if CONFIG[k] is not None else v
+            except (TypeError, ValueError):
+                return JSONResponse({"code": 400, "msg": f"参数 {k} 的值无效: {v!r}"}, status_code=400)
+    CONFIG.update(updates)
+    return CONFIG
+
+@app.post("/__mock/reset")
+def reset():
+    with _LOCK:
+        _SLOTS.clear()
+        _ORDERS.clear()
+        _EXPIRED.clear()
+        _STATS.update({"requests": {}, "injected": {"fail": 0, "stall": 0, "expire": 0},
+                       "contention_lost": 0, "apply_ok": 0, "apply_rejected": 0})
+    return {"status": "success"}
+
+@app.get("/__mock/stats")
+def stats():
+    with _LOCK:
+        return {**_STATS, "orders": len(_ORDERS), "config": CONFIG}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="学校订场接口模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    parser.add_argument("--expire-rate", type=float, default=0.0)
+    parser.add_argument("--contention", type=float, default=0.0)
+    parser.add_argument("--occupancy", type=float, default=0.5)
+    parser.add_argument("--hold-seconds", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--record", help="转发到真实接口并把请求/响应保存到该目录")
+    group.add_argument("--replay", help="回放该目录中录制的响应")
+    args = parser.parse_args()
+
+    for k in ("latency", "jitter", "fail_rate", "stall_rate", "expire_rate", "contention",
+              "occupancy", "hold_seconds", "seed", "record", "replay"):
+        CONFIG[k] = getattr(args, k)
+    random.seed(args.seed)
+    if args.replay:
+        print(f"回放 {load_captures(args.replay)} 条录制")
+    uvicorn.run(app, host=args.host, port=args.port, access_log=False)
+
+
+if __name__ == "__main__":
+    main()
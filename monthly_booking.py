@@ -10,7 +10,11 @@ import uuid
 import requests
 import json
 from typing import List, Dict, Any
-from core import redis_client, add_log, check_token_validity, send_email_notification
+from core import (
+    redis_client, add_log, check_token_validity, send_email_notification,
+    acquire_upstream_slot, PRIORITY_MONTHLY, UPSTREAM_BASE,
+    acquire_task_lease, renew_task_lease, release_task_lease, get_task_lease_owner
+)
 
 # 场地ID映射（1-16号场地）
 VENUE_ID_MAP = {
@@ -33,8 +37,11 @@ VENUE_ID_MAP = {
 }
 
 # 月场任务管理
+# Redis 为唯一数据源（多 worker 时任意进程都能查询/取消）；MONTHLY_TASKS 仅为本进程执行中任务的缓存
+# 每个任务只由持有租约 monthly:{task_id} 的进程执行，进程退出后由其他进程接管
 MONTHLY_TASKS = {}  # {task_id: task_data}
 MONTHLY_TASK_LOCK = threading.Lock()
+MONTHLY_LEASE_TTL = 180  # 等待期间每轮（最长 60 秒）续约一次
 
 def month_weekday_timestamps(year: int, month: int, weekday: int) -> dict:
     """
@@ -66,13 +73,13 @@ def month_weekday_timestamps(year: int, month: int, weekday: int) -> dict:
 
 def send_monthly_booking_request(token: str, user_id: int, year: int, month: int, 
                                  weekday: int, start_time: str, end_time: str, 
-                                 venue_id: str) -> tuple:
+                                 venue_id: str, username: str = None) -> tuple:
     """
     发送月场预定请求
     
     返回：(success: bool, message: str, response_data: dict)
     """
-    url = "https://venue.spe.scut.edu.cn/api/pc/order/rental/orders/apply"
+    url = f"{UPSTREAM_BASE}/api/pc/order/rental/orders/apply"
     
     headers = {
         "accept": "application/json, text/plain, */*",
@@ -108,6 +115,8 @@ def send_monthly_booking_request(token: str, user_id: int, year: int, month: int
     }
     
     try:
+        if not acquire_upstream_slot(PRIORITY_MONTHLY, username):
+            return False, "上游限流，请稍后重试", {}
         response = requests.post(url, headers=headers, json=payload, timeout=10)
         response_data = response.json()
         
@@ -124,9 +133,16 @@ def execute_monthly_booking_task(task_id: str):
     """
     执行月场预定任务的后台线程
     """
+    lease_id = f"monthly:{task_id}"
+    if not acquire_task_lease(lease_id, ttl=MONTHLY_LEASE_TTL):
+        with MONTHLY_TASK_LOCK:
+            MONTHLY_TASKS.pop(task_id, None)
+        return  # 已由其他进程执行
+    
     with MONTHLY_TASK_LOCK:
         task = MONTHLY_TASKS.get(task_id)
         if not task:
+            release_task_lease(lease_id)
             return
     
     try:
@@ -171,6 +187,16 @@ def execute_monthly_booking_task(task_id: str):
             if diff <= 0:
                 break
             
+            # 续约，并检查是否已在其他进程中被取消
+            if diff > 5:
+                if not renew_task_lease(lease_id, ttl=MONTHLY_LEASE_TTL):
+                    add_log(f"⚠️ [月场预定] {username} 租约已被其他进程接管，本进程退出")
+                    return
+                latest = _load_monthly_task(task_id)
+                if latest and latest.get('status') == 'cancelled':
+                    add_log(f"⏹️ [月场预定] {username} 任务已取消")
+                    return
+            
             # 智能休眠
             if diff > 5:
                 time.sleep(min(diff - 2, 60))
@@ -186,8 +212,11 @@ def execute_monthly_booking_task(task_id: str):
             task['status'] = 'running'
             save_monthly_task_to_redis(task_id, task)
         
-        # 检查 Token 有效性
-        if not check_token_validity(token):
+        # 检查 Token 有效性：明确失效才终止；无法判断（上游繁忙）时照常提交，放弃本月名额的代价更大
+        token_valid = check_token_validity(token, priority=PRIORITY_MONTHLY)
+        if token_valid is None:
+            add_log(f"⚠️ [月场预定] {username} 暂时无法确认 Token 状态，继续尝试提交")
+        if token_valid is False:
             add_log(f"❌ [月场预定] {username} Token 已失效，任务终止")
             with MONTHLY_TASK_LOCK:
                 task['status'] = 'failed'
@@ -214,7 +243,7 @@ def execute_monthly_booking_task(task_id: str):
             def submit_venue(vid):
                 success, msg, data = send_monthly_booking_request(
                     token, user_id, target_year, target_month, 
-                    weekday, start_time, end_time, vid
+                    weekday, start_time, end_time, vid, username
                 )
                 results[vid] = (success, msg, data)
             
@@ -283,6 +312,10 @@ def execute_monthly_booking_task(task_id: str):
             task['status'] = 'error'
             task['error'] = str(e)
             save_monthly_task_to_redis(task_id, task)
+    finally:
+        with MONTHLY_TASK_LOCK:
+            MONTHLY_TASKS.pop(task_id, None)
+        release_task_lease(lease_id)
 
 def create_monthly_booking_task(username: str, token: str, user_id: int, email: str,
                                 target_year: int, target_month: int, weekday: int,
@@ -326,8 +359,7 @@ def get_monthly_tasks(username: str = None) -> List[Dict]:
     """
     获取月场任务列表
     """
-    with MONTHLY_TASK_LOCK:
-        tasks = list(MONTHLY_TASKS.values())
+    tasks = list(_load_all_monthly_tasks().values())
     
     if username:
         tasks = [t for t in tasks if t['username'] == username]
@@ -341,7 +373,7 @@ def cancel_monthly_task(task_id: str, username: str) -> bool:
     取消月场任务（仅能取消 pending/waiting 状态的任务）
     """
     with MONTHLY_TASK_LOCK:
-        task = MONTHLY_TASKS.get(task_id)
+        task = _load_monthly_task(task_id)
         if not task:
             return False
         
@@ -354,6 +386,8 @@ def cancel_monthly_task(task_id: str, username: str) -> bool:
         task['status'] = 'cancelled'
         task['cancelled_at'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         save_monthly_task_to_redis(task_id, task)
+        if task_id in MONTHLY_TASKS:
+            MONTHLY_TASKS[task_id].update(status='cancelled', cancelled_at=task['cancelled_at'])
     
     return True
 
@@ -365,26 +399,59 @@ def save_monthly_task_to_redis(task_id: str, task: Dict):
     except:
         pass
 
-def load_monthly_tasks_from_redis():
-    """从 Redis 加载所有月场任务"""
+def _load_monthly_task(task_id: str):
+    try:
+        data = redis_client.get(f"scut_order:monthly_tasks:{task_id}")
+        return json.loads(data) if data else None
+    except:
+        return None
+
+def _load_all_monthly_tasks() -> Dict[str, Dict]:
+    """从 Redis 读取所有月场任务 {task_id: task}"""
+    tasks = {}
     try:
-        keys = redis_client.keys("scut_order:monthly_tasks:*")
-        for key in keys:
-            data = redis_client.get(key)
+        keys = list(redis_client.scan_iter("scut_order:monthly_tasks:*", count=200))
+        for data in (redis_client.mget(keys) if keys else []):
             if data:
                 task = json.loads(data)
-                task_id = task['task_id']
-                
-                with MONTHLY_TASK_LOCK:
-                    MONTHLY_TASKS[task_id] = task
-                
-                # 如果任务处于等待或挂起状态，恢复执行线程
-                if task['status'] in ['pending', 'waiting']:
-                    print(f"Resuming monthly task: {task_id}")
-                    t = threading.Thread(target=execute_monthly_booking_task, args=(task_id,), daemon=True)
-                    t.start()
+                tasks[task['task_id']] = task
+    except Exception as e:
+        print(f"Error reading monthly tasks: {e}")
+        with MONTHLY_TASK_LOCK:
+            tasks = dict(MONTHLY_TASKS)
+    return tasks
+
+def load_monthly_tasks_from_redis():
+    """从 Redis 加载所有月场任务，恢复没有进程在执行的等待中任务"""
+    try:
+        for task_id, task in _load_all_monthly_tasks().items():
+            # 如果任务处于等待或挂起状态，且没有其他进程持有租约，恢复执行线程
+            if task['status'] not in ['pending', 'waiting']:
+                continue
+            with MONTHLY_TASK_LOCK:
+                if task_id in MONTHLY_TASKS:
+                    continue
+            if get_task_lease_owner(f"monthly:{task_id}"):
+                continue
+            with MONTHLY_TASK_LOCK:
+                MONTHLY_TASKS[task_id] = task
+            print(f"Resuming monthly task: {task_id}")
+            t = threading.Thread(target=execute_monthly_booking_task, args=(task_id,), daemon=True)
+            t.start()
     except Exception as e:
         print(f"Error loading monthly tasks: {e}")
 
-# 服务启动时加载历史任务
-load_monthly_tasks_from_redis()
+def _monthly_claim_daemon():
+    """定期接管执行进程已退出的月场任务"""
+    while True:
+        load_monthly_tasks_from_redis()
+        time.sleep(MONTHLY_LEASE_TTL)
+
+_monthly_claim_thread = None
+
+def start_monthly_claim_daemon():
+    """服务启动时加载历史任务并定期接管（由 API 启动事件调用，导入本模块不会访问 Redis）"""
+    global _monthly_claim_thread
+    if _monthly_claim_thread is None or not _monthly_claim_thread.is_alive():
+        _monthly_claim_thread = threading.Thread(target=_monthly_claim_daemon, daemon=True, name="MonthlyClaim")
+        _monthly_claim_thread.start()
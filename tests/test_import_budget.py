@@ -0,0 +1,48 @@
+"""
+导入耗时预算：Celery / 月场等进程只导入 core，不应加载 Selenium，导入时间也要控制在预算内
+
+依赖见 requirements-test.txt: pip install -r requirements-test.txt && python -m pytest tests
+或直接运行: python tests/test_import_budget.py
+"""
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_BUDGET_SECONDS = float(os.environ.get("IMPORT_BUDGET_SECONDS", 3.0))
+
+# 在全新的解释器中导入，避免受当前进程已加载模块的影响
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import core, celery_worker, monthly_booking
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "elapsed": elapsed,
+    "selenium": sorted(m for m in sys.modules if m == "selenium" or m.startswith("selenium.")),
+}))
+"""
+
+
+def measure_import():
+    proc = subprocess.run(
+        [sys.executable, "-c", _PROBE], cwd=ROOT, capture_output=True, text=True, timeout=60
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"导入失败:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def test_import_does_not_load_selenium_and_stays_in_budget():
+    result = measure_import()
+    assert not result["selenium"], f"导入时加载了 Selenium: {result['selenium']}"
+    assert result["elapsed"] < IMPORT_BUDGET_SECONDS, (
+        f"导入耗时 {result['elapsed']:.2f}s 超过预算 {IMPORT_BUDGET_SECONDS}s"
+    )
+
+
+if __name__ == "__main__":
+    result = measure_import()
+    print(f"导入耗时 {result['elapsed']:.2f}s (预算 {IMPORT_BUDGET_SECONDS}s)，Selenium 模块: {result['selenium'] or '无'}")
+    sys.exit(0 if not result["selenium"] and result["elapsed"] < IMPORT_BUDGET_SECONDS else 1)
@@ -0,0 +1,138 @@
+"""
+上游接口回归：在随机端口启动 mock_upstream.py，把 core / monthly_booking 的 UPSTREAM_BASE 指向它，
+覆盖场地查询、单个/批量预定、订单查询和月场预定，包括抢场竞争、Token 失效返回登录页、批量部分失败
+
+依赖见 requirements-test.txt: pip install -r requirements-test.txt && python -m pytest tests
+Redis 不可用时 core 的限流/熔断直接放行，本测试不要求本地运行 Redis
+"""
+import datetime
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+import requests
+import uvicorn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import core  # noqa: E402
+import mock_upstream  # noqa: E402
+import monthly_booking  # noqa: E402
+
+DATE = (datetime.date.today() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+VENUE_A, VENUE_B = mock_upstream.VENUES[0][0], mock_upstream.VENUES[1][0]
+
+
+@pytest.fixture(scope="module")
+def upstream():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    base = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    server = uvicorn.Server(uvicorn.Config(mock_upstream.app, log_level="warning", access_log=False))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True)
+    thread.start()
+    deadline = time.time() + 10
+    while not server.started:
+        assert time.time() < deadline, "mock_upstream 启动超时"
+        time.sleep(0.05)
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(core, "UPSTREAM_BASE", base)
+        mp.setattr(monthly_booking, "UPSTREAM_BASE", base)
+        yield base
+
+    server.should_exit = True
+    thread.join(timeout=5)
+
+
+@pytest.fixture(autouse=True)
+def fresh_upstream(upstream):
+    # 每个用例从全部空闲、无故障注入的场地开始
+    requests.post(f"{upstream}/__mock/reset", timeout=5)
+    requests.post(f"{upstream}/__mock/config", json={"occupancy": 0, "contention": 0, "expire_rate": 0,
+                                                     "fail_rate": 0, "stall_rate": 0, "latency": 0}, timeout=5)
+    for breaker in core.UPSTREAM_BREAKERS.values():
+        breaker.record(core.UPSTREAM_OK)
+    core._BATCH_STATE.update(unsupported_until=0, strikes=0)
+
+
+def _token(upstream, user_id):
+    return requests.post(f"{upstream}/__mock/token", json={"userId": user_id}, timeout=5).json()["token"]
+
+
+def _avail(sessions, venue_id, start_time):
+    return next(s["availNum"] for s in sessions if s["venueId"] == venue_id and s["startTime"] == start_time)
+
+
+def _slot(start_time, venue_id):
+    end_time = f"{int(start_time[:2]) + 1:02d}:00"
+    return {"startTime": start_time, "endTime": end_time, "venueId": venue_id, "price": 40, "venueName": str(venue_id)}
+
+
+def test_fetch_book_and_list_orders(upstream):
+    token = _token(upstream, "1001")
+    sessions = core.fetch_venue_data(token, DATE)
+    assert isinstance(sessions, list) and _avail(sessions, VENUE_A, "10:00") == 1
+
+    ok, msg, _ = core.send_booking_request(token, "1001", DATE, "10:00", "11:00", VENUE_A)
+    assert ok, msg
+    assert _avail(core.fetch_venue_data(token, DATE), VENUE_A, "10:00") == 0
+
+    orders = core.fetch_orders_internal(token, 1)
+    # belongDate 按服务器本地时区换算（生产环境为 UTC+8），这里只核对场次
+    assert [(r["startTime"], r["venueName"]) for r in orders["records"]] == [("10:00", mock_upstream.VENUES[0][1])]
+
+
+def test_contention_loses_the_slot(upstream):
+    requests.post(f"{upstream}/__mock/config", json={"contention": 1}, timeout=5)
+    token = _token(upstream, "1002")
+
+    ok, msg, _ = core.send_booking_request(token, "1002", DATE, "12:00", "13:00", VENUE_A)
+    assert not ok and "已被预订" in msg
+    assert requests.get(f"{upstream}/__mock/stats", timeout=5).json()["contention_lost"] == 1
+
+
+def test_expired_token_gets_login_page(upstream):
+    token = _token(upstream, "1003")
+    requests.post(f"{upstream}/__mock/expire", json={"token": token}, timeout=5)
+
+    assert core.fetch_venue_data(token, DATE) is None
+    assert core.fetch_orders_internal(token, 1) is None
+    ok, _, _ = core.send_booking_request(token, "1003", DATE, "14:00", "15:00", VENUE_A)
+    assert not ok
+    assert core.check_token_validity(token) is False
+
+
+def test_batch_partial_failure_retries_each_slot(upstream):
+    other = _token(upstream, "2000")
+    assert core.send_booking_request(other, "2000", DATE, "16:00", "17:00", VENUE_B)[0]
+
+    token = _token(upstream, "1004")
+    free, taken = _slot("16:00", VENUE_A), _slot("16:00", VENUE_B)
+    booked, failed = core.send_batch_booking_request(token, "1004", DATE, [free, taken])
+
+    assert booked == [free]
+    assert [slot for slot, _ in failed] == [taken]
+    # 确有场次不可订，不能因此停用合并预定
+    assert core._BATCH_STATE["unsupported_until"] == 0
+
+
+def test_monthly_apply(upstream):
+    token = _token(upstream, "1005")
+    next_month = (datetime.date.today().replace(day=1) + datetime.timedelta(days=32))
+    args = (token, 1005, next_month.year, next_month.month, 3, "18:00", "19:00", str(VENUE_A))
+
+    ok, msg, _ = monthly_booking.send_monthly_booking_request(*args)
+    assert ok, msg
+    ok, msg, _ = monthly_booking.send_monthly_booking_request(*args)
+    assert not ok and "已被预订" in msg
+
+
+def test_mock_config_rejects_non_numeric(upstream):
+    resp = requests.post(f"{upstream}/__mock/config", json={"latency": "slow", "contention": 0.5}, timeout=5)
+    assert resp.status_code == 400
+    assert requests.get(f"{upstream}/__mock/stats", timeout=5).json()["config"]["contention"] == 0